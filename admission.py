@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Seconds a connection may sit between requests before it is closed
+DEFAULT_IDLE_TIMEOUT = 300.0
+# Seconds a client gets to finish sending a request it has started, and to
+# accept a response
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_WRITE_TIMEOUT = 30.0
+# Requests waiting for a worker beyond the ones being run; more are shed
+DEFAULT_MAX_QUEUE = 256
+# A request that waited this long for a worker is shed instead of run: its
+# client has likely given up, and running it would only delay the next ones
+DEFAULT_QUEUE_TIMEOUT = 5.0
+# Suggested client back-off after a busy reply
+BUSY_RETRY_AFTER = 0.25
+# Clients tracked by the rate limiter; the least recently seen are forgotten
+MAX_CLIENTS = 10000
+
+
+# Token bucket per client address: rate requests per second on average,
+# bursts of up to burst
+class ClientRateLimiter:
+    def __init__(self, rate, burst=None, max_clients=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.max_clients = max_clients
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns 0 if the client may send a request now, otherwise the seconds
+    # until it may
+    def check(self, client):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                tokens = self.burst
+                if len(self._buckets) >= self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens, updated = bucket
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1.0:
+                self._buckets[client] = (tokens - 1.0, now)
+                return 0.0
+            self._buckets[client] = (tokens, now)
+            self.limited += 1
+            return (1.0 - tokens) / self.rate
+
+    def stats(self):
+        with self._lock:
+            return {'clients': len(self._buckets), 'limited': self.limited}
+
+
+# Bounded queue in front of the request workers: at most `workers` requests
+# run at once and max_queued more may wait. Beyond that a request is answered
+# straight away with a busy reply instead of piling up, and one that waited
+# longer than timeout is shed rather than run. call() runs the request on the
+# calling thread (the threaded server's connection threads); submit() runs it
+# on the queue's own threads (the event loop).
+class RequestQueue:
+    def __init__(self, run, shed, workers, max_queued=DEFAULT_MAX_QUEUE, timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.run = run
+        self.shed = shed
+        self.workers = workers
+        self.max_pending = workers + max_queued
+        self.timeout = timeout
+        self.rejected = 0
+        self.expired = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers)
+        self._executor = None
+
+    def _enter(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self._pending += 1
+            return True
+
+    def _leave(self, expired=False):
+        with self._lock:
+            self._pending -= 1
+            self.expired += int(expired)
+
+    # The encoded response
+    def call(self, payload):
+        if not self._enter():
+            return self.shed(payload, 'busy')
+        if not self._slots.acquire(timeout=self.timeout or None):
+            self._leave(expired=True)
+            return self.shed(payload, 'busy')
+        try:
+            return self.run(payload)
+        finally:
+            self._slots.release()
+            self._leave()
+
+    # A future for the encoded response
+    def submit(self, payload):
+        if not self._enter():
+            future = Future()
+            future.set_result(self.shed(payload, 'busy'))
+            return future
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='request-worker')
+        return self._executor.submit(self._process, payload, time.monotonic())
+
+    def _process(self, payload, queued_at):
+        if self.timeout and time.monotonic() - queued_at > self.timeout:
+            self._leave(expired=True)
+            return self.shed(payload, 'busy')
+        try:
+            return self.run(payload)
+        finally:
+            self._leave()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._pending, 'max_pending': self.max_pending,
+                    'rejected': self.rejected, 'expired': self.expired}
+
+    def shutdown(self, wait=False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+# Connection and request limits shared by the threaded and async servers
+class Admission:
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 write_timeout=DEFAULT_WRITE_TIMEOUT, max_queue=DEFAULT_MAX_QUEUE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, client_rate=0.0, client_burst=None):
+        self.idle_timeout = idle_timeout or None
+        self.read_timeout = read_timeout or None
+        self.write_timeout = write_timeout or None
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.limiter = ClientRateLimiter(client_rate, client_burst) if client_rate else None
+        self.requests = None
+        self._events = {'refused': 0, 'idle_closed': 0, 'read_timeouts': 0, 'write_timeouts': 0}
+        self._lock = threading.Lock()
+
+    def start(self, run, shed, workers):
+        self.requests = RequestQueue(run, shed, workers, self.max_queue, self.queue_timeout)
+        return self.requests
+
+    # Seconds the client must wait before its next request, 0 if it may go ahead
+    def throttle(self, client):
+        return self.limiter.check(client) if self.limiter is not None else 0.0
+
+    def count(self, event):
+        with self._lock:
+            self._events[event] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._events)
+        if self.requests is not None:
+            stats.update(self.requests.stats())
+        if self.limiter is not None:
+            stats.update(('rate_' + key, value) for key, value in self.limiter.stats().items())
+        return stats
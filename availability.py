@@ -0,0 +1,82 @@
+import datetime
+import threading
+import time
+
+from db import get_pool
+
+# Longest stay a single booking may cover
+MAX_NIGHTS = 90
+# Reads accept an occupancy index this many seconds old before catching up
+REFRESH_INTERVAL = 0.5
+
+
+# Parse ISO check-in/check-out dates into night ordinals: a stay covers the
+# nights check_in .. check_out - 1
+def parse_stay(check_in, check_out):
+    try:
+        first = datetime.date.fromisoformat(check_in).toordinal()
+        end = datetime.date.fromisoformat(check_out).toordinal()
+    except (TypeError, ValueError):
+        raise ValueError(f"Dates must be given as YYYY-MM-DD, got {check_in!r} and {check_out!r}")
+    if end <= first:
+        raise ValueError("check_out must be after check_in")
+    if end - first > MAX_NIGHTS:
+        raise ValueError(f"Stays are limited to {MAX_NIGHTS} nights")
+    return first, end
+
+
+# Per-night occupancy index: for every room type, the number of rooms booked
+# on each night. A date-range query is one dict lookup per night of the stay,
+# independent of how many bookings exist. The index follows the Bookings
+# table by reading rows with an id above the last one it has seen, which also
+# picks up bookings written by other processes.
+class AvailabilityIndex:
+    def __init__(self):
+        self._occupancy = {}
+        self._last_booking_id = 0
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def catch_up(self, conn):
+        with self._lock:
+            rows = conn.execute(
+                "SELECT id, room_type_id, check_in, check_out FROM Bookings WHERE id > ? ORDER BY id",
+                (self._last_booking_id,)).fetchall()
+            for booking_id, room_type_id, check_in, check_out in rows:
+                self._last_booking_id = booking_id
+                if room_type_id is None or check_in is None or check_out is None:
+                    continue
+                try:
+                    first, end = parse_stay(check_in, check_out)
+                except ValueError:
+                    continue
+                nights = self._occupancy.setdefault(room_type_id, {})
+                for night in range(first, end):
+                    nights[night] = nights.get(night, 0) + 1
+            self._refreshed_at = time.monotonic()
+
+    def refresh(self, max_age=REFRESH_INTERVAL):
+        if time.monotonic() - self._refreshed_at > max_age:
+            with get_pool().connection() as conn:
+                self.catch_up(conn)
+
+    def booked(self, room_type_id, first, end):
+        nights = self._occupancy.get(room_type_id)
+        if not nights:
+            return 0
+        return max(nights.get(night, 0) for night in range(first, end))
+
+    # Rooms of this type free on every night of the stay; inventory of None means unlimited
+    def available(self, room_type_id, inventory, first, end):
+        if inventory is None:
+            return None
+        return max(0, inventory - self.booked(room_type_id, first, end))
+
+    def reset(self):
+        with self._lock:
+            self._occupancy = {}
+            self._last_booking_id = 0
+            self._refreshed_at = 0.0
+
+
+availability = AvailabilityIndex()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import db
+import server
+from booking_writer import configure_writer, get_writer
+
+# Booking write throughput: the group-commit writer against one transaction
+# per booking on a pooled connection (the path save_booking used before).
+# Every mode stores the same undated bookings from the same number of
+# threads into a fresh database.
+
+
+def booking(worker_id, index):
+    return {
+        'transport_type': None, 'origin': 'Chicago', 'destination': 'Chicago', 'transport_cost': 0,
+        'hotel_name': 'City Central', 'room_type': 'Suite', 'hotel_cost': 100, 'total_amount': 100,
+        'booking_id': f'BENCH-{worker_id}-{index}',
+    }
+
+
+def per_row(details):
+    with db.get_pool().transaction() as conn:
+        server.insert_booking(conn, dict(details, idempotency_key=None))
+
+
+def group_commit(details):
+    server.save_booking({'booking': details})
+
+
+def run(mode, threads, bookings, synchronous, max_batch, max_wait):
+    workdir = tempfile.mkdtemp(prefix='bench_bookings_')
+    db.configure_pool(os.path.join(workdir, 'hotel_booking.db'), max_size=threads)
+    configure_writer(max_batch=max_batch, max_wait=max_wait)
+    server.setup_database()
+    if mode == 'row':
+        # Pooled connections only take the synchronous level from PRAGMAS, so
+        # set it on each one before the run starts
+        conns = [db.get_pool().acquire() for _ in range(threads)]
+        for conn in conns:
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+        for conn in conns:
+            db.get_pool().release(conn)
+    store = per_row if mode == 'row' else group_commit
+    per_thread = bookings // threads
+    start = threading.Barrier(threads + 1)
+
+    def worker(worker_id):
+        start.wait()
+        for index in range(per_thread):
+            store(booking(worker_id, index))
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with db.get_pool().connection() as conn:
+        stored = conn.execute("SELECT COUNT(*) FROM Bookings").fetchone()[0]
+    stats = get_writer().stats() if mode == 'group' else None
+    configure_writer()
+    db.configure_pool()
+    return stored, elapsed, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare booking write throughput: per-row commits vs group commit")
+    parser.add_argument('--threads', type=int, default=32, help="concurrent writers")
+    parser.add_argument('--bookings', type=int, default=5000, help="bookings per mode")
+    parser.add_argument('--max-batch', type=int, default=256, help="group commit: most bookings per transaction")
+    parser.add_argument('--max-wait', type=float, default=0.0,
+                        help="group commit: milliseconds to wait for a fuller batch")
+    args = parser.parse_args()
+
+    modes = [
+        ('per-row commit, synchronous=NORMAL', 'row', 'NORMAL'),
+        ('per-row commit, synchronous=FULL', 'row', 'FULL'),
+        ('group commit, synchronous=FULL', 'group', 'FULL'),
+    ]
+    print(f"{args.bookings} bookings from {args.threads} threads")
+    print(f"{'mode':<38} {'bookings/s':>12} {'avg batch':>10}")
+    for label, mode, synchronous in modes:
+        stored, elapsed, stats = run(mode, args.threads, args.bookings, synchronous, args.max_batch, args.max_wait / 1000)
+        batch = f"{stats['average_batch']:.1f}" if stats else '1.0'
+        print(f"{label:<38} {stored / elapsed:>12,.0f} {batch:>10}")
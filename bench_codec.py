@@ -0,0 +1,47 @@
+import argparse
+import pickle
+import timeit
+
+import codec
+
+# Representative messages: a small request, a typical catalog response and a large result set
+SAMPLES = {
+    'request': {'action': 'fetch_transports', 'origin': 'San Francisco', 'destination': 'Chicago'},
+    'room_types': [(1, 1, 'Single Room', 150.0), (2, 1, 'Double Room', 200.0), (3, 1, 'Suite', 250.0), (4, 1, 'Delux Suite', 350.0)],
+    'booking': {'action': 'save_booking', 'booking': {
+        'booking_id': 'BOOK-1234', 'transport_type': 'Train', 'origin': 'San Francisco', 'destination': 'Chicago',
+        'transport_cost': 110.0, 'hotel_name': 'Skyline Plaza', 'room_type': 'Suite', 'hotel_cost': 255.0, 'total_amount': 365.0}},
+    'large_rows': [(i, i % 50, f'Hotel {i}', 'Chicago', 100.0 + i) for i in range(5000)],
+}
+
+CODECS = {
+    'pickle (unrestricted)': (lambda obj: pickle.dumps(obj), pickle.loads),
+    'pickle': (lambda obj: codec.encode(obj, codec.PICKLE), codec.decode),
+    'binary': (lambda obj: codec.encode(obj, codec.BINARY), codec.decode),
+    'json': (lambda obj: codec.encode(obj, codec.JSON), codec.decode),
+}
+
+
+def measure(func, arg, min_time):
+    timer = timeit.Timer(lambda: func(arg))
+    number, elapsed = timer.autorange()
+    while elapsed < min_time:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return number / elapsed
+
+
+def run(min_time=0.2):
+    print(f"{'Message':<12} {'Codec':<22} {'Bytes':>8} {'Encode/s':>12} {'Decode/s':>12}")
+    for sample_name, obj in SAMPLES.items():
+        for codec_name, (encode, decode) in CODECS.items():
+            payload = encode(obj)
+            encode_rate = measure(encode, obj, min_time)
+            decode_rate = measure(decode, payload, min_time)
+            print(f"{sample_name:<12} {codec_name:<22} {len(payload):>8} {encode_rate:>12,.0f} {decode_rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare encode/decode throughput of the wire codecs")
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds to spend per measurement")
+    run(parser.parse_args().min_time)
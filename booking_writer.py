@@ -0,0 +1,173 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from db import PRAGMAS, get_pool
+
+logger = logging.getLogger('server.writer')
+
+DEFAULT_MAX_BATCH = 256
+# How long the writer waits for more jobs before committing a batch that is
+# not full. Jobs that queue up while a commit is running join the next batch
+# without any wait, which already batches well under load; a wait only adds
+# latency when every caller is already in the batch.
+DEFAULT_MAX_WAIT = 0.0
+
+
+# Group-commit writer: one thread owns a write connection and runs queued
+# jobs in batches, one transaction and one fsync per batch instead of per
+# booking. A job is a callable taking the connection; it runs under its own
+# savepoint, so a job that raises is rolled back alone and the rest of the
+# batch still commits. The future returned by submit() resolves only after
+# the batch's COMMIT, and commits are synchronous=FULL, so a result is a
+# durable acknowledgement.
+class BookingWriter:
+    def __init__(self, path, busy_timeout=5.0, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.jobs = 0
+        self.largest_batch = 0
+        self._queue = queue.SimpleQueue()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        for pragma in PRAGMAS:
+            self._conn.execute(pragma)
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='booking-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        if self._closed:
+            raise RuntimeError("Booking writer is closed")
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    # Run job in the writer and wait for its committed result
+    def run(self, job):
+        return self.submit(job).result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if any(item is None for item in batch):
+                batch = [item for item in batch if item is not None]
+                if batch:
+                    self._commit(batch)
+                return
+            self._commit(batch)
+
+    def _commit(self, batch):
+        conn = self._conn
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = job(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    outcomes.append((future, None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    outcomes.append((future, result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # The whole batch is lost: every job that had not already failed gets this error
+            logger.error("Booking batch of %d failed to commit: %s", len(batch), e)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self._on_rollback()
+            outcomes = [(future, None, error or e) for future, _, error in outcomes]
+            started = {id(future) for future, _, _ in outcomes}
+            outcomes += [(future, None, e) for _, future in batch
+                         if id(future) not in started and not future.cancelled()]
+
+        self.batches += 1
+        self.jobs += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # Called after a batch is rolled back; state derived from rows the jobs
+    # wrote (such as the occupancy index) must be rebuilt
+    def _on_rollback(self):
+        for callback in rollback_listeners:
+            callback()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'jobs': self.jobs,
+            'largest_batch': self.largest_batch,
+            'average_batch': self.jobs / self.batches if self.batches else 0.0,
+            'queued': self._queue.qsize(),
+        }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._conn.close()
+
+
+# Callables run when a batch is rolled back
+rollback_listeners = []
+
+_writer = None
+_writer_lock = threading.Lock()
+_writer_options = {}
+
+
+# The process's writer, on the shared pool's database; it follows the pool
+# when configure_pool points it at another file
+def get_writer():
+    global _writer
+    pool = get_pool()
+    with _writer_lock:
+        if _writer is None or _writer.path != pool.path:
+            if _writer is not None:
+                _writer.close()
+            _writer = BookingWriter(pool.path, pool.busy_timeout, **_writer_options)
+        return _writer
+
+
+def configure_writer(**options):
+    global _writer
+    with _writer_lock:
+        _writer_options.clear()
+        _writer_options.update(options)
+        if _writer is not None:
+            _writer.close()
+            _writer = None
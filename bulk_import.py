@@ -0,0 +1,239 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from db import DB_PATH
+from schema import create_change_log_triggers, drop_change_log_triggers, ensure_schema, restart_change_log
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Importable catalog tables: (table, [(column, type, required)]). Rows without
+# an id get the next free one; rows with an id keep it, so RoomType.hotel_id
+# can refer to hotels imported earlier.
+TABLES = {
+    'transports': ('Transport', [('id', int, False), ('type', str, True), ('cost', float, True),
+                                 ('origin', str, True), ('destination', str, True), ('duration', float, False)]),
+    'hotels': ('Hotel', [('id', int, False), ('name', str, True), ('destination', str, True)]),
+    'room_types': ('RoomType', [('id', int, False), ('hotel_id', int, True), ('type', str, True),
+                                ('cost', float, True), ('inventory', int, False)]),
+}
+
+NON_NEGATIVE = {'cost', 'duration', 'inventory'}
+
+
+class ImportAborted(Exception):
+    pass
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Passed on as is, so it is rejected like any other bad record
+                yield line
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    if extension == 'json':
+        extension = 'jsonl'
+    if extension not in READERS:
+        raise ValueError(f"Cannot tell the format of {path}; pass --format")
+    return extension
+
+
+# Turn one input record into a parameter tuple, or raise ValueError. CSV gives
+# every field as a string, so empty strings count as missing. This runs once
+# per row and dominates the load time, so it is kept to the bare checks.
+def convert(record, columns):
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+    values = []
+    for name, column_type, required in columns:
+        value = record.get(name)
+        if column_type is str and value is not None:
+            value = str(value).strip()
+        if value is None or value == '':
+            if required:
+                raise ValueError(f"{name} is required")
+            values.append(None)
+            continue
+        if column_type is not str:
+            try:
+                value = column_type(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{name} must be {column_type.__name__}, got {value!r}")
+            # Also false for NaN
+            if name in NON_NEGATIVE and not value >= 0:
+                raise ValueError(f"{name} must be a non-negative number, got {value!r}")
+        values.append(value)
+    return tuple(values)
+
+
+# Secondary indexes on table are dropped for the load and rebuilt once at the
+# end: one sorted build is much cheaper than updating every index per row
+def drop_indexes(conn, table):
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+                           (table,)).fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX "{name}"')
+    return [sql for _, sql in indexes]
+
+
+class Importer:
+    def __init__(self, conn, kind, chunk_size=DEFAULT_CHUNK_SIZE, max_errors=0, rejects=None):
+        self.conn = conn
+        self.table, self.columns = TABLES[kind]
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.rejects = rejects
+        self.loaded = 0
+        self.rejected = 0
+        names = ', '.join(name for name, _, _ in self.columns)
+        placeholders = ', '.join('?' for _ in self.columns)
+        self.insert = f"INSERT INTO {self.table} ({names}) VALUES ({placeholders})"
+
+    def reject(self, line, record, error):
+        self.rejected += 1
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({'line': line, 'error': str(error), 'record': record}, default=str) + '\n')
+        if self.rejected > self.max_errors:
+            raise ImportAborted(f"Too many rejected rows ({self.rejected}); last at record {line}: {error}")
+
+    def load_chunk(self, chunk):
+        rows = []
+        for line, record in chunk:
+            try:
+                rows.append((line, record, convert(record, self.columns)))
+            except ValueError as e:
+                self.reject(line, record, e)
+        if not rows:
+            return
+        # The savepoint undoes a partly applied executemany so the chunk can be
+        # replayed row by row to find the rows the database refuses
+        self.conn.execute("SAVEPOINT chunk")
+        try:
+            self.conn.executemany(self.insert, [params for _, _, params in rows])
+            self.conn.execute("RELEASE chunk")
+            self.loaded += len(rows)
+            return
+        except sqlite3.IntegrityError:
+            self.conn.execute("ROLLBACK TO chunk")
+            self.conn.execute("RELEASE chunk")
+        for line, record, params in rows:
+            try:
+                self.conn.execute(self.insert, params)
+                self.loaded += 1
+            except sqlite3.IntegrityError as e:
+                self.reject(line, record, e)
+
+    # The change log triggers are dropped for the load too: replicas copy the
+    # tables again under a new log instead of replaying the import row by row
+    def run(self, records, replace=False):
+        drop_change_log_triggers(self.conn, self.table)
+        if replace:
+            self.conn.execute(f"DELETE FROM {self.table}")
+        indexes = drop_indexes(self.conn, self.table)
+        records = enumerate(records, 1)
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+            if not chunk:
+                break
+            self.load_chunk(chunk)
+        for sql in indexes:
+            self.conn.execute(sql)
+        create_change_log_triggers(self.conn, self.table)
+        restart_change_log(self.conn)
+
+
+# Load one file into one catalog table in a single transaction: either every
+# accepted row is committed or, on abort, nothing is. on_commit is called once
+# the rows are committed, e.g. with catalog.invalidate when importing from a
+# server process; servers in other processes see the import at their next
+# catalog change check (the import starts a new change log).
+def import_file(path, kind, fmt=None, db_path=DB_PATH, chunk_size=DEFAULT_CHUNK_SIZE, replace=False,
+                max_errors=0, rejects_path=None, on_commit=None):
+    reader = READERS[fmt or detect_format(path)]
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    rejects = open(rejects_path, 'w', encoding='utf-8') if rejects_path else None
+    started = time.perf_counter()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        # The load is one transaction that is simply re-run if the machine dies,
+        # so skip the per-commit fsync and give the page cache room for index builds
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA cache_size=-262144")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        importer = Importer(conn, kind, chunk_size, max_errors, rejects)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ensure_schema(conn, seed=False)
+            importer.run(reader(path), replace)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if on_commit is not None:
+            on_commit()
+        orphans = conn.execute("SELECT COUNT(*) FROM pragma_foreign_key_check('RoomType')").fetchone()[0]
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+        if rejects is not None:
+            rejects.close()
+    return {
+        'table': importer.table,
+        'loaded': importer.loaded,
+        'rejected': importer.rejected,
+        'orphaned_room_types': orphans,
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load a catalog file into the booking database")
+    parser.add_argument('kind', choices=sorted(TABLES), help="catalog table to load")
+    parser.add_argument('file', help="CSV with a header row, or JSON lines")
+    parser.add_argument('--format', choices=sorted(READERS), help="input format (default: from the file extension)")
+    parser.add_argument('--db', default=DB_PATH, help="database file")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="rows per executemany batch")
+    parser.add_argument('--replace', action='store_true', help="delete the table's existing rows first")
+    parser.add_argument('--max-errors', type=int, default=0, help="abort when more rows than this are rejected")
+    parser.add_argument('--rejects', help="write rejected rows and the reason to this JSON lines file")
+    args = parser.parse_args(argv)
+
+    try:
+        result = import_file(args.file, args.kind, args.format, args.db, args.chunk_size, args.replace,
+                             args.max_errors, args.rejects)
+    except (ImportAborted, ValueError, OSError, sqlite3.Error) as e:
+        print(f"Import failed, nothing was written: {e}", file=sys.stderr)
+        return 1
+
+    rate = result['loaded'] / result['seconds'] if result['seconds'] else 0
+    print(f"{result['table']}: loaded {result['loaded']} rows, rejected {result['rejected']} "
+          f"in {result['seconds']:.2f}s ({rate:,.0f} rows/s)")
+    if result['orphaned_room_types']:
+        print(f"Warning: {result['orphaned_room_types']} room types refer to hotels that do not exist", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
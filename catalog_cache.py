@@ -0,0 +1,175 @@
+import functools
+import hashlib
+import threading
+import time
+
+from db import get_pool
+from schema import CATALOG_TABLES
+from search import DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT, SearchIndex
+
+# Seconds a snapshot is used before checking the database for catalog changes
+# made outside this process (bulk imports, manual SQL, other workers)
+DEFAULT_TTL = 5.0
+
+# Changes whenever a catalog row does: the change log triggers record every
+# write to these tables, and a bulk import starts a new log
+CATALOG_VERSION_SQL = "SELECT (SELECT value FROM ReplicationState WHERE name = 'log_id'), " + ', '.join(
+    f"(SELECT MAX(seq) FROM ChangeLog WHERE table_name = '{table}')" for table in CATALOG_TABLES)
+
+
+# Immutable view of the Transport, Hotel and RoomType tables with the lookup
+# indexes the read actions need, built in one pass when the catalog is loaded
+class CatalogSnapshot:
+    def __init__(self, transports, hotels, room_types, version=None):
+        self.transports = transports
+        self.hotels = hotels
+        self.room_types = room_types
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.checked_at = self.loaded_at
+
+        self.transports_by_route = {}
+        for row in transports:
+            origin, destination = row[3], row[4]
+            self.transports_by_route.setdefault(origin, {}).setdefault(destination, []).append(row)
+
+        self.hotels_by_destination = {}
+        for row in hotels:
+            self.hotels_by_destination.setdefault(row[2], []).append(row)
+
+        self.room_types_by_hotel = {}
+        self.room_types_by_id = {}
+        for row in room_types:
+            self.room_types_by_hotel.setdefault(row[1], []).append(row)
+            self.room_types_by_id[row[0]] = row
+
+        cities = set(self.transports_by_route)
+        cities.update(row[4] for row in transports)
+        cities.update(self.hotels_by_destination)
+        self.cities = list(cities)
+        # Sorted views for paged queries, filled in by catalog_query on first use
+        self.orderings = {}
+
+    # Content hash of the catalog: identical in every process serving the same
+    # data, so a client can revalidate against whichever worker answers
+    @functools.cached_property
+    def etag(self):
+        digest = hashlib.blake2b(digest_size=12)
+        for table in (self.transports, self.hotels, self.room_types):
+            digest.update(repr(table).encode())
+        return digest.hexdigest()
+
+
+    # Name search over the cities and hotels, built on first use
+    @functools.cached_property
+    def search_index(self):
+        return SearchIndex(self.cities, self.hotels)
+
+
+def catalog_version(conn):
+    return tuple(conn.execute(CATALOG_VERSION_SQL).fetchone())
+
+
+def current_version():
+    with get_pool().connection() as conn:
+        return catalog_version(conn)
+
+
+def load_snapshot():
+    with get_pool().connection() as conn:
+        # Read first, so a change made during the load is seen by the next check
+        version = catalog_version(conn)
+        transports = conn.execute("SELECT * FROM Transport ORDER BY id").fetchall()
+        hotels = conn.execute("SELECT * FROM Hotel ORDER BY id").fetchall()
+        room_types = conn.execute("SELECT * FROM RoomType ORDER BY id").fetchall()
+    return CatalogSnapshot(transports, hotels, room_types, version)
+
+
+# Read-through cache: the first read after startup or invalidate() loads the
+# whole catalog once; every other read is a dict lookup. Once a snapshot is ttl
+# seconds old one request checks the version, and the catalog is only loaded
+# again if it changed; meanwhile other requests keep using the old snapshot.
+class CatalogCache:
+    def __init__(self, loader=load_snapshot, ttl=DEFAULT_TTL, version=current_version):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._loads = 0
+        self._checks = 0
+        self._invalidations = 0
+
+    def _expired(self, snapshot):
+        return self.ttl is not None and time.monotonic() - snapshot.checked_at > self.ttl
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        # With a snapshot to fall back on, only one request at a time checks for changes
+        if (snapshot is not None and not self._expired(snapshot)) or not self._lock.acquire(blocking=snapshot is None):
+            with self._stats_lock:
+                self._hits += 1
+            return snapshot
+
+        try:
+            snapshot = self._snapshot
+            if snapshot is not None and self._expired(snapshot) and snapshot.version is not None \
+                    and self.version is not None:
+                self._checks += 1
+                if self.version() == snapshot.version:
+                    snapshot.checked_at = time.monotonic()
+            if snapshot is None or self._expired(snapshot):
+                snapshot = self.loader()
+                self._snapshot = snapshot
+                self._loads += 1
+        finally:
+            self._lock.release()
+        with self._stats_lock:
+            self._misses += 1
+        return snapshot
+
+    # Call whenever Transport, Hotel or RoomType rows change
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._invalidations += 1
+
+    def cities(self):
+        return list(self.snapshot().cities)
+
+    def transports(self, origin, destination):
+        return list(self.snapshot().transports_by_route.get(origin, {}).get(destination, ()))
+
+    def hotels(self, destination):
+        return list(self.snapshot().hotels_by_destination.get(destination, ()))
+
+    def room_types(self, hotel_id):
+        return list(self.snapshot().room_types_by_hotel.get(hotel_id, ()))
+
+    def room_type(self, room_type_id):
+        return self.snapshot().room_types_by_id.get(room_type_id)
+
+    def search(self, query, kinds=None, limit=DEFAULT_SEARCH_LIMIT, city=None):
+        return self.snapshot().search_index.search(query, kinds, limit, city)
+
+    def stats(self):
+        snapshot = self._snapshot
+        with self._stats_lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'loads': self._loads,
+                'checks': self._checks,
+                'invalidations': self._invalidations,
+                'ttl': self.ttl,
+                'age': None if snapshot is None else time.monotonic() - snapshot.loaded_at,
+                'transports': 0 if snapshot is None else len(snapshot.transports),
+                'hotels': 0 if snapshot is None else len(snapshot.hotels),
+                'room_types': 0 if snapshot is None else len(snapshot.room_types),
+            }
+
+
+catalog = CatalogCache()
@@ -0,0 +1,145 @@
+import base64
+import bisect
+import json
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Request keys that ask for a page instead of the whole list
+PAGE_OPTIONS = ('fields', 'min_price', 'max_price', 'sort', 'limit', 'cursor')
+
+# Columns of each catalog row. Hotels also offer price_from, the cheapest
+# room's nightly cost, and dated room types their free room count.
+COLUMNS = {
+    'transports': ('id', 'type', 'cost', 'origin', 'destination', 'duration'),
+    'hotels': ('id', 'name', 'destination', 'price_from'),
+    'room_types': ('id', 'hotel_id', 'type', 'cost', 'inventory', 'available'),
+}
+# Columns the price filters apply to, and the sort keys each table offers
+PRICE_COLUMN = {'transports': 'cost', 'hotels': 'price_from', 'room_types': 'cost'}
+SORT_KEYS = {
+    'transports': ('cost', 'duration', 'type', 'id'),
+    'hotels': ('name', 'price_from', 'id'),
+    'room_types': ('cost', 'type', 'id'),
+}
+DEFAULT_SORT = {'transports': 'cost', 'hotels': 'name', 'room_types': 'cost'}
+
+
+def wants_page(request):
+    return any(request.get(option) is not None for option in PAGE_OPTIONS)
+
+
+def encode_cursor(sort, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, key]).encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    try:
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor belongs to a query with a different sort")
+    return tuple(key)
+
+
+def _sort_value(value):
+    # None sorts after every value (a hotel without rooms has no price)
+    return (value is None, value if value is not None else 0)
+
+
+# One group of catalog rows (a route's transports, a city's hotels or a
+# hotel's room types) sorted by one column, with the sort keys alongside for
+# binary searches. Built once per snapshot and reused by every page.
+def _ordering(snapshot, table, group, rows, sort):
+    cache = snapshot.orderings
+    cache_key = (table, group, sort)
+    ordering = cache.get(cache_key)
+    if ordering is None:
+        position = COLUMNS[table].index(sort)
+        keyed = sorted((_sort_value(row[position]) + (row[0],), row) for row in rows)
+        ordering = cache[cache_key] = ([key for key, _ in keyed], [row for _, row in keyed])
+    return ordering
+
+
+def hotel_rows(snapshot, destination):
+    cache = snapshot.orderings
+    rows = cache.get(('hotel_rows', destination))
+    if rows is None:
+        rows = []
+        for hotel in snapshot.hotels_by_destination.get(destination, ()):
+            costs = [room[3] for room in snapshot.room_types_by_hotel.get(hotel[0], ()) if room[3] is not None]
+            rows.append(tuple(hotel[:3]) + (min(costs) if costs else None,))
+        cache[('hotel_rows', destination)] = rows
+    return rows
+
+
+# One page of rows from table's group, as {'fields', 'rows', 'next_cursor'}.
+# fields picks and orders the columns; min_price and max_price filter on the
+# table's price column; sort is a sort key, '-' first for descending, always
+# tie-broken by id; cursor continues after the last row of the previous
+# page (keyset pagination, so deep pages cost no more than the first).
+# extend(row), for dated queries, returns None to drop a row or the row to
+# serve (room types get their free room count appended); columns names the
+# served row's columns.
+def page(snapshot, table, group, rows, request, extend=None, columns=None):
+    sort = request.get('sort') or DEFAULT_SORT[table]
+    descending = sort.startswith('-')
+    column = sort.lstrip('-')
+    if column not in SORT_KEYS[table]:
+        raise ValueError(f"Cannot sort {table} by {column!r}; choose from {', '.join(SORT_KEYS[table])}")
+    columns = columns or COLUMNS[table]
+    fields = request.get('fields') or list(columns)
+    if not isinstance(fields, (list, tuple)) or not all(isinstance(field, str) for field in fields):
+        raise ValueError(f"fields must be a list of {table} field names")
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise ValueError(f"Unknown {table} fields: {', '.join(map(str, unknown))}")
+    limit = request.get('limit') or DEFAULT_PAGE_SIZE
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    min_price = request.get('min_price')
+    max_price = request.get('max_price')
+    for name, value in (('min_price', min_price), ('max_price', max_price)):
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"{name} must be a number, not {value!r}")
+    price = COLUMNS[table].index(PRICE_COLUMN[table])
+
+    keys, ordered = _ordering(snapshot, table, group, rows, column)
+    low, high = 0, len(keys)
+    if column == PRICE_COLUMN[table]:
+        # Sorted by price, the price range is a slice of the ordering
+        if min_price is not None:
+            low = bisect.bisect_left(keys, (False, min_price))
+        if max_price is not None:
+            high = bisect.bisect_right(keys, (False, max_price, float('inf')))
+    cursor = request.get('cursor')
+    if descending:
+        if cursor is not None:
+            high = min(high, bisect.bisect_left(keys, decode_cursor(cursor, sort)))
+        positions = range(high - 1, low - 1, -1)
+    else:
+        if cursor is not None:
+            low = max(low, bisect.bisect_right(keys, decode_cursor(cursor, sort)))
+        positions = range(low, high)
+
+    indexes = [columns.index(field) for field in fields]
+    result = []
+    next_cursor = None
+    last = None
+    for position in positions:
+        row = ordered[position]
+        if min_price is not None and (row[price] is None or row[price] < min_price):
+            continue
+        if max_price is not None and (row[price] is None or row[price] > max_price):
+            continue
+        if extend is not None:
+            row = extend(row)
+            if row is None:
+                continue
+        if len(result) == limit:
+            # Another row matches, so there is a next page; it starts after the last row served
+            next_cursor = encode_cursor(sort, keys[last])
+            break
+        result.append(tuple(row[index] for index in indexes))
+        last = position
+    return {'fields': list(fields), 'rows': result, 'next_cursor': next_cursor}
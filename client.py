@@ -1,61 +1,442 @@
 import socket
-import pickle
 import getpass
-import random
 import time
 import datetime
-import csv
 import logging
+import threading
+import atexit
+import json
+import queue
+import select
+from collections import OrderedDict
+
+import codec
+from ids import new_id
+from metrics import RollingHistogram
+from metrics_sink import MetricsSink
+from protocol import send_frame, recv_frame
+from search import EXACT as SEARCH_EXACT, NAME_PREFIX as SEARCH_PREFIX
 
 # Set up logging
 logging.basicConfig(level=logging.ERROR, format='%(message)s')  # Adjust to only show errors
 
-# CSV file for performance metrics
-performance_data = []
+# Performance records go to a MetricsSink (rotating CSV and binary files
+# written in the background), created on first use
+performance_sink = None
+_performance_sink_lock = threading.Lock()
+# Headless tools such as loadgen.py turn this off and use a listener instead
+record_performance_data = True
+# Callables invoked as listener(operation, start_time, end_time, latency, rtt)
+performance_listeners = []
+
+def get_performance_sink():
+    global performance_sink
+    with _performance_sink_lock:
+        if performance_sink is None:
+            performance_sink = MetricsSink()
+            atexit.register(performance_sink.close)
+        return performance_sink
 
 # Function to log performance metrics
 def log_performance(operation, start_time, end_time, latency, rtt):
-    data = {
-        'latency': latency*(1000),
-        'rtt': rtt*(1000)
-    }
-    performance_data.append(data)
-
-def send_request(request, server_ip='127.0.0.1', port=12345):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((server_ip, port))
-    
+    if record_performance_data:
+        get_performance_sink().record(operation, start_time, end_time, latency, rtt)
+    for listener in performance_listeners:
+        listener(operation, start_time, end_time, latency, rtt)
+
+# Wire codec for requests; the server answers in the same one
+CODEC = codec.BINARY
+
+# Actions that change state on the server. After a failure they are only sent
+# again when the server provably never got them, or when they carry an
+# idempotency key.
+WRITE_ACTIONS = {'process_payment', 'book_and_pay', 'save_booking'}
+
+# The request never reached the server: sending it failed, or the server had
+# already closed the connection and answered with an immediate EOF
+class ConnectionLost(ConnectionError):
+    pass
+
+# An idle connection has nothing to read, so a readable one was closed or
+# reset by the server (or is out of step with it) and must not carry a request
+def connection_closed(client_socket):
+    try:
+        readable, _, _ = select.select([client_socket], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+def resend_safe(request):
+    action = request.get('action')
+    if action == 'batch':
+        return all(resend_safe(sub_request) for sub_request in request.get('requests') or ())
+    return action not in WRITE_ACTIONS or request.get('idempotency_key') is not None
+
+# Whether a request that failed with error may be sent again on a new
+# connection: always if it never reached the server, never after a timeout
+# (the server may still be running it), otherwise only if running it twice is harmless
+def may_resend(request, error):
+    if isinstance(error, ConnectionLost):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return resend_safe(request)
+
+# One persistent connection per thread, reused for every request
+_local = threading.local()
+
+def get_connection(server_ip='127.0.0.1', port=12345):
+    client_socket = getattr(_local, 'socket', None)
+    if client_socket is None or _local.address != (server_ip, port) or connection_closed(client_socket):
+        close_connection()
+        client_socket = socket.create_connection((server_ip, port))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _local.socket = client_socket
+        _local.address = (server_ip, port)
+    return client_socket
+
+def close_connection():
+    client_socket = getattr(_local, 'socket', None)
+    if client_socket is not None:
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+    _local.socket = None
+    _local.address = None
+
+# observe, if given, is called as observe(action, latency, rtt)
+def _exchange(client_socket, request, observe=None):
     # Measure RTT
     start_time = time.time()
-    client_socket.sendall(pickle.dumps(request))
-    
+    data = codec.encode(request, CODEC)
+    try:
+        send_frame(client_socket, data)
+    except socket.timeout:
+        raise
+    except OSError as e:
+        # The server only runs complete frames, and this one was not sent in full
+        raise ConnectionLost(f"Could not send the request: {e}") from e
+
     # Measure latency
     latency_start_time = time.time()
-    response_data = receive_all(client_socket)  # Ensure full response is received
+    response_data = recv_frame(client_socket)  # Reads exactly one length-prefixed response
+    if response_data is None:
+        raise ConnectionLost("Server closed the connection")
     latency = time.time() - latency_start_time
     end_time = time.time()
-    
+
     rtt = end_time - start_time  # Total RTT includes the time to send and receive
 
     log_performance(request['action'], start_time, end_time, latency, rtt)
-    
-    client_socket.close()
-    
-    return pickle.loads(response_data)
+    if observe is not None:
+        observe(request['action'], latency, rtt)
 
-# Function to ensure full data is received before unpickling
-def receive_all(sock, buffer_size=4096):
-    data = b''
-    while True:
-        part = sock.recv(buffer_size)
-        data += part
-        if len(part) < buffer_size:
-            break
-    return data
+    response, _ = codec.decode(response_data)
+    return response
+
+# Uncached request on this thread's own connection; see BookingClient for
+# pooled connections and catalog caching
+def send_request(request, server_ip='127.0.0.1', port=12345):
+    previous = getattr(_local, 'socket', None)
+    client_socket = get_connection(server_ip, port)
+    try:
+        return _exchange(client_socket, request)
+    except (ConnectionError, OSError) as e:
+        close_connection()
+        if client_socket is not previous or not may_resend(request, e):
+            raise
+    # The server dropped the reused connection; retry once on a fresh one
+    return _exchange(get_connection(server_ip, port), request)
+
+# Persistent connections to one server, at most size of them in use at once
+class ServerConnections:
+    def __init__(self, server_ip, port, size=2, timeout=30.0):
+        self.server_ip = server_ip
+        self.port = port
+        self.timeout = timeout
+        self.down_until = 0.0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        client_socket = socket.create_connection((self.server_ip, self.port), timeout=self.timeout)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client_socket
+
+    # An idle connection the server has closed since is dropped here, before
+    # it is sent anything
+    def _checkout(self):
+        while True:
+            try:
+                client_socket = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(), False
+            if not connection_closed(client_socket):
+                return client_socket, True
+            client_socket.close()
+
+    def exchange(self, request, observe=None):
+        with self._slots:
+            client_socket, reused = self._checkout()
+            try:
+                response = _exchange(client_socket, request, observe)
+            except (ConnectionError, OSError) as e:
+                client_socket.close()
+                if not reused or not may_resend(request, e):
+                    raise
+                # The server dropped the reused connection; retry once on a fresh one
+                client_socket = self._connect()
+                try:
+                    response = _exchange(client_socket, request, observe)
+                except BaseException:
+                    client_socket.close()
+                    raise
+            except BaseException:
+                client_socket.close()
+                raise
+            self._idle.put(client_socket)
+            return response
+
+    def idle(self):
+        return self._idle.qsize()
+
+    def close(self):
+        while True:
+            try:
+                client_socket = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                client_socket.close()
+            except OSError:
+                pass
+
+def _address(server):
+    if isinstance(server, str):
+        host, _, port = server.rpartition(':')
+        return host, int(port)
+    return tuple(server)
+
+# Client library object: a small pool of persistent connections plus a cache
+# of catalog answers. A cached answer is served locally for cache_ttl seconds
+# and then revalidated against the server's catalog etag, so an unchanged
+# catalog costs a tiny not_modified reply instead of the whole result. Cached
+# results are shared, so treat them as read-only.
+#
+# replicas lists read replicas as (host, port) pairs or "host:port" strings.
+# Catalog reads then go to them in turn and everything else to the primary at
+# server_ip:port. A replica that cannot be reached is skipped for
+# replica_retry seconds, and reads it refuses as too far behind are sent to
+# the primary instead.
+class BookingClient:
+    def __init__(self, server_ip='127.0.0.1', port=12345, pool_size=2, cache_ttl=30.0, max_cached=1024,
+                 timeout=30.0, write_retries=3, busy_retries=2, replicas=(), replica_retry=5.0):
+        self.server_ip = server_ip
+        self.port = port
+        self.timeout = timeout
+        self.write_retries = write_retries
+        self.busy_retries = busy_retries
+        self.cache_ttl = cache_ttl
+        self.max_cached = max_cached
+        self.primary = ServerConnections(server_ip, port, pool_size, timeout)
+        self.replicas = [ServerConnections(*_address(replica), pool_size, timeout) for replica in replicas]
+        self.replica_retry = replica_retry
+        self._next_replica = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.revalidations = 0
+        self.shed = 0
+        self.replica_reads = 0
+        self.replica_fallbacks = 0
+        # Rolling latency and RTT over the last minute, in seconds
+        self.latency = RollingHistogram()
+        self.rtt = RollingHistogram()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _observe(self, action, latency, rtt):
+        self.latency.observe(latency)
+        self.rtt.observe(rtt)
+
+    # Send one request. A busy or rate_limited reply means the server did not
+    # run it, so it is sent again after the suggested delay, up to busy_retries
+    # times. read=True allows a replica to answer it.
+    def request(self, request, read=False):
+        for attempt in range(self.busy_retries + 1):
+            response = self._read(request) if read and self.replicas else self.primary.exchange(request, self._observe)
+            if not (isinstance(response, dict) and response.get('code') in ('busy', 'rate_limited')):
+                return response
+            self.shed += 1
+            if attempt == self.busy_retries:
+                return response
+            time.sleep(min(2.0, response.get('retry_after') or 0.1))
+
+    # Send a read to the next replica that is up, or to the primary when none
+    # is or the replica refuses it as stale
+    def _read(self, request):
+        now = time.monotonic()
+        with self._cache_lock:
+            start = self._next_replica
+            self._next_replica = (start + 1) % len(self.replicas)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.down_until > now:
+                continue
+            try:
+                response = replica.exchange(request, self._observe)
+            except (ConnectionError, OSError) as e:
+                replica.down_until = now + self.replica_retry
+                if not may_resend(request, e):
+                    raise
+                continue
+            if isinstance(response, dict) and response.get('code') == 'stale':
+                break
+            self.replica_reads += 1
+            return response
+        self.replica_fallbacks += 1
+        return self.primary.exchange(request, self._observe)
+
+    # Send a catalog request through the cache
+    def fetch(self, request):
+        key = json.dumps(request, sort_keys=True)
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and time.monotonic() - entry[2] < self.cache_ttl:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return entry[1]
+
+        response = self.request(dict(request, if_none_match=entry[0] if entry is not None else None), read=True)
+        if not (isinstance(response, dict) and 'etag' in response
+                and response.get('status') in ('success', 'not_modified')):
+            return response  # a failure, or a server without conditional requests
+
+        with self._cache_lock:
+            if response['status'] == 'not_modified':
+                self.revalidations += 1
+                result = entry[1]
+            else:
+                self.cache_misses += 1
+                result = response['result']
+            if response['etag'] is not None:
+                self._cache[key] = (response['etag'], result, time.monotonic())
+                self._cache.move_to_end(key)
+                if len(self._cache) > self.max_cached:
+                    self._cache.popitem(last=False)
+        return result
+
+    def cities(self):
+        return self.fetch({'action': 'fetch_cities'})
+
+    # transports, hotels and room_types return every row, or with any of
+    # fields, min_price, max_price, sort, limit or cursor one page:
+    # {'fields': [...], 'rows': [...], 'next_cursor': ...}. pages() follows
+    # the cursors.
+    def transports(self, origin, destination, **options):
+        return self.fetch(dict(options, action='fetch_transports', origin=origin, destination=destination))
+
+    def hotels(self, destination, check_in=None, check_out=None, **options):
+        return self.fetch(dict(options, action='fetch_hotels', destination=destination,
+                               check_in=check_in, check_out=check_out))
+
+    def room_types(self, hotel_id, check_in=None, check_out=None, **options):
+        return self.fetch(dict(options, action='fetch_room_types', hotel_id=hotel_id,
+                               check_in=check_in, check_out=check_out))
+
+    # Every row of a paged list request, fetched a page at a time
+    def pages(self, request):
+        cursor = None
+        while True:
+            response = self.fetch(dict(request, cursor=cursor, limit=request.get('limit') or 100))
+            if isinstance(response, dict) and response.get('status') == 'failure':
+                raise RuntimeError(response.get('message'))
+            yield from response['rows']
+            cursor = response['next_cursor']
+            if cursor is None:
+                return
+
+    def trip(self, origin, destination, check_in=None, check_out=None):
+        return self.fetch({'action': 'search_trip', 'origin': origin, 'destination': destination,
+                           'check_in': check_in, 'check_out': check_out})
+
+    def routes(self, origin, destination, k=3, max_legs=3, sort='cheapest'):
+        return self.fetch({'action': 'fetch_routes', 'origin': origin, 'destination': destination,
+                           'k': k, 'max_legs': max_legs, 'sort': sort})
+
+    # Cities and hotels matching a partial or misspelt name, best first, as
+    # (kind, hotel id, name, city, score) rows
+    def search(self, query, kinds=None, limit=10, city=None):
+        return self.fetch({'action': 'search', 'query': query, 'kinds': kinds, 'limit': limit, 'city': city})
+
+    def batch(self, requests):
+        return self.request({'action': 'batch', 'requests': requests})
+
+    def process_payment(self, total_amount, account_number, password):
+        return self.request({'action': 'process_payment', 'total_amount': total_amount,
+                             'account_number': account_number, 'password': password})
+
+    # Bookings carry an idempotency key, so a dropped connection is retried
+    # with the same key and the server stores the booking only once. A timeout
+    # is raised instead, since the first attempt may still be running; the
+    # caller can send it again with the same idempotency_key. The server
+    # assigns the booking ID and returns it in the result.
+    def _idempotent(self, request, idempotency_key=None):
+        request['idempotency_key'] = idempotency_key or new_id()
+        for attempt in range(self.write_retries + 1):
+            try:
+                return self.request(request)
+            except (ConnectionError, OSError) as e:
+                if attempt == self.write_retries or not may_resend(request, e):
+                    raise
+                time.sleep(min(2.0, 0.1 * 2 ** attempt))
+
+    def book_and_pay(self, booking_details, account_number, password, idempotency_key=None):
+        return self._idempotent({'action': 'book_and_pay', 'booking': booking_details,
+                                 'account_number': account_number, 'password': password}, idempotency_key)
+
+    def save_booking(self, booking_details, idempotency_key=None):
+        return self._idempotent({'action': 'save_booking', 'booking': booking_details}, idempotency_key)
+
+    def invalidate(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._cache_lock:
+            cache = {'entries': len(self._cache), 'hits': self.cache_hits,
+                     'misses': self.cache_misses, 'revalidations': self.revalidations}
+        stats = {'latency': self.latency.snapshot(), 'rtt': self.rtt.snapshot(), 'cache': cache,
+                 'idle_connections': self.primary.idle(), 'shed': self.shed}
+        if self.replicas:
+            stats['replicas'] = {'reads': self.replica_reads, 'fallbacks': self.replica_fallbacks,
+                                 'down': sum(1 for replica in self.replicas if replica.down_until > time.monotonic())}
+        return stats
+
+    def close(self):
+        self.primary.close()
+        for replica in self.replicas:
+            replica.close()
+
+# Shared client used by the interactive helpers below
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = BookingClient()
+        return _default_client
 
 def fetch_available_cities():
-    request = {'action': 'fetch_cities'}
-    cities = send_request(request)
+    cities = default_client().cities()
 
     if not cities:
         print("No available cities.")
@@ -67,9 +448,9 @@ def fetch_available_cities():
 
     return cities
 
-def fetch_destination_cities(source):
-    request = {'action': 'fetch_cities'}
-    cities = send_request(request)
+def fetch_destination_cities(source, cities=None):
+    if cities is None:
+        cities = default_client().cities()
 
     if not cities:
         print("No available cities.")
@@ -87,13 +468,52 @@ def fetch_destination_cities(source):
 
     return destination_cities
 
-def search_transport(origin, destination):
-    request = {
-        'action': 'fetch_transports',
-        'origin': origin,
-        'destination': destination
-    }
-    transport_options = send_request(request)
+# Ask for a city by name until one is picked. A name the server does not know
+# exactly gets a short list of suggestions (prefix or misspelling matches)
+# rather than the whole city list.
+def ask_city(prompt, exclude=None):
+    while True:
+        query = input(prompt).strip()
+        if not query:
+            continue
+        matches = [row for row in default_client().search(query, kinds=['city'], limit=6) if row[2] != exclude]
+        if not matches:
+            print("No matching city. Please try again.")
+            continue
+        if matches[0][4] == SEARCH_EXACT or len(matches) == 1 and matches[0][4] >= SEARCH_PREFIX:
+            return matches[0][2]
+        print("\nDid you mean:")
+        for index, row in enumerate(matches):
+            print(f"{index + 1}. {row[2]}")
+        choice = input("Enter a number, or press Enter to search again: ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(matches):
+            return matches[int(choice) - 1][2]
+
+# Fetch transports, hotels and every hotel's room types in one round trip
+def fetch_trip(origin, destination, check_in=None, check_out=None):
+    return default_client().trip(origin, destination, check_in, check_out)
+
+# Ask for the check-in date and length of stay; returns ISO check-in and check-out dates and the nights
+def ask_stay_dates():
+    while True:
+        try:
+            check_in = datetime.date.fromisoformat(input("\nEnter the check-in date (YYYY-MM-DD): ").strip())
+            nights = int(input("Enter the number of nights: "))
+            if nights < 1:
+                print("Please stay at least one night.")
+                continue
+            check_out = check_in + datetime.timedelta(days=nights)
+            return check_in.isoformat(), check_out.isoformat(), nights
+        except ValueError:
+            print("Invalid input. Please enter a date as YYYY-MM-DD and a whole number of nights.")
+
+# Send several requests in one round trip; results come back in the same order
+def send_batch(requests):
+    return default_client().batch(requests)
+
+def search_transport(origin, destination, transport_options=None):
+    if transport_options is None:
+        transport_options = default_client().transports(origin, destination)
 
     if not transport_options:
         print("No available transport options.")
@@ -113,12 +533,9 @@ def search_transport(origin, destination):
         except ValueError:
             print("Invalid input. Please enter a number.")
 
-def select_hotel(destination):
-    request = {
-        'action': 'fetch_hotels',
-        'destination': destination
-    }
-    hotel_options = send_request(request)
+def select_hotel(destination, hotel_options=None, room_types_by_hotel=None):
+    if hotel_options is None:
+        hotel_options = default_client().hotels(destination)
 
     if not hotel_options:
         print("No available hotels.")
@@ -132,18 +549,16 @@ def select_hotel(destination):
 
     if 0 <= hotel_choice < len(hotel_options):
         selected_hotel = hotel_options[hotel_choice]
-        room_types = select_room_type(selected_hotel[0])  # Fetch room types based on selected hotel ID
+        prefetched = room_types_by_hotel[hotel_choice] if room_types_by_hotel is not None else None
+        room_types = select_room_type(selected_hotel[0], prefetched)  # Fetch room types based on selected hotel ID
         return selected_hotel, room_types
     else:
         print("Invalid choice. Please select a valid option.")
     return None, None
 
-def select_room_type(hotel_id):
-    request = {
-        'action': 'fetch_room_types',
-        'hotel_id': hotel_id
-    }
-    room_types = send_request(request)
+def select_room_type(hotel_id, room_types=None):
+    if room_types is None:
+        room_types = default_client().room_types(hotel_id)
 
     if not room_types:
         print("No available room types.")
@@ -151,7 +566,9 @@ def select_room_type(hotel_id):
 
     print("\nAvailable Room Types:")
     for index, room in enumerate(room_types):
-        print(f"{index + 1}. {room[2]}, Cost: ${room[3]}")  # room[2] for room type, room[3] for cost
+        # room[2] for room type, room[3] for cost, room[5] for rooms left when dates were given
+        rooms_left = f" ({room[5]} left)" if len(room) > 5 and room[5] is not None else ""
+        print(f"{index + 1}. {room[2]}, Cost: ${room[3]} per night{rooms_left}")
 
     while True:
         try:
@@ -163,123 +580,90 @@ def select_room_type(hotel_id):
         except ValueError:
             print("Invalid input. Please enter a number.")
 
-def process_payment(total_amount):
+def collect_bank_credentials():
     account_number = input("\nEnter your bank account number: ")
     password = getpass.getpass("Enter your bank password: ")
+    return account_number, password
 
-    payment_request = {
-        'action': 'process_payment',
-        'total_amount': total_amount,
-        'account_number': account_number,
-        'password': password
-    }
-
-    result = send_request(payment_request)
-
-    return result
+def process_payment(total_amount):
+    account_number, password = collect_bank_credentials()
+    return default_client().process_payment(total_amount, account_number, password)
 
-import os
+# Charge the account and store the booking atomically: the server either
+# does both or neither
+def book_and_pay(booking_details):
+    account_number, password = collect_bank_credentials()
+    return default_client().book_and_pay(booking_details, account_number, password)
 
+# Write out any buffered performance records and close the metrics files
 def save_performance_data():
-    try:
-        file_exists = os.path.isfile('performance_metrics.csv')  # Check if file exists
-
-        # Open the CSV file in append mode
-        with open('performance_metrics.csv', 'a', newline='') as csvfile:
-            fieldnames = ['latency', 'rtt']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            # Write the header only if the file is new or empty
-            if not file_exists:  # Write header only if file does not already exist
-                writer.writeheader()
-
-            # Write the performance data to the file
-            for data in performance_data:
-                writer.writerow(data)
-
-    except Exception as e:
-        logging.error(f"Error saving performance data: {e}")
+    if performance_sink is not None:
+        performance_sink.close()
 
 
 if __name__ == "__main__":
     print("Welcome to the Hotel Booking Application!")
 
-    available_cities = fetch_available_cities()
-    if not available_cities:
-        print("No cities available. Exiting...")
-        exit(1)
-
-    origin = input("\nEnter the origin city: ").strip()
-    
-    if origin not in available_cities:
-        print("Invalid origin city. Please restart the application and select a valid city.")
-        exit(1)
+    origin = ask_city("\nEnter the origin city: ")
 
     same_city_hotel = input("\nDo you want to book a hotel in the same city? (yes/no): ").strip().lower()
     destination = origin 
     if same_city_hotel in ['yes', 'y']:
         destination = origin
     else:
-        destination_cities = fetch_destination_cities(origin)
-        if not destination_cities:
-            print("No valid destination cities available.")
-            exit(1)
-        destination = input("\nEnter the destination city: ").strip()
-        if destination not in destination_cities:
-            print("Invalid destination. Please restart the application and select a valid city.")
-            exit(1)
+        destination = ask_city("\nEnter the destination city: ", exclude=origin)
+
+    check_in, check_out, nights = ask_stay_dates()
 
-    hotel, room_type = select_hotel(destination)
+    # Prefetch the whole trip so the selections below need no further round trips
+    trip = fetch_trip(origin, destination, check_in, check_out)
+    hotel, room_type = select_hotel(destination, trip['hotels'], trip['room_types'])
+    if not room_type:
+        print("No rooms available for those dates. Please restart the application and try other dates.")
+        exit(1)
 
     transport = None
     if destination != origin:
         transport_booking = input("\nWould you like to book transport as well? (yes/no): ").strip().lower()
         if transport_booking in ['yes', 'y']:
-            transport = search_transport(origin, destination)
+            transport = search_transport(origin, destination, trip['transports'])
     
     # Calculate total amount
     transport_cost = transport[2] if transport else 0
-    hotel_cost = room_type[3]  # Only room type cost
+    hotel_cost = room_type[3] * nights  # Room cost per night
     total_amount = transport_cost + hotel_cost
 
-    # Process payment
-    payment_result = process_payment(total_amount)
+    # Prepare booking details; the server assigns the booking ID
+    booking_details = {
+        'transport_type': transport[1] if transport else None,
+        'origin': origin,
+        'destination': destination,
+        'transport_cost': transport_cost,
+        'hotel_name': hotel[1] if hotel else None,
+        'room_type': room_type[2],
+        'hotel_cost': hotel_cost,
+        'total_amount': total_amount,
+        'room_type_id': room_type[0],
+        'check_in': check_in,
+        'check_out': check_out
+    }
 
-    if payment_result and payment_result['status'] == 'success':
-        print("\nPayment Successful!")
+    # Pay and save the booking in one server-side transaction
+    result = book_and_pay(booking_details)
 
-        # Prepare booking details
-        booking_id = f"BOOK-{random.randint(1000, 9999)}"
-        booking_details = {
-            'booking_id': booking_id,
-            'transport_type': transport[1] if transport else None,
-            'origin': origin,
-            'destination': destination,
-            'transport_cost': transport_cost,
-            'hotel_name': hotel[1] if hotel else None,
-            'room_type': room_type[2],
-            'hotel_cost': hotel_cost,
-            'total_amount': total_amount
-        }
-        
-        # Save booking
-        save_request = {
-            'action': 'save_booking',
-            'booking': booking_details
-        }
-        save_result = send_request(save_request)
+    if result and result['status'] == 'success':
+        print("\nPayment Successful!")
 
         # Print booking details
-        if save_result['status'] == 'success':
-            print("\nBooking Details:")
-            print(f"  Booking ID: {booking_id}")
-            print(f"  Total Amount: ${total_amount}")
-        else:
-            print("\nFailed to save booking.")
+        print("\nBooking Details:")
+        print(f"  Booking ID: {result['booking_id']}")
+        print(f"  Total Amount: ${total_amount}")
     else:
-        print(f"Payment Failed: {payment_result.get('message', 'Unknown error')}")
+        print(f"Payment Failed: {result.get('message', 'Unknown error')}")
 
     print("\nThank you for using the Hotel Booking Application!")
 
+    default_client().close()
+
     # Save performance data at the end
     save_performance_data()
@@ -0,0 +1,316 @@
+import io
+import json
+import pickle
+import struct
+
+# The first byte of every frame payload names the codec it was written with,
+# and the server always answers in the codec the request used. A pickled
+# payload is recognised by the pickle PROTO opcode (0x80). Only framed
+# requests are understood (see protocol.py): clients from before framing,
+# which send a bare pickle, are not supported.
+BINARY = 0x01
+JSON = 0x02
+PICKLE = 0x80
+
+CODEC_NAMES = {BINARY: 'binary', JSON: 'json', PICKLE: 'pickle'}
+
+# Set to False to refuse pickled requests outright
+ALLOW_PICKLE = True
+
+
+class CodecError(ValueError):
+    pass
+
+
+# Pickles from the network may only contain plain data; importing any global
+# (and therefore calling any constructor) is refused, which closes the
+# arbitrary-code-execution hole while clients that frame pickles keep working
+class _DataOnlyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Refusing to load global {module}.{name}")
+
+
+def _loads_pickle(payload):
+    return _DataOnlyUnpickler(io.BytesIO(payload)).load()
+
+
+# Binary codec, version 1. Every value is a one-byte tag followed by its body.
+# Strings that appear in almost every message (action names, dict keys,
+# statuses) are sent as a one-byte reference into SYMBOLS, and a list of
+# equally sized tuples (a query result) is sent as a single ROWS block with
+# the column count stated once. SYMBOLS is part of the version 1 format and
+# must never be reordered; new entries require a new codec byte.
+SYMBOLS = (
+    'action', 'status', 'message', 'success', 'failure',
+    'fetch_cities', 'fetch_transports', 'fetch_hotels', 'fetch_room_types',
+    'process_payment', 'save_booking',
+    'origin', 'destination', 'hotel_id', 'booking', 'booking_id',
+    'transport_type', 'transport_cost', 'hotel_name', 'room_type', 'hotel_cost', 'total_amount',
+    'account_number', 'password',
+    'San Francisco', 'Los Angeles', 'Chicago', 'New York',
+    'Bus', 'Train', 'Flight', 'Single Room', 'Double Room', 'Suite', 'Delux Suite',
+)
+_SYMBOL_IDS = {symbol: index for index, symbol in enumerate(SYMBOLS)}
+
+T_NONE = 0
+T_TRUE = 1
+T_FALSE = 2
+T_UINT8 = 3
+T_INT64 = 4
+T_FLOAT = 5
+T_STR = 6
+T_SYMBOL = 7
+T_BYTES = 8
+T_LIST = 9
+T_TUPLE = 10
+T_DICT = 11
+T_ROWS = 12
+
+_INT64 = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+_UINT32 = struct.Struct('<I')
+
+
+def _write_size(out, size):
+    if size < 0xFF:
+        out.append(size)
+    else:
+        out.append(0xFF)
+        out += _UINT32.pack(size)
+
+
+def _is_rows(value):
+    first = value[0]
+    if type(first) is not tuple or not first:
+        return False
+    width = len(first)
+    for row in value:
+        if type(row) is not tuple or len(row) != width:
+            return False
+    return True
+
+
+# ROWS blocks are stored column by column. Columns holding only ints, only
+# floats or only strings are packed with a single struct/join call, which is
+# what keeps large result sets close to C speed; anything else falls back to
+# one tagged value per cell.
+C_ANY = 0
+C_INT64 = 1
+C_FLOAT = 2
+C_STR = 3
+C_UINT8 = 4
+C_INT32 = 5
+
+# Below this many rows the per-cell encoding is smaller (symbols, small ints)
+PACKED_COLUMN_MIN_ROWS = 16
+
+_INT_COLUMN_FORMATS = {C_UINT8: ('B', 1), C_INT32: ('i', 4), C_INT64: ('q', 8)}
+
+
+def _encode_column(column, out):
+    kinds = set(map(type, column)) if len(column) >= PACKED_COLUMN_MIN_ROWS else ()
+    if len(kinds) == 1:
+        kind = kinds.pop()
+        if kind is int:
+            low, high = min(column), max(column)
+            if low >= 0 and high < 256:
+                column_kind = C_UINT8
+            elif low >= -2 ** 31 and high < 2 ** 31:
+                column_kind = C_INT32
+            elif low >= -2 ** 63 and high < 2 ** 63:
+                column_kind = C_INT64
+            else:
+                column_kind = C_ANY
+            if column_kind != C_ANY:
+                out.append(column_kind)
+                out += struct.pack(f'<{len(column)}{_INT_COLUMN_FORMATS[column_kind][0]}', *column)
+                return
+        elif kind is float:
+            out.append(C_FLOAT)
+            out += struct.pack(f'<{len(column)}d', *column)
+            return
+        elif kind is str:
+            joined = '\x00'.join(column)
+            if joined.count('\x00') == len(column) - 1:
+                data = joined.encode('utf-8')
+                out.append(C_STR)
+                out += _UINT32.pack(len(data))
+                out += data
+                return
+    out.append(C_ANY)
+    for item in column:
+        _encode_value(item, out)
+
+
+def _decode_column(data, pos, count):
+    kind = data[pos]
+    pos += 1
+    if kind in _INT_COLUMN_FORMATS:
+        code, width = _INT_COLUMN_FORMATS[kind]
+        return struct.unpack_from(f'<{count}{code}', data, pos), pos + width * count
+    if kind == C_FLOAT:
+        return struct.unpack_from(f'<{count}d', data, pos), pos + 8 * count
+    if kind == C_STR:
+        size = _UINT32.unpack_from(data, pos)[0]
+        pos += 4
+        column = str(data[pos:pos + size], 'utf-8').split('\x00')
+        if len(column) != count:
+            raise CodecError("String column length does not match row count")
+        return column, pos + size
+    if kind == C_ANY:
+        column = []
+        for _ in range(count):
+            item, pos = _decode_value(data, pos)
+            column.append(item)
+        return column, pos
+    raise CodecError(f"Unknown column kind {kind}")
+
+
+def _encode_value(value, out):
+    kind = type(value)
+    if value is None:
+        out.append(T_NONE)
+    elif kind is str:
+        symbol = _SYMBOL_IDS.get(value)
+        if symbol is not None:
+            out.append(T_SYMBOL)
+            out.append(symbol)
+        else:
+            data = value.encode('utf-8')
+            out.append(T_STR)
+            _write_size(out, len(data))
+            out += data
+    elif kind is bool:
+        out.append(T_TRUE if value else T_FALSE)
+    elif kind is int:
+        if 0 <= value < 256:
+            out.append(T_UINT8)
+            out.append(value)
+        else:
+            out.append(T_INT64)
+            try:
+                out += _INT64.pack(value)
+            except struct.error:
+                raise CodecError(f"Integer {value} does not fit in 64 bits")
+    elif kind is float:
+        out.append(T_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif kind is dict:
+        out.append(T_DICT)
+        _write_size(out, len(value))
+        for key, item in value.items():
+            _encode_value(key, out)
+            _encode_value(item, out)
+    elif kind is list and value and _is_rows(value):
+        out.append(T_ROWS)
+        _write_size(out, len(value))
+        _write_size(out, len(value[0]))
+        for column in zip(*value):
+            _encode_column(column, out)
+    elif kind is list or kind is tuple:
+        out.append(T_LIST if kind is list else T_TUPLE)
+        _write_size(out, len(value))
+        for item in value:
+            _encode_value(item, out)
+    elif kind is bytes:
+        out.append(T_BYTES)
+        _write_size(out, len(value))
+        out += value
+    else:
+        raise CodecError(f"Cannot encode values of type {kind.__name__}")
+
+
+def _read_size(data, pos):
+    size = data[pos]
+    if size < 0xFF:
+        return size, pos + 1
+    return _UINT32.unpack_from(data, pos + 1)[0], pos + 5
+
+
+def _decode_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == T_SYMBOL:
+        return SYMBOLS[data[pos]], pos + 1
+    if tag == T_STR:
+        size, pos = _read_size(data, pos)
+        return str(data[pos:pos + size], 'utf-8'), pos + size
+    if tag == T_UINT8:
+        return data[pos], pos + 1
+    if tag == T_FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_DICT:
+        size, pos = _read_size(data, pos)
+        result = {}
+        for _ in range(size):
+            key, pos = _decode_value(data, pos)
+            result[key], pos = _decode_value(data, pos)
+        return result, pos
+    if tag == T_ROWS:
+        count, pos = _read_size(data, pos)
+        width, pos = _read_size(data, pos)
+        columns = []
+        for _ in range(width):
+            column, pos = _decode_column(data, pos, count)
+            columns.append(column)
+        return list(zip(*columns)), pos
+    if tag == T_LIST or tag == T_TUPLE:
+        size, pos = _read_size(data, pos)
+        items = []
+        for _ in range(size):
+            item, pos = _decode_value(data, pos)
+            items.append(item)
+        return (items if tag == T_LIST else tuple(items)), pos
+    if tag == T_INT64:
+        return _INT64.unpack_from(data, pos)[0], pos + 8
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_BYTES:
+        size, pos = _read_size(data, pos)
+        return bytes(data[pos:pos + size]), pos + size
+    raise CodecError(f"Unknown binary tag {tag}")
+
+
+def encode(obj, codec=BINARY):
+    if codec == BINARY:
+        out = bytearray((BINARY,))
+        _encode_value(obj, out)
+        return bytes(out)
+    if codec == JSON:
+        try:
+            return bytes((JSON,)) + json.dumps(obj, separators=(',', ':'), allow_nan=False).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            raise CodecError(str(e))
+    if codec == PICKLE:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    raise CodecError(f"Unknown codec {codec}")
+
+
+# Returns the decoded object and the codec it was written with
+def decode(payload):
+    if not payload:
+        raise CodecError("Empty payload")
+    codec = payload[0]
+    try:
+        if codec == BINARY:
+            obj, pos = _decode_value(payload, 1)
+            if pos != len(payload):
+                raise CodecError("Trailing bytes after binary message")
+            return obj, codec
+        if codec == JSON:
+            return json.loads(payload[1:].decode('utf-8')), codec
+        if codec == PICKLE:
+            if not ALLOW_PICKLE:
+                raise CodecError("Pickled messages are not accepted")
+            return _loads_pickle(payload), codec
+    except CodecError:
+        raise
+    except (IndexError, struct.error, UnicodeDecodeError, ValueError, pickle.UnpicklingError, EOFError) as e:
+        raise CodecError(f"Malformed {CODEC_NAMES[codec]} message: {e}")
+    except RecursionError:
+        raise CodecError(f"Malformed {CODEC_NAMES[codec]} message: nested too deeply")
+    raise CodecError(f"Unknown codec byte {codec:#04x}")
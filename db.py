@@ -0,0 +1,164 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = 'hotel_booking.db'
+
+# Applied to every pooled connection when it is opened
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",          # readers never block on the booking writer
+    "PRAGMA synchronous=NORMAL",        # fsync on checkpoint instead of every commit (safe with WAL)
+    "PRAGMA cache_size=-16000",         # 16 MB page cache per connection
+    "PRAGMA mmap_size=268435456",       # map up to 256 MB of the database file
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, max_size=16, timeout=30.0, busy_timeout=5.0, statement_cache_size=256):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.statement_cache_size = statement_cache_size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = 0
+        self._hits = 0
+        self._misses = 0
+        self._waits = 0
+        self._closed = False
+
+    def _connect(self):
+        # Autocommit mode: transactions are opened explicitly by transaction().
+        # sqlite3 keeps up to statement_cache_size compiled statements per
+        # connection, so long-lived connections reuse their prepared statements.
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False,
+                               isolation_level=None, cached_statements=self.statement_cache_size)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._open < self.max_size
+            if can_open:
+                self._open += 1
+                self._misses += 1
+            else:
+                self._waits += 1
+        if can_open:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._open -= 1
+        else:
+            self._idle.put(conn)
+
+    # Nested use on the same thread shares the connection already checked out
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        conn = self.acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        with self.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+            # IMMEDIATE takes the write lock up front so two writers never deadlock upgrading
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'max_size': self.max_size,
+                'open': self._open,
+                'idle': self._idle.qsize(),
+                'in_use': self._open - self._idle.qsize(),
+                'hits': self._hits,
+                'misses': self._misses,
+                'waits': self._waits,
+            }
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._open -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+# Replace the shared pool, e.g. to point the server at another database file
+def configure_pool(path=DB_PATH, **options):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(path, **options)
+    return _pool
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Crockford base32, as used by ULIDs: no I, L, O or U
+CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+RANDOM_BITS = 80
+
+
+# ULIDs: a 48-bit millisecond timestamp followed by 80 random bits, written
+# as 26 base32 characters, so IDs sort in creation order and need no
+# coordination between processes. Within one millisecond the random part is
+# incremented instead of redrawn, keeping one generator's IDs strictly
+# increasing.
+class ULIDGenerator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_random = 0
+
+    def new(self):
+        with self._lock:
+            ms = time.time_ns() // 1_000_000
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                random_part = self._last_random + 1
+                if random_part >> RANDOM_BITS:
+                    ms += 1
+                    random_part = int.from_bytes(os.urandom(RANDOM_BITS // 8), 'big')
+            else:
+                random_part = int.from_bytes(os.urandom(RANDOM_BITS // 8), 'big')
+            self._last_ms = ms
+            self._last_random = random_part
+        value = (ms << RANDOM_BITS) | random_part
+        return ''.join(CROCKFORD[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+_generator = ULIDGenerator()
+
+
+def new_id():
+    return _generator.new()
+
+
+# Creation time (Unix seconds) of a ULID, or None for anything else, such as
+# booking IDs chosen by older clients
+def ulid_time(value):
+    if not isinstance(value, str) or len(value) != 26:
+        return None
+    ms = 0
+    for char in value[:10]:
+        digit = CROCKFORD.find(char.upper())
+        if digit < 0:
+            return None
+        ms = ms * 32 + digit
+    return ms / 1000
+
+
+# Idempotency key as stored and looked up: the client's key hashed together
+# with what it is scoped to, so a key replayed by another account, or with
+# another booking, names a new request instead of returning an earlier answer
+def scoped_key(key, *scope):
+    if key is None:
+        return None
+    return hashlib.blake2b(repr((key,) + scope).encode(), digest_size=16).hexdigest()
+
+
+# Bounded LRU map from idempotency key to the result already returned for it,
+# so retries are answered without touching the database. The database stays
+# the authority: an evicted key is still found there.
+class RecentResults:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            if len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._results), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,310 @@
+import argparse
+import csv
+import datetime
+import json
+import random
+import threading
+import time
+
+import client
+from ids import new_id
+
+# Headless load generator: N virtual users replay booking flows against the
+# server through client.send_request, and every request is timed through the
+# client's log_performance listeners.
+
+DEFAULT_MIX = 'book=1,browse=2,search=4,cities=3'
+
+BANK_ACCOUNTS = [('12345', 'pass'), ('54321', 'pass')]
+
+
+def is_failure(response):
+    return isinstance(response, dict) and response.get('status') == 'failure'
+
+
+# Flows. Each one is a realistic sequence of requests and returns the number
+# of requests that came back as failures.
+
+def flow_cities(send, rng, catalog):
+    return int(is_failure(send({'action': 'fetch_cities'})))
+
+
+def flow_search(send, rng, catalog):
+    origin, destination = rng.sample(catalog['cities'], 2)
+    trip = send({'action': 'search_trip', 'origin': origin, 'destination': destination})
+    return int(is_failure(trip))
+
+
+# The pre-batching interactive flow: one request per selection
+def flow_browse(send, rng, catalog):
+    origin, destination = rng.sample(catalog['cities'], 2)
+    failures = int(is_failure(send({'action': 'fetch_cities'})))
+    hotels = send({'action': 'fetch_hotels', 'destination': destination})
+    failures += int(is_failure(hotels))
+    if hotels and not is_failure(hotels):
+        hotel = rng.choice(hotels)
+        failures += int(is_failure(send({'action': 'fetch_room_types', 'hotel_id': hotel[0]})))
+    transports = send({'action': 'fetch_transports', 'origin': origin, 'destination': destination})
+    return failures + int(is_failure(transports))
+
+
+# A stay of 1-5 nights starting within the next year
+def random_stay(rng):
+    check_in = datetime.date.today() + datetime.timedelta(days=rng.randrange(365))
+    nights = rng.randint(1, 5)
+    return check_in.isoformat(), (check_in + datetime.timedelta(days=nights)).isoformat(), nights
+
+
+# The current interactive flow: cities, one search_trip, then book_and_pay
+def flow_book(send, rng, catalog):
+    origin, destination = rng.sample(catalog['cities'], 2)
+    check_in, check_out, nights = random_stay(rng)
+    failures = int(is_failure(send({'action': 'fetch_cities'})))
+    trip = send({'action': 'search_trip', 'origin': origin, 'destination': destination,
+                 'check_in': check_in, 'check_out': check_out})
+    if is_failure(trip) or not trip['hotels']:
+        return failures + 1
+    index = rng.randrange(len(trip['hotels']))
+    hotel = trip['hotels'][index]
+    room_type = rng.choice(trip['room_types'][index])
+    transport = rng.choice(trip['transports']) if trip['transports'] else None
+    transport_cost = transport[2] if transport else 0
+    account_number, password = rng.choice(BANK_ACCOUNTS)
+    booking = {
+        'transport_type': transport[1] if transport else None,
+        'origin': origin,
+        'destination': destination,
+        'transport_cost': transport_cost,
+        'hotel_name': hotel[1],
+        'room_type': room_type[2],
+        'hotel_cost': room_type[3] * nights,
+        'total_amount': transport_cost + room_type[3] * nights,
+        'room_type_id': room_type[0],
+        'check_in': check_in,
+        'check_out': check_out,
+    }
+    # Not drawn from rng: runs repeated with the same --seed must not be deduplicated
+    result = send({'action': 'book_and_pay', 'booking': booking, 'idempotency_key': new_id(),
+                   'account_number': account_number, 'password': password})
+    return failures + int(is_failure(result))
+
+
+FLOWS = {
+    'cities': flow_cities,
+    'search': flow_search,
+    'browse': flow_browse,
+    'book': flow_book,
+}
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in FLOWS:
+            raise ValueError(f"Unknown flow {name!r}; choose from {', '.join(FLOWS)}")
+        mix[name] = float(weight) if weight else 1.0
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError("The flow mix needs at least one positive weight")
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5 - 1e-9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, operation, start_time, end_time, latency, rtt):
+        self.latencies.setdefault(operation, []).append(rtt * 1000)
+
+    def error(self, name, count=1):
+        self.errors[name] = self.errors.get(name, 0) + count
+
+
+class LoadGenerator:
+    def __init__(self, users=10, duration=10.0, mix=DEFAULT_MIX, rate=None, think_time=0.0,
+                 server_ip='127.0.0.1', port=12345, seed=None):
+        self.users = users
+        self.duration = duration
+        self.mix = parse_mix(mix) if isinstance(mix, str) else dict(mix)
+        self.rate = rate
+        self.think_time = think_time
+        self.server_ip = server_ip
+        self.port = port
+        self.seed = seed
+        self._local = threading.local()
+        self._recorders = []
+        self._recorders_lock = threading.Lock()
+
+    def _listener(self, operation, start_time, end_time, latency, rtt):
+        recorder = getattr(self._local, 'recorder', None)
+        if recorder is not None:
+            recorder.record(operation, start_time, end_time, latency, rtt)
+
+    def _virtual_user(self, user_id, catalog, deadline):
+        recorder = Recorder()
+
+        def send(request):
+            response = client.send_request(request, self.server_ip, self.port)
+            if is_failure(response):
+                recorder.error(request['action'])
+            return response
+
+        self._local.recorder = recorder
+        with self._recorders_lock:
+            self._recorders.append(recorder)
+        rng = random.Random(None if self.seed is None else self.seed + user_id)
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        # Fixed-rate pacing: each user owns an equal share of the target rate and
+        # its flows are due on a fixed schedule. A user runs one flow at a time,
+        # so a slow flow makes the following ones start late; to keep those
+        # stalls in the results, flows are timed from when they were due, not
+        # from when they were sent, and a late user runs its overdue flows
+        # back to back until it has caught up
+        interval = self.users / self.rate if self.rate else None
+        next_start = time.monotonic() + (rng.random() * interval if interval else 0)
+
+        try:
+            while True:
+                if interval:
+                    flow_start = next_start
+                    next_start += interval
+                    if flow_start >= deadline:
+                        break
+                    delay = flow_start - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    flow_start = time.monotonic()
+                    if flow_start >= deadline:
+                        break
+                name = rng.choices(names, weights)[0]
+                try:
+                    failures = FLOWS[name](send, rng, catalog)
+                except (ConnectionError, OSError):
+                    failures = 1
+                    client.close_connection()
+                flow_end = time.monotonic()
+                recorder.record(f'flow:{name}', flow_start, flow_end, 0, flow_end - flow_start)
+                if failures:
+                    recorder.error(f'flow:{name}', failures)
+                if not interval and self.think_time:
+                    time.sleep(rng.expovariate(1 / self.think_time))
+        finally:
+            client.close_connection()
+
+    def run(self):
+        previous_record = client.record_performance_data
+        client.record_performance_data = False
+        client.performance_listeners.append(self._listener)
+        try:
+            catalog = {'cities': client.send_request({'action': 'fetch_cities'}, self.server_ip, self.port)}
+            client.close_connection()
+            if len(catalog['cities']) < 2:
+                raise RuntimeError("The server needs at least two cities to generate trips")
+
+            started = time.monotonic()
+            deadline = started + self.duration
+            threads = [threading.Thread(target=self._virtual_user, args=(i, catalog, deadline), daemon=True)
+                       for i in range(self.users)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+        finally:
+            client.performance_listeners.remove(self._listener)
+            client.record_performance_data = previous_record
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        latencies = {}
+        errors = {}
+        for recorder in self._recorders:
+            for name, values in recorder.latencies.items():
+                latencies.setdefault(name, []).extend(values)
+            for name, count in recorder.errors.items():
+                errors[name] = errors.get(name, 0) + count
+
+        rows = []
+        for name in sorted(latencies):
+            values = sorted(latencies[name])
+            rows.append({
+                'action': name,
+                'count': len(values),
+                'errors': errors.get(name, 0),
+                'throughput': len(values) / elapsed if elapsed else 0.0,
+                'mean_ms': sum(values) / len(values),
+                'p50_ms': percentile(values, 0.50),
+                'p95_ms': percentile(values, 0.95),
+                'p99_ms': percentile(values, 0.99),
+                'max_ms': values[-1],
+            })
+        requests = sum(row['count'] for row in rows if not row['action'].startswith('flow:'))
+        return {
+            'config': {
+                'users': self.users, 'duration': self.duration, 'mix': self.mix, 'rate': self.rate,
+                'think_time': self.think_time, 'server': f'{self.server_ip}:{self.port}', 'seed': self.seed,
+            },
+            'elapsed': elapsed,
+            'requests': requests,
+            'throughput': requests / elapsed if elapsed else 0.0,
+            'actions': rows,
+        }
+
+
+REPORT_FIELDS = ['label', 'action', 'count', 'errors', 'throughput', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+
+def write_csv(report, path, label=''):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for row in report['actions']:
+            writer.writerow(dict(row, label=label))
+
+
+def write_json(report, path, label=''):
+    with open(path, 'w') as jsonfile:
+        json.dump(dict(report, label=label), jsonfile, indent=2)
+
+
+def print_report(report):
+    print(f"{report['requests']} requests in {report['elapsed']:.1f}s ({report['throughput']:.1f} req/s)")
+    print(f"{'Action':<24} {'Count':>8} {'Errors':>7} {'Req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for row in report['actions']:
+        print(f"{row['action']:<24} {row['count']:>8} {row['errors']:>7} {row['throughput']:>9.1f} "
+              f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay booking flows against the server with concurrent virtual users")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--users', type=int, default=10, help="concurrent virtual users")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"weighted flows, e.g. {DEFAULT_MIX}")
+    parser.add_argument('--rate', type=float, help="fixed-rate pacing: flows per second across all users, "
+                                                   "each timed from when it was due (default: closed loop)")
+    parser.add_argument('--think-time', type=float, default=0.0, help="closed loop: mean pause between flows in seconds")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--label', default='', help="tag stored with the results, e.g. the server mode")
+    parser.add_argument('--csv', default='loadgen_report.csv')
+    parser.add_argument('--json', default='loadgen_report.json')
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.users, args.duration, args.mix, args.rate, args.think_time,
+                              args.host, args.port, args.seed)
+    report = generator.run()
+    print_report(report)
+    write_csv(report, args.csv, args.label)
+    write_json(report, args.json, args.label)
@@ -0,0 +1,321 @@
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+
+# Latency bucket upper bounds in seconds, Prometheus style (cumulative, +Inf implied)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Upper bound of the bucket holding the requested quantile
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target and bucket_count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    # The last bucket has no upper bound, written as None so the snapshot
+    # stays plain data in every codec (JSON has no infinity)
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': list(zip(self.bounds + (None,), self.counts)),
+        }
+
+
+# Histogram of roughly the last `window` seconds, kept as `slots` per-interval
+# histograms that are recycled as time moves on, so memory stays constant
+class RollingHistogram:
+    def __init__(self, window=60.0, slots=6, bounds=LATENCY_BUCKETS):
+        self.window = window
+        self.slots = slots
+        self.bounds = bounds
+        self._interval = window / slots
+        self._histograms = [Histogram(bounds) for _ in range(slots)]
+        self._epochs = [None] * slots
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        epoch = int(time.monotonic() // self._interval)
+        index = epoch % self.slots
+        with self._lock:
+            if self._epochs[index] != epoch:
+                self._histograms[index] = Histogram(self.bounds)
+                self._epochs[index] = epoch
+            self._histograms[index].observe(value)
+
+    def snapshot(self):
+        oldest = int(time.monotonic() // self._interval) - self.slots + 1
+        merged = Histogram(self.bounds)
+        with self._lock:
+            for epoch, histogram in zip(self._epochs, self._histograms):
+                if epoch is None or epoch < oldest:
+                    continue
+                for index, count in enumerate(histogram.counts):
+                    merged.counts[index] += count
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.max = max(merged.max, histogram.max)
+        snapshot = merged.snapshot()
+        snapshot['window'] = self.window
+        return snapshot
+
+
+class ActionMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.handler_seconds = 0.0
+        self.codec_seconds = 0.0
+        self.latency = Histogram()
+
+
+class ServerMetrics:
+    # The server records known actions by name and anything else as
+    # 'unknown'; as a backstop only the first max_actions distinct names get
+    # their own series and the rest are counted under 'other'
+    def __init__(self, max_actions=64):
+        self.max_actions = max_actions
+        self._lock = threading.Lock()
+        self._actions = {}
+        self.started_at = time.time()
+        self.connections_total = 0
+        self.connections_in_flight = 0
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections_total += 1
+            self.connections_in_flight += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections_in_flight -= 1
+
+    # handler_seconds is time spent running the action (database and cache
+    # work); codec_seconds is time spent decoding the request and encoding the reply
+    def record(self, action, bytes_in, bytes_out, handler_seconds, codec_seconds, error):
+        with self._lock:
+            metrics = self._actions.get(action)
+            if metrics is None:
+                if len(self._actions) >= self.max_actions:
+                    action = 'other'
+                metrics = self._actions.get(action)
+                if metrics is None:
+                    metrics = self._actions[action] = ActionMetrics()
+            metrics.requests += 1
+            metrics.errors += int(error)
+            metrics.bytes_in += bytes_in
+            metrics.bytes_out += bytes_out
+            metrics.handler_seconds += handler_seconds
+            metrics.codec_seconds += codec_seconds
+            metrics.latency.observe(handler_seconds + codec_seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime': time.time() - self.started_at,
+                'connections_total': self.connections_total,
+                'connections_in_flight': self.connections_in_flight,
+                'actions': {
+                    action: {
+                        'requests': metrics.requests,
+                        'errors': metrics.errors,
+                        'bytes_in': metrics.bytes_in,
+                        'bytes_out': metrics.bytes_out,
+                        'handler_seconds': metrics.handler_seconds,
+                        'codec_seconds': metrics.codec_seconds,
+                        'latency': metrics.latency.snapshot(),
+                    }
+                    for action, metrics in self._actions.items()
+                },
+            }
+
+
+# Combine ServerMetrics snapshots from several processes into one: counters
+# and histogram buckets add up, and quantiles are recomputed from the merged buckets
+def merge_snapshots(snapshots):
+    merged = {'uptime': 0.0, 'connections_total': 0, 'connections_in_flight': 0, 'actions': {}}
+    latencies = {}
+    for snapshot in snapshots:
+        merged['uptime'] = max(merged['uptime'], snapshot['uptime'])
+        merged['connections_total'] += snapshot['connections_total']
+        merged['connections_in_flight'] += snapshot['connections_in_flight']
+        for action, values in snapshot['actions'].items():
+            totals = merged['actions'].setdefault(action, {
+                'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'handler_seconds': 0.0, 'codec_seconds': 0.0,
+            })
+            for key in totals:
+                totals[key] += values[key]
+            latency = values['latency']
+            histogram = latencies.get(action)
+            if histogram is None:
+                histogram = latencies[action] = Histogram(tuple(bound for bound, _ in latency['buckets'][:-1]))
+            for index, (_, count) in enumerate(latency['buckets']):
+                histogram.counts[index] += count
+            histogram.count += latency['count']
+            histogram.sum += latency['sum']
+            histogram.max = max(histogram.max, latency['max'])
+    for action, histogram in latencies.items():
+        merged['actions'][action]['latency'] = histogram.snapshot()
+    return merged
+
+
+# None is the top histogram bucket's missing bound
+def _prometheus_number(value):
+    return '+Inf' if value is None or value == float('inf') else repr(float(value))
+
+
+# Label values with backslash, double quote and newline escaped, as the text format requires
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Render a ServerMetrics snapshot in the Prometheus text exposition format.
+# gauges maps a group name to a dict of extra values (e.g. pool stats); the
+# numeric ones are exported as <prefix>_<group>_<name>.
+def prometheus_text(snapshot, prefix='hotel_booking', gauges=None):
+    lines = [
+        f'# TYPE {prefix}_uptime_seconds gauge',
+        f'{prefix}_uptime_seconds {_prometheus_number(snapshot["uptime"])}',
+        f'# TYPE {prefix}_connections_total counter',
+        f'{prefix}_connections_total {snapshot["connections_total"]}',
+        f'# TYPE {prefix}_connections_in_flight gauge',
+        f'{prefix}_connections_in_flight {snapshot["connections_in_flight"]}',
+    ]
+    counters = (
+        ('requests_total', 'requests'),
+        ('errors_total', 'errors'),
+        ('received_bytes_total', 'bytes_in'),
+        ('sent_bytes_total', 'bytes_out'),
+        ('handler_seconds_total', 'handler_seconds'),
+        ('codec_seconds_total', 'codec_seconds'),
+    )
+    actions = snapshot['actions']
+    for name, key in counters:
+        lines.append(f'# TYPE {prefix}_{name} counter')
+        for action, metrics in sorted(actions.items()):
+            lines.append(f'{prefix}_{name}{{action="{_prometheus_label(action)}"}} {_prometheus_number(metrics[key])}')
+
+    lines.append(f'# TYPE {prefix}_request_duration_seconds histogram')
+    for action, metrics in sorted(actions.items()):
+        action = _prometheus_label(action)
+        latency = metrics['latency']
+        cumulative = 0
+        for bound, count in latency['buckets']:
+            cumulative += count
+            lines.append(f'{prefix}_request_duration_seconds_bucket{{action="{action}",le="{_prometheus_number(bound)}"}} {cumulative}')
+        lines.append(f'{prefix}_request_duration_seconds_sum{{action="{action}"}} {_prometheus_number(latency["sum"])}')
+        lines.append(f'{prefix}_request_duration_seconds_count{{action="{action}"}} {latency["count"]}')
+
+    for group, values in (gauges or {}).items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'# TYPE {prefix}_{group}_{name} gauge')
+                lines.append(f'{prefix}_{group}_{name} {_prometheus_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# Opt-in sampling profiler: every Nth request runs under cProfile and the
+# results accumulate until report() is asked for them
+class SamplingProfiler:
+    def __init__(self, every=0):
+        self.every = every
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+        self._counter = 0
+        self._stats = None
+        self.samples = 0
+
+    def should_sample(self):
+        if not self.every:
+            return False
+        with self._lock:
+            self._counter += 1
+            return self._counter % self.every == 0
+
+    # Only one request is profiled at a time; newer Pythons allow a single
+    # active profiler per process, so overlapping samples run unprofiled
+    def run(self, func, *args):
+        if not self._active.acquire(blocking=False):
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self._active.release()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.samples += 1
+
+    def report(self, limit=25, sort='cumulative'):
+        with self._lock:
+            if self._stats is None:
+                return "No requests have been profiled."
+            output = io.StringIO()
+            self._stats.stream = output
+            self._stats.sort_stats(sort).print_stats(limit)
+            return f"{self.samples} sampled requests\n" + output.getvalue()
+
+
+# Drops log records beyond `rate` per second (with bursts up to `burst`) and
+# notes how many were dropped, so per-request logging cannot stall the server
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=20.0, burst=50):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False
+            self._tokens -= 1
+            if self._suppressed:
+                record.msg = f"{record.msg} ({self._suppressed} log messages suppressed)"
+                self._suppressed = 0
+            return True
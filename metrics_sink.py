@@ -0,0 +1,270 @@
+import argparse
+import csv
+import glob
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+# Client performance records: (action, start_time, end_time, latency, rtt).
+# Times are Unix timestamps, latency and RTT are seconds.
+CSV_FIELDS = ['action', 'start_time', 'end_time', 'latency', 'rtt']
+
+# Columnar binary format: a magic header, then self-contained blocks, one per
+# flush. A block is a record count, the block's action names, and one packed
+# column each for the action index, start time, end time, latency and RTT. A
+# block cut short by a crash is ignored when reading.
+BINARY_MAGIC = b'PMB1'
+BINARY_EXTENSION = '.pmb'
+COUNT = struct.Struct('<I')
+NAME_COUNT = struct.Struct('<H')
+NAME_SIZE = struct.Struct('<H')
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_AGE = 3600.0
+# Records held in memory waiting for the writer; beyond this the oldest are dropped
+DEFAULT_MAX_PENDING = 100000
+
+
+def encode_block(records):
+    names = {}
+    indexes = []
+    for record in records:
+        indexes.append(names.setdefault(record[0], len(names)))
+    count = len(records)
+    parts = [COUNT.pack(count), NAME_COUNT.pack(len(names))]
+    for name in names:
+        encoded = name.encode('utf-8')
+        parts.append(NAME_SIZE.pack(len(encoded)))
+        parts.append(encoded)
+    parts.append(struct.pack(f'<{count}H', *indexes))
+    for column in range(1, 5):
+        parts.append(struct.pack(f'<{count}d', *[record[column] for record in records]))
+    return b''.join(parts)
+
+
+def read_binary(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError(f"{path} is not a performance metrics file")
+    offset = len(BINARY_MAGIC)
+    try:
+        while offset < len(data):
+            (count,) = COUNT.unpack_from(data, offset)
+            offset += COUNT.size
+            (name_count,) = NAME_COUNT.unpack_from(data, offset)
+            offset += NAME_COUNT.size
+            names = []
+            for _ in range(name_count):
+                (size,) = NAME_SIZE.unpack_from(data, offset)
+                offset += NAME_SIZE.size
+                names.append(data[offset:offset + size].decode('utf-8'))
+                offset += size
+            indexes = struct.unpack_from(f'<{count}H', data, offset)
+            offset += 2 * count
+            columns = []
+            for _ in range(4):
+                columns.append(struct.unpack_from(f'<{count}d', data, offset))
+                offset += 8 * count
+            for index, start, end, latency, rtt in zip(indexes, *columns):
+                yield names[index], start, end, latency, rtt
+    except (struct.error, IndexError, UnicodeDecodeError):
+        return  # truncated final block
+
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if 'action' not in row:
+                # Files written before records carried the action: latency and rtt in ms
+                yield 'unknown', None, None, float(row['latency']) / 1000, float(row['rtt']) / 1000
+                continue
+            yield (row['action'], float(row['start_time']), float(row['end_time']),
+                   float(row['latency']), float(row['rtt']))
+
+
+def read_records(path):
+    return read_binary(path) if path.endswith(BINARY_EXTENSION) else read_csv(path)
+
+
+# Buffers performance records in memory and appends them to rotating CSV and
+# binary files from a background thread, in batches, so recording costs a
+# list append and a crash loses at most one flush interval
+class MetricsSink:
+    def __init__(self, directory='.', prefix='performance_metrics', formats=('csv', 'binary'),
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, batch_size=DEFAULT_BATCH_SIZE,
+                 max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE, max_pending=DEFAULT_MAX_PENDING):
+        unknown = set(formats) - {'csv', 'binary'}
+        if unknown:
+            raise ValueError(f"Unknown metrics formats: {', '.join(sorted(unknown))}")
+        self.directory = directory
+        self.prefix = prefix
+        self.formats = tuple(formats)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self.paths = []
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._files = {}
+        self._csv_writer = None
+        self._opened_at = None
+        self._sequence = 0
+        self._thread = threading.Thread(target=self._run, name='metrics-sink', daemon=True)
+        self._thread.start()
+
+    def record(self, action, start_time, end_time, latency, rtt):
+        with self._lock:
+            if self._closed:
+                return
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append((action, start_time, end_time, latency, rtt))
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _open(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        self._sequence += 1
+        base = os.path.join(self.directory, f'{self.prefix}-{stamp}-{os.getpid()}-{self._sequence}')
+        os.makedirs(self.directory, exist_ok=True)
+        if 'csv' in self.formats:
+            f = open(base + '.csv', 'w', newline='')
+            self._csv_writer = csv.writer(f)
+            self._csv_writer.writerow(CSV_FIELDS)
+            self._files['csv'] = f
+            self.paths.append(base + '.csv')
+        if 'binary' in self.formats:
+            f = open(base + BINARY_EXTENSION, 'wb')
+            f.write(BINARY_MAGIC)
+            self._files['binary'] = f
+            self.paths.append(base + BINARY_EXTENSION)
+        self._opened_at = time.monotonic()
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self._csv_writer = None
+
+    def _should_rotate(self):
+        if not self._files:
+            return False
+        if self.max_age is not None and time.monotonic() - self._opened_at >= self.max_age:
+            return True
+        return self.max_bytes is not None and any(f.tell() >= self.max_bytes for f in self._files.values())
+
+    # Write everything recorded so far; called by the background thread, and
+    # safe to call directly
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                records = list(self._pending)
+                self._pending.clear()
+            if not records:
+                return
+            if self._should_rotate():
+                self._close_files()
+            if not self._files:
+                self._open()
+            if self._csv_writer is not None:
+                self._csv_writer.writerows(records)
+            if 'binary' in self._files:
+                self._files['binary'].write(encode_block(records))
+            for f in self._files.values():
+                f.flush()
+            self.written += len(records)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        with self._write_lock:
+            self._close_files()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Per-action latency and RTT summaries (milliseconds) over any number of
+# metrics files, CSV or binary
+def aggregate(paths):
+    latencies = {}
+    rtts = {}
+    for path in paths:
+        for action, _, _, latency, rtt in read_records(path):
+            latencies.setdefault(action, array('d')).append(latency)
+            rtts.setdefault(action, array('d')).append(rtt)
+
+    summary = {}
+    for action in sorted(latencies):
+        row = {'count': len(latencies[action])}
+        for metric, values in (('latency', latencies[action]), ('rtt', rtts[action])):
+            ordered = sorted(values)
+            row[f'{metric}_mean'] = sum(ordered) / len(ordered) * 1000
+            for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+                row[f'{metric}_{name}'] = percentile(ordered, fraction) * 1000
+            row[f'{metric}_max'] = ordered[-1] * 1000
+        summary[action] = row
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'action':<20} {'count':>8} {'lat p50':>9} {'lat p95':>9} {'lat p99':>9} {'rtt p50':>9} {'rtt p95':>9} {'rtt p99':>9} {'rtt max':>9}")
+    for action, row in summary.items():
+        print(f"{action:<20} {row['count']:>8} {row['latency_p50']:>9.2f} {row['latency_p95']:>9.2f} {row['latency_p99']:>9.2f} "
+              f"{row['rtt_p50']:>9.2f} {row['rtt_p95']:>9.2f} {row['rtt_p99']:>9.2f} {row['rtt_max']:>9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise client performance metrics files per action (milliseconds)")
+    parser.add_argument('files', nargs='*', help="CSV or .pmb files (default: performance_metrics*.pmb in this directory)")
+    parser.add_argument('--csv', help="also write the summary to this CSV file")
+    args = parser.parse_args(argv)
+
+    paths = args.files or sorted(glob.glob('performance_metrics*' + BINARY_EXTENSION))
+    if not paths:
+        print("No metrics files found.", file=sys.stderr)
+        return 1
+    summary = aggregate(paths)
+    print_summary(summary)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = None
+            for action, row in summary.items():
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=['action'] + list(row))
+                    writer.writeheader()
+                writer.writerow(dict(row, action=action))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
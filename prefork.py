@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+import codec
+from metrics import merge_snapshots, prometheus_text
+from protocol import recv_frame, send_frame
+
+logger = logging.getLogger('server.prefork')
+
+# Workers send their stats this often; each report doubles as a heartbeat
+REPORT_INTERVAL = 1.0
+# A worker that has not reported for this long is considered hung and replaced
+HEALTH_TIMEOUT = 15.0
+# How long a new worker may take to start listening
+STARTUP_TIMEOUT = 60.0
+# How long a worker waits for the routes the supervisor precomputes
+ROUTES_WAIT = 600.0
+# A worker that dies within this many seconds of starting is respawned after
+# a delay that doubles with every such crash, up to MAX_RESPAWN_DELAY
+MIN_HEALTHY_LIFETIME = 10.0
+RESPAWN_DELAY = 0.5
+MAX_RESPAWN_DELAY = 30.0
+# With SO_REUSEPORT every worker binds the port itself and the kernel spreads
+# new connections across them; elsewhere the workers share one listening socket
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+# Worker process entry point. server is imported here rather than at the top:
+# in the supervisor it is already running as __main__, and importing it in the
+# worker means every restart runs the code currently on disk.
+def run_worker(args, slot, generation, reports, listener=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops workers with SIGTERM
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    import server
+    server.configure(args)
+    server.SAVED_ROUTES_WAIT = ROUTES_WAIT
+    server.start_warm_up()
+    asyncio.run(_serve_worker(server, args, slot, generation, reports, listener))
+
+
+async def _serve_worker(server, args, slot, generation, reports, listener):
+    def report(kind='stats'):
+        reports.put((kind, os.getpid(), slot, generation, server.server_stats()))
+
+    async def heartbeat():
+        while True:
+            report()
+            await asyncio.sleep(REPORT_INTERVAL)
+
+    tasks = []
+    try:
+        await server.serve_async(args.host, args.port, args.backlog, args.max_connections, args.db_workers,
+                                 sock=listener, reuse_port=listener is None, graceful_timeout=args.graceful_timeout,
+                                 on_listening=lambda: tasks.append(asyncio.ensure_future(heartbeat())))
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Final counters, kept by the supervisor after this worker is gone
+        report('exit')
+
+
+class WorkerProcess:
+    def __init__(self, process, slot, generation):
+        self.process = process
+        self.slot = slot
+        self.generation = generation
+        self.started_at = time.monotonic()
+        self.last_report = None
+        self.snapshot = None
+        self.retiring = False
+        self.stop_sent_at = None
+
+    @property
+    def ready(self):
+        return self.last_report is not None
+
+
+# Pre-fork supervisor: runs `workers` async server processes on one port so
+# request handling scales across cores instead of sharing one GIL. It
+# replaces workers that exit or stop reporting, restarts all of them
+# gracefully on SIGHUP (the new generation is listening before the old one is
+# asked to drain), stops them gracefully on SIGTERM or SIGINT, and sums their
+# stats, which --stats-port serves over the normal protocol.
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.size = max(1, args.workers)
+        self.context = multiprocessing.get_context('spawn')
+        self.reports = self.context.Queue()
+        self.listener = None
+        self.generation = 0
+        self.restarts = 0
+        self.started_at = time.time()
+        self._workers = {}
+        self._retired = None
+        self._crashes = {}
+        self._respawn_at = {}
+        self._lock = threading.Lock()
+        self._restart_requested = False
+        self._stopping = False
+
+    def _spawn(self, slot):
+        process = self.context.Process(target=run_worker, name=f'worker-{slot}',
+                                       args=(self.args, slot, self.generation, self.reports, self.listener))
+        process.start()
+        with self._lock:
+            self._workers[process.pid] = WorkerProcess(process, slot, self.generation)
+        logger.info("Started worker %d (pid %d, generation %d)", slot, process.pid, self.generation)
+
+    def _stop(self, worker):
+        if worker.stop_sent_at is None and worker.process.is_alive():
+            worker.stop_sent_at = time.monotonic()
+            worker.process.terminate()
+
+    def _handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._restart_requested = True
+        else:
+            self._stopping = True
+
+    def _collect_reports(self, timeout):
+        try:
+            message = self.reports.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            _, pid, _, _, snapshot = message
+            with self._lock:
+                worker = self._workers.get(pid)
+                if worker is not None:
+                    worker.snapshot = snapshot
+                    worker.last_report = time.monotonic()
+            try:
+                message = self.reports.get_nowait()
+            except queue.Empty:
+                return
+
+    def _restart(self):
+        self._restart_requested = False
+        with self._lock:
+            old = [worker for worker in self._workers.values() if not worker.retiring]
+            for worker in old:
+                worker.retiring = True
+        self.generation += 1
+        self.restarts += 1
+        logger.info("Graceful restart: starting generation %d", self.generation)
+        self._respawn_at.clear()
+        for slot in range(self.size):
+            self._spawn(slot)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        with self._lock:
+            workers = list(self._workers.values())
+        current_ready = all(worker.ready for worker in workers if not worker.retiring)
+        if any(not worker.process.is_alive() for worker in workers):
+            # Pick up the final reports of workers that just exited before reaping them
+            self._collect_reports(timeout=0)
+        for worker in workers:
+            process = worker.process
+            if not process.is_alive():
+                process.join()
+                self._reap(worker, now)
+            elif worker.retiring:
+                # Old generation drains once the new one is accepting connections
+                if current_ready or now - worker.started_at > STARTUP_TIMEOUT:
+                    self._stop(worker)
+                if worker.stop_sent_at is not None and now - worker.stop_sent_at > self.args.graceful_timeout + 5:
+                    process.kill()
+            elif not worker.ready and now - worker.started_at > STARTUP_TIMEOUT:
+                logger.error("Worker %d (pid %d) did not start listening in %.0fs; killing it",
+                             worker.slot, process.pid, STARTUP_TIMEOUT)
+                process.kill()
+            elif worker.ready and now - worker.last_report > HEALTH_TIMEOUT:
+                logger.error("Worker %d (pid %d) has not reported for %.0fs; killing it",
+                             worker.slot, process.pid, now - worker.last_report)
+                process.kill()
+
+        for slot, due in list(self._respawn_at.items()):
+            if now >= due and not self._stopping:
+                del self._respawn_at[slot]
+                self._spawn(slot)
+
+    def _reap(self, worker, now):
+        with self._lock:
+            self._workers.pop(worker.process.pid, None)
+            if worker.snapshot is not None:
+                final = dict(worker.snapshot, connections_in_flight=0)
+                self._retired = final if self._retired is None else merge_snapshots([self._retired, final])
+        if worker.retiring or self._stopping:
+            logger.info("Worker %d (pid %d) stopped", worker.slot, worker.process.pid)
+            return
+        lifetime = now - worker.started_at
+        crashes = self._crashes.get(worker.slot, 0) + 1 if lifetime < MIN_HEALTHY_LIFETIME else 0
+        self._crashes[worker.slot] = crashes
+        delay = min(MAX_RESPAWN_DELAY, RESPAWN_DELAY * 2 ** (crashes - 1)) if crashes else 0.0
+        logger.warning("Worker %d (pid %d) exited with code %s; restarting it in %.1fs",
+                       worker.slot, worker.process.pid, worker.process.exitcode, delay)
+        self._respawn_at[worker.slot] = now + delay
+
+    def _shutdown(self):
+        logger.info("Stopping workers")
+        with self._lock:
+            workers = list(self._workers.values())
+        for worker in workers:
+            self._stop(worker)
+        deadline = time.monotonic() + self.args.graceful_timeout + 5
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        if self.listener is not None:
+            self.listener.close()
+
+    # Metrics summed over every worker, including ones that have exited
+    def stats(self, output_format=None):
+        with self._lock:
+            live = [worker for worker in self._workers.values() if worker.snapshot is not None]
+            snapshots = [worker.snapshot for worker in live]
+            if self._retired is not None:
+                snapshots.append(self._retired)
+            workers = [{
+                'slot': worker.slot,
+                'pid': worker.process.pid,
+                'generation': worker.generation,
+                'ready': worker.ready,
+                'retiring': worker.retiring,
+                'requests': sum(values['requests'] for values in worker.snapshot['actions'].values()) if worker.snapshot else 0,
+                'report_age': None if worker.last_report is None else time.monotonic() - worker.last_report,
+            } for worker in self._workers.values()]
+        snapshot = merge_snapshots(snapshots)
+        snapshot['uptime'] = time.time() - self.started_at
+        summary = {'live': sum(1 for worker in workers if worker['ready'] and not worker['retiring']),
+                   'configured': self.size, 'generation': self.generation, 'restarts': self.restarts}
+        if output_format == 'prometheus':
+            return prometheus_text(snapshot, gauges={'workers': summary})
+        snapshot['workers'] = workers
+        snapshot['supervisor'] = summary
+        return snapshot
+
+    def _serve_stats_client(self, conn):
+        with conn:
+            try:
+                while True:
+                    payload = recv_frame(conn)
+                    if payload is None:
+                        break
+                    reply_codec = payload[0] if payload and payload[0] in codec.CODEC_NAMES else codec.JSON
+                    try:
+                        request, reply_codec = codec.decode(payload)
+                        if request.get('action') != 'stats':
+                            raise ValueError("Only the stats action is served on the stats port")
+                        response = self.stats(request.get('format'))
+                    except Exception as e:
+                        response = {'status': 'failure', 'message': str(e)}
+                    send_frame(conn, codec.encode(response, reply_codec))
+            except (ConnectionError, OSError) as e:
+                logger.info("Stats connection error: %s", e)
+
+    def _serve_stats(self, stats_socket):
+        while True:
+            conn, _ = stats_socket.accept()
+            threading.Thread(target=self._serve_stats_client, args=(conn,), daemon=True).start()
+
+    def run(self):
+        if not REUSE_PORT:
+            self.listener = socket.create_server((self.args.host, self.args.port), backlog=self.args.backlog)
+        if self.args.stats_port:
+            stats_socket = socket.create_server((self.args.host, self.args.stats_port))
+            threading.Thread(target=self._serve_stats, args=(stats_socket,), name='stats', daemon=True).start()
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._handle_signal)
+
+        logger.info("Starting %d workers on port %d (%s)", self.size, self.args.port,
+                    'SO_REUSEPORT' if REUSE_PORT else 'shared socket')
+        for slot in range(self.size):
+            self._spawn(slot)
+        try:
+            while not self._stopping:
+                if self._restart_requested:
+                    self._restart()
+                self._collect_reports(timeout=0.25)
+                self._check_workers()
+        finally:
+            self._shutdown()
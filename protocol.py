@@ -0,0 +1,83 @@
+import asyncio
+import socket
+import struct
+
+# Every message on the wire is a 4-byte big-endian length header followed by the payload,
+# so one connection can carry any number of requests and responses of any size.
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+# The peer started a frame but did not finish sending it in time
+class FrameTimeout(ConnectionError):
+    pass
+
+
+def send_frame(sock, payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        part = sock.recv(size - len(buffer))
+        if not part:
+            if not buffer:
+                return None
+            raise ConnectionError("Connection closed in the middle of a frame")
+        buffer += part
+    return bytes(buffer)
+
+
+# Returns None when the peer closed the connection cleanly between frames.
+# The socket's own timeout applies while waiting for a frame to start; with
+# read_timeout, the rest of the frame must arrive within that many seconds
+# (the socket is left with that timeout).
+def recv_frame(sock, read_timeout=None):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Peer announced a {size} byte frame, above the {MAX_FRAME_SIZE} byte limit")
+    if size == 0:
+        return b''
+    if read_timeout is not None:
+        sock.settimeout(read_timeout)
+    try:
+        payload = recv_exactly(sock, size)
+    except socket.timeout:
+        raise FrameTimeout(f"Frame not received within {read_timeout}s")
+    if payload is None:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return payload
+
+
+# asyncio stream equivalents of recv_frame/send_frame. idle_timeout bounds the
+# wait for a frame to start (asyncio.TimeoutError) and read_timeout the rest
+# of it (FrameTimeout).
+async def read_frame_async(reader, idle_timeout=None, read_timeout=None):
+    try:
+        header = await asyncio.wait_for(reader.readexactly(HEADER.size), idle_timeout)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed in the middle of a frame")
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Peer announced a {size} byte frame, above the {MAX_FRAME_SIZE} byte limit")
+    try:
+        return await asyncio.wait_for(reader.readexactly(size), read_timeout)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    except asyncio.TimeoutError:
+        raise FrameTimeout(f"Frame not received within {read_timeout}s")
+
+
+async def write_frame_async(writer, payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    writer.write(HEADER.pack(len(payload)) + payload)
+    await writer.drain()
@@ -0,0 +1,478 @@
+import argparse
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import codec
+from availability import availability
+from booking_writer import get_writer
+from catalog_cache import catalog
+from db import get_pool
+from protocol import recv_frame, send_frame
+from schema import CATALOG_TABLES, REPLICATED_TABLES
+
+logger = logging.getLogger('server.replication')
+
+# Changes per fetch_changes reply, and rows per fetch_snapshot reply
+DEFAULT_BATCH = 1000
+MAX_BATCH = 10000
+DEFAULT_SNAPSHOT_CHUNK = 5000
+# Seconds a replica waits between polls once it has caught up
+DEFAULT_POLL_INTERVAL = 0.1
+# A replica that has not been caught up with its primary for this many
+# seconds refuses reads, so clients fall back to the primary
+DEFAULT_MAX_LAG = 30.0
+# Newest change log entries kept; a replica further behind starts over from a snapshot
+DEFAULT_RETENTION = 100000
+PRUNE_INTERVAL = 60.0
+# Followers not heard from for this long are dropped from the primary's stats
+FOLLOWER_TIMEOUT = 300.0
+# Most followers tracked at once; the one heard from least recently makes room
+MAX_FOLLOWERS = 64
+# Seconds between reconnection attempts, doubling up to RETRY_MAX
+RETRY_DELAY = 0.5
+RETRY_MAX = 10.0
+
+# Actions that write to the database; replicas refuse them
+WRITE_ACTIONS = {'process_payment', 'book_and_pay', 'save_booking'}
+# Unique columns besides id, per table (see Replica._upsert)
+UNIQUE_COLUMNS = {'Bookings': ('booking_id', 'idempotency_key')}
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def log_id(conn):
+    return conn.execute("SELECT value FROM ReplicationState WHERE name = 'log_id'").fetchone()[0]
+
+
+# seq of the newest change ever logged, pruned or not
+def last_seq(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ChangeLog'").fetchone()
+    return row[0] if row is not None else 0
+
+
+def _limit(value, default, maximum):
+    value = default if value is None else value
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= maximum:
+        raise ValueError(f"limit must be between 1 and {maximum}")
+    return value
+
+
+# The primary's side: serves its change log and table snapshots to replicas,
+# remembers how far each replica has got, and trims the log to the newest
+# retention entries. Only requests carrying the shared replication secret are
+# served; without one configured, replication is off.
+class ChangeLogPublisher:
+    def __init__(self, retention=DEFAULT_RETENTION, secret=None):
+        self.retention = retention
+        self.secret = secret
+        self.pruned = 0
+        self._followers = {}
+        self._lock = threading.Lock()
+        self._pruner = None
+
+    # The failure response for a replication request without the right secret, else None
+    def refusal(self, request):
+        if not self.secret:
+            return {'status': 'failure', 'code': 'forbidden',
+                    'message': "Replication is not enabled on this server; start it with --replication-secret"}
+        secret = request.get('secret')
+        if not isinstance(secret, str) or not hmac.compare_digest(secret.encode(), self.secret.encode()):
+            return {'status': 'failure', 'code': 'forbidden', 'message': "Invalid replication secret"}
+        return None
+
+    # Up to limit changes after seq `after`, oldest first, as (seq, at,
+    # table, op, row id, row JSON) rows. A replica whose position is no longer
+    # in the log (pruned, or the database was replaced) gets a
+    # snapshot_required failure and must start over from fetch_snapshot.
+    def changes(self, request):
+        refusal = self.refusal(request)
+        if refusal is not None:
+            return refusal
+        after = request.get('after', 0)
+        if isinstance(after, bool) or not isinstance(after, int) or after < 0:
+            raise ValueError(f"Invalid change log position: {after!r}")
+        limit = _limit(request.get('limit'), DEFAULT_BATCH, MAX_BATCH)
+        with get_pool().transaction(immediate=False) as conn:
+            current = last_seq(conn)
+            oldest = conn.execute("SELECT MIN(seq) FROM ChangeLog").fetchone()[0]
+            if after > current or (after < current and (oldest is None or oldest > after + 1)):
+                return {'status': 'failure', 'code': 'snapshot_required',
+                        'message': f"Change log position {after} is not available; take a snapshot"}
+            changes = conn.execute(
+                "SELECT seq, at, table_name, op, row_id, data FROM ChangeLog WHERE seq > ? ORDER BY seq LIMIT ?",
+                (after, limit)).fetchall()
+            response = {'status': 'success', 'log_id': log_id(conn), 'last_seq': current, 'changes': changes}
+        follower = request.get('replica')
+        if follower is not None:
+            follower = str(follower)
+            with self._lock:
+                if follower not in self._followers and len(self._followers) >= MAX_FOLLOWERS:
+                    del self._followers[min(self._followers, key=lambda name: self._followers[name][2])]
+                self._followers[follower] = (after + len(changes), current, time.monotonic())
+        return response
+
+    # Up to limit rows of one replicated table with an id above after_id, and
+    # the change log position they are at least as new as. Chunks are read in
+    # separate transactions, so a replica replays the log from the first
+    # chunk's seq to make the copy consistent.
+    def snapshot(self, request):
+        refusal = self.refusal(request)
+        if refusal is not None:
+            return refusal
+        table = request.get('table')
+        if table not in REPLICATED_TABLES:
+            raise ValueError(f"Not a replicated table: {table!r}")
+        after_id = request.get('after_id', 0)
+        if isinstance(after_id, bool) or not isinstance(after_id, int):
+            raise ValueError(f"Invalid after_id: {after_id!r}")
+        limit = _limit(request.get('limit'), DEFAULT_SNAPSHOT_CHUNK, MAX_BATCH)
+        with get_pool().transaction(immediate=False) as conn:
+            seq = last_seq(conn)
+            cursor = conn.execute(f"SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+            rows = cursor.fetchall()
+            return {'status': 'success', 'log_id': log_id(conn), 'seq': seq,
+                    'columns': [column[0] for column in cursor.description], 'rows': rows}
+
+    def prune(self):
+        if not self.retention:
+            return 0
+
+        def job(conn):
+            return conn.execute("DELETE FROM ChangeLog WHERE seq <= (SELECT MAX(seq) FROM ChangeLog) - ?",
+                                (self.retention,)).rowcount
+
+        pruned = get_writer().run(job)
+        self.pruned += pruned
+        return pruned
+
+    def start_pruning(self, interval=PRUNE_INTERVAL):
+        if self._pruner is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.prune()
+                except Exception as e:
+                    logger.warning("Could not prune the change log: %s", e)
+
+        self._pruner = threading.Thread(target=run, name='change-log-pruner', daemon=True)
+        self._pruner.start()
+
+    def stats(self):
+        with get_pool().connection() as conn:
+            current = last_seq(conn)
+            oldest = conn.execute("SELECT MIN(seq) FROM ChangeLog").fetchone()[0]
+        now = time.monotonic()
+        with self._lock:
+            for name, (_, _, seen) in list(self._followers.items()):
+                if now - seen > FOLLOWER_TIMEOUT:
+                    del self._followers[name]
+            followers = {name: {'applied_seq': applied, 'behind': max(0, current - applied), 'last_poll': now - seen}
+                         for name, (applied, _, seen) in self._followers.items()}
+        return {'role': 'primary', 'last_seq': current, 'oldest_seq': oldest, 'pruned': self.pruned,
+                'followers': len(followers),
+                'max_follower_behind': max((follower['behind'] for follower in followers.values()), default=0),
+                'replicas': followers}
+
+
+# Read replica: a thread follows the primary's change log and applies each
+# batch of changes through this process's booking writer, so the local
+# database holds the primary's catalog and bookings as of some recent seq.
+# The first start, or a position the primary no longer has, copies every
+# replicated table with fetch_snapshot first. The position is stored in
+# ReplicationState with the rows it covers, so a restart resumes where it stopped.
+class Replica:
+    def __init__(self, primary, name=None, poll_interval=DEFAULT_POLL_INTERVAL, max_lag=DEFAULT_MAX_LAG,
+                 batch=DEFAULT_BATCH, timeout=30.0, secret=None):
+        host, _, port = primary.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Primary must be given as HOST:PORT, got {primary!r}")
+        self.primary = primary
+        self.address = (host, int(port))
+        self.name = name or socket.gethostname()
+        self.poll_interval = poll_interval
+        self.max_lag = max_lag
+        self.batch = batch
+        self.timeout = timeout
+        self.secret = secret
+        self.state = 'starting'
+        self.source_log_id = None
+        self.applied_seq = 0
+        self.primary_seq = None
+        self.caught_up_at = None
+        self.applied = 0
+        self.bootstraps = 0
+        self.errors = 0
+        self.last_error = None
+        self._socket = None
+        self._columns = {}
+        self._last_booking_id = 0
+        self._thread = None
+
+    def start(self):
+        with get_pool().connection() as conn:
+            state = dict(conn.execute("SELECT name, value FROM ReplicationState"))
+            for table in REPLICATED_TABLES:
+                self._columns[table] = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            self._last_booking_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM Bookings").fetchone()[0]
+        self.source_log_id = state.get('source_log_id')
+        self.applied_seq = state.get('applied_seq') or 0
+        self._thread = threading.Thread(target=self._run, name='replica', daemon=True)
+        self._thread.start()
+
+    # Seconds since the replica last knew it had every change the primary had
+    # committed, None before it first caught up
+    def lag(self):
+        return None if self.caught_up_at is None else time.monotonic() - self.caught_up_at
+
+    def stale(self):
+        if not self.max_lag:
+            return False
+        lag = self.lag()
+        return lag is None or lag > self.max_lag
+
+    # The failure response for an action this replica will not run, else None:
+    # writes belong on the primary, and reads are refused while the copy is
+    # too far behind (or still being taken) to be useful
+    def refusal(self, action):
+        if action == 'stats':
+            return None
+        if action in WRITE_ACTIONS:
+            return {'status': 'failure', 'code': 'read_only', 'primary': self.primary,
+                    'message': f"This server is a read replica; send writes to the primary at {self.primary}"}
+        if self.stale():
+            lag = self.lag()
+            behind = 'not caught up yet' if lag is None else f"{lag:.1f}s behind"
+            return {'status': 'failure', 'code': 'stale', 'primary': self.primary,
+                    'message': f"Replica is {behind} the primary at {self.primary}"}
+        return None
+
+    def _run(self):
+        delay = RETRY_DELAY
+        while True:
+            try:
+                more = self._poll()
+                delay = RETRY_DELAY
+                if not more:
+                    time.sleep(self.poll_interval)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                if self.state != 'bootstrapping':
+                    self.state = 'disconnected'
+                logger.warning("Replication from %s failed: %s; retrying in %.1fs", self.primary, e, delay)
+                self._close()
+                time.sleep(delay)
+                delay = min(RETRY_MAX, delay * 2)
+
+    def _request(self, request):
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, timeout=self.timeout)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(self._socket, codec.encode(request, codec.BINARY))
+        payload = recv_frame(self._socket)
+        if payload is None:
+            raise ConnectionError("Primary closed the connection")
+        response, _ = codec.decode(payload)
+        if isinstance(response, dict) and response.get('status') == 'failure' \
+                and response.get('code') != 'snapshot_required':
+            raise ReplicationError(response.get('message'))
+        return response
+
+    def _close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+    # Apply the next batch of changes; True if the primary has more
+    def _poll(self):
+        if self.source_log_id is None:
+            self._bootstrap()
+        polled_at = time.monotonic()
+        response = self._request({'action': 'fetch_changes', 'after': self.applied_seq, 'limit': self.batch,
+                                  'replica': self.name, 'secret': self.secret})
+        if response.get('code') == 'snapshot_required' or response['log_id'] != self.source_log_id:
+            logger.warning("Position %d of %s's change log is gone; copying the tables again",
+                           self.applied_seq, self.primary)
+            self.source_log_id = None
+            return True
+        changes = response['changes']
+        if changes:
+            self._apply(changes)
+        self.primary_seq = response['last_seq']
+        if self.applied_seq >= self.primary_seq:
+            self.caught_up_at = polled_at
+        self.state = 'following'
+        return len(changes) == self.batch
+
+    def _upsert(self, conn, table, row):
+        columns = [column for column in self._columns[table] if column in row]
+        values = [row[column] for column in columns]
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns if column != 'id')
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+               f"ON CONFLICT(id) DO UPDATE SET {updates}")
+        try:
+            conn.execute(sql, values)
+        except sqlite3.IntegrityError:
+            # Replaying the log over a snapshot chunk read later: another row
+            # still holds one of this row's unique values. Its own later
+            # change in the log brings it back.
+            for column in UNIQUE_COLUMNS.get(table, ()):
+                if row.get(column) is not None:
+                    conn.execute(f"DELETE FROM {table} WHERE {column} = ? AND id != ?", (row[column], row['id']))
+            conn.execute(sql, values)
+
+    def _copy(self, conn, table, rows):
+        for row in rows:
+            self._upsert(conn, table, row)
+
+    @staticmethod
+    def _save_position(conn, source_log_id, applied_seq):
+        conn.executemany("INSERT INTO ReplicationState VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                         [('source_log_id', source_log_id), ('applied_seq', applied_seq)])
+
+    def _apply(self, changes):
+        def job(conn):
+            for _, _, table, op, row_id, data in changes:
+                if table not in REPLICATED_TABLES:
+                    raise ReplicationError(f"Change to unknown table {table!r}")
+                if op == 'delete':
+                    conn.execute(f"DELETE FROM {table} WHERE id = ?", (row_id,))
+                else:
+                    self._upsert(conn, table, json.loads(data))
+            self._save_position(conn, self.source_log_id, changes[-1][0])
+
+        get_writer().run(job)
+        self.applied_seq = changes[-1][0]
+        self.applied += len(changes)
+        tables = {change[2] for change in changes}
+        if tables.intersection(CATALOG_TABLES):
+            catalog.invalidate()
+        # New bookings reach the occupancy index by themselves; an update or
+        # delete means rebuilding it
+        booking_ids = [change[4] for change in changes if change[2] == 'Bookings']
+        if booking_ids and (any(change[3] == 'delete' for change in changes if change[2] == 'Bookings')
+                            or len(set(booking_ids)) < len(booking_ids) or min(booking_ids) <= self._last_booking_id):
+            availability.reset()
+        if booking_ids:
+            self._last_booking_id = max(self._last_booking_id, max(booking_ids))
+
+    # Copy every replicated table from the primary, then follow its log from
+    # the position the copy started at
+    def _bootstrap(self):
+        self.state = 'bootstrapping'
+        self.caught_up_at = None
+        started = time.perf_counter()
+
+        def clear(conn):
+            for table in reversed(REPLICATED_TABLES):
+                conn.execute(f"DELETE FROM {table}")
+            conn.execute("DELETE FROM ReplicationState WHERE name IN ('source_log_id', 'applied_seq')")
+
+        get_writer().run(clear)
+        source_log_id = start_seq = None
+        copied = 0
+        for table in REPLICATED_TABLES:
+            after_id = 0
+            while True:
+                response = self._request({'action': 'fetch_snapshot', 'table': table, 'after_id': after_id,
+                                          'limit': DEFAULT_SNAPSHOT_CHUNK, 'secret': self.secret})
+                if source_log_id is None:
+                    source_log_id, start_seq = response['log_id'], response['seq']
+                elif response['log_id'] != source_log_id:
+                    raise ReplicationError("The primary's database was replaced during the snapshot")
+                columns = response['columns']
+                rows = [dict(zip(columns, row)) for row in response['rows']]
+                if rows:
+                    get_writer().run(lambda conn: self._copy(conn, table, rows))
+                    copied += len(rows)
+                if len(rows) < DEFAULT_SNAPSHOT_CHUNK:
+                    break
+                after_id = rows[-1]['id']
+
+        def finish(conn):
+            self._save_position(conn, source_log_id, start_seq)
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM Bookings").fetchone()[0]
+
+        self._last_booking_id = get_writer().run(finish)
+        self.source_log_id = source_log_id
+        self.applied_seq = start_seq
+        self.bootstraps += 1
+        catalog.invalidate()
+        availability.reset()
+        logger.info("Copied %d rows from %s in %.1fs; following its change log from %d",
+                    copied, self.primary, time.perf_counter() - started, start_seq)
+
+    def stats(self):
+        lag = self.lag()
+        return {'role': 'replica', 'primary': self.primary, 'state': self.state, 'stale': self.stale(),
+                'applied_seq': self.applied_seq, 'primary_seq': self.primary_seq,
+                'behind': None if self.primary_seq is None else max(0, self.primary_seq - self.applied_seq),
+                'lag': lag, 'applied': self.applied, 'bootstraps': self.bootstraps,
+                'errors': self.errors, 'last_error': self.last_error}
+
+
+# Run a primary and `replicas` read replicas on consecutive ports of this
+# machine, each with its own database under directory, until interrupted.
+# They share a replication secret, generated unless given. Options after the
+# known ones are passed to every server.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a primary server and local read replicas")
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345, help="primary port; replicas use the following ones")
+    parser.add_argument('--dir', default='cluster', help="directory for the databases")
+    parser.add_argument('--replication-secret', help="shared secret for the servers (default: a random one)")
+    args, server_args = parser.parse_known_args(argv)
+    server_args += ['--replication-secret', args.replication_secret or secrets.token_hex(16)]
+
+    os.makedirs(args.dir, exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    primary = f"{args.host}:{args.port}"
+    commands = [[sys.executable, script, '--host', args.host, '--port', str(args.port),
+                 '--db', os.path.join(args.dir, 'primary.db')]]
+    for index in range(1, args.replicas + 1):
+        commands.append([sys.executable, script, '--host', args.host, '--port', str(args.port + index),
+                         '--db', os.path.join(args.dir, f'replica-{index}.db'), '--replica-of', primary])
+    processes = []
+    for command in commands:
+        processes.append(subprocess.Popen(command + server_args))
+        print(f"{'replica' if '--replica-of' in command else 'primary'} on {command[3]}:{command[5]}, pid {processes[-1].pid}")
+        if len(processes) == 1:
+            time.sleep(1.0)  # let the primary create its database before the replicas copy it
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    try:
+        while not stopping.is_set() and all(process.poll() is None for process in processes):
+            stopping.wait(0.5)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+    # A server that exited by itself stopped the others; report it
+    return 0 if stopping.is_set() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
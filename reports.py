@@ -0,0 +1,179 @@
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+
+from schema import rebuild_rollup, rollup_values
+
+# Booking analytics. Every report is one GROUP BY in SQLite over
+# BookingRollup, the per-day summary the Bookings triggers keep up to date,
+# so its cost follows the number of days and catalog combinations rather
+# than the number of bookings. exact=True runs the same query over the
+# Bookings rows themselves, which is slower but needs no rollup.
+
+BUCKETS = {
+    'hour': "strftime('%Y-%m-%d %H:00', created_at, 'unixepoch')",
+    'day': "day",
+    'week': "strftime('%Y-W%W', day)",
+    'month': "substr(day, 1, 7)",
+}
+
+# Revenue columns shared by the grouped reports
+TOTALS = '''SUM(bookings) AS bookings, ROUND(SUM(revenue), 2) AS revenue,
+    ROUND(SUM(hotel_revenue), 2) AS hotel_revenue, ROUND(SUM(transport_revenue), 2) AS transport_revenue,
+    ROUND(SUM(revenue) / SUM(bookings), 2) AS average_booking'''
+
+REPORTS = {
+    'destinations': f'''
+        SELECT destination, {TOTALS},
+               ROUND(100.0 * SUM(revenue) / SUM(SUM(revenue)) OVER (), 2) AS revenue_share
+        FROM {{source}} {{where}}
+        GROUP BY destination ORDER BY revenue DESC''',
+    'hotels': f'''
+        SELECT destination, hotel_name, {TOTALS}
+        FROM {{source}} {{where}}
+        GROUP BY destination, hotel_name ORDER BY revenue DESC''',
+    'room_types': f'''
+        SELECT room_type, {TOTALS}
+        FROM {{source}} {{where}}
+        GROUP BY room_type ORDER BY revenue DESC''',
+    'transport': '''
+        SELECT NULLIF(transport_type, '') AS transport_type, SUM(bookings) AS bookings,
+               ROUND(100.0 * SUM(bookings) / SUM(SUM(bookings)) OVER (), 2) AS booking_share,
+               ROUND(SUM(transport_revenue), 2) AS transport_revenue,
+               ROUND(SUM(transport_revenue) / SUM(bookings), 2) AS average_fare
+        FROM {source} {where}
+        GROUP BY transport_type ORDER BY bookings DESC''',
+    'routes': f'''
+        SELECT origin, destination, {TOTALS}
+        FROM {{source}} {{where}}
+        GROUP BY origin, destination ORDER BY revenue DESC''',
+    'rate': '''
+        SELECT {bucket} AS period, SUM(bookings) AS bookings, ROUND(SUM(revenue), 2) AS revenue
+        FROM {source} {where}
+        GROUP BY period ORDER BY period''',
+}
+
+# One rollup-shaped row per booking, for exact reports and hourly rates
+EXACT_SOURCE = f"(SELECT created_at, {rollup_values()} FROM Bookings)"
+
+
+# Run a report and return (column names, rows). since and until are
+# inclusive YYYY-MM-DD dates (UTC); bookings with no known creation time are
+# only counted when neither is given.
+def run_report(conn, name, since=None, until=None, destination=None, bucket='day', exact=False):
+    if name not in REPORTS:
+        raise ValueError(f"Unknown report: {name}")
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket: {bucket}")
+    # Hours are finer than the rollup's days, so hourly rates read the bookings
+    hourly = name == 'rate' and bucket == 'hour'
+    source = EXACT_SOURCE if exact or hourly else 'BookingRollup'
+    filters = []
+    params = []
+    if since is not None:
+        # On the bookings, filter created_at itself so its index is used
+        filters.append("day >= ?" if source == 'BookingRollup' else "created_at >= CAST(strftime('%s', ?) AS REAL)")
+        params.append(since)
+    if until is not None:
+        filters.append("day <= ? AND day != ''" if source == 'BookingRollup' else "created_at < CAST(strftime('%s', ?, '+1 day') AS REAL)")
+        params.append(until)
+    if destination is not None:
+        filters.append("destination = ?")
+        params.append(destination)
+    if name == 'rate':
+        filters.append("day != ''")
+    where = f"WHERE {' AND '.join(filters)}" if filters else ''
+    query = REPORTS[name].format(source=source, where=where, bucket=BUCKETS[bucket])
+    cursor = conn.execute(query, params)
+    return [column[0] for column in cursor.description], cursor.fetchall()
+
+
+# Column-oriented form of a report: {'columns': [...], 'rows': n, 'data': {column: values}}
+def to_columns(columns, rows):
+    return {'columns': columns, 'rows': len(rows),
+            'data': {column: [row[index] for row in rows] for index, column in enumerate(columns)}}
+
+
+def write_csv(path, columns, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def write_json(path, columns, rows):
+    with open(path, 'w') as f:
+        json.dump(to_columns(columns, rows), f)
+
+
+def write_parquet(path, columns, rows):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)")
+    pyarrow.parquet.write_table(pyarrow.table(to_columns(columns, rows)['data']), path)
+
+
+def print_report(columns, rows):
+    cells = [[('' if value is None else f"{value:,.2f}" if isinstance(value, float) else str(value)) for value in row]
+             for row in rows]
+    widths = [max([len(column)] + [len(row[index]) for row in cells]) for index, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in cells:
+        print('  '.join(cell.rjust(width) if index else cell.ljust(width)
+                        for index, (cell, width) in enumerate(zip(row, widths))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Booking revenue and volume reports")
+    parser.add_argument('report', choices=sorted(REPORTS) + ['rebuild'],
+                        help="report to run; rebuild recomputes the rollup table from every booking")
+    parser.add_argument('--since', help="first day to include (YYYY-MM-DD, UTC)")
+    parser.add_argument('--until', help="last day to include (YYYY-MM-DD, UTC)")
+    parser.add_argument('--destination', help="only bookings to this city")
+    parser.add_argument('--bucket', choices=list(BUCKETS), default='day', help="rate report: period per row")
+    parser.add_argument('--exact', action='store_true', help="aggregate the Bookings rows instead of the rollup")
+    parser.add_argument('--csv', help="also write the report to this CSV file")
+    parser.add_argument('--json', help="also write the report to this file as column-oriented JSON")
+    parser.add_argument('--parquet', help="also write the report to this Parquet file (needs pyarrow)")
+    parser.add_argument('--db', default='hotel_booking.db', help="database file")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        if args.report == 'rebuild':
+            conn.execute("BEGIN IMMEDIATE")
+            rebuild_rollup(conn.cursor())
+            conn.execute("COMMIT")
+            print("Rollup rebuilt.")
+            return 0
+        try:
+            columns, rows = run_report(conn, args.report, args.since, args.until, args.destination,
+                                       args.bucket, args.exact)
+        except sqlite3.OperationalError as e:
+            print(f"{args.db}: {e} (start the server once to create or upgrade the schema)", file=sys.stderr)
+            return 1
+        if not rows:
+            print("No bookings found.")
+        else:
+            print_report(columns, rows)
+        if args.csv:
+            write_csv(args.csv, columns, rows)
+        if args.json:
+            write_json(args.json, columns, rows)
+        if args.parquet:
+            try:
+                write_parquet(args.parquet, columns, rows)
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                return 1
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import hashlib
+import heapq
+import os
+import threading
+from collections import OrderedDict
+
+import codec
+
+# Transport rows are (id, type, cost, origin, destination, duration)
+ID, TYPE, COST, ORIGIN, DESTINATION, DURATION = range(6)
+
+WEIGHTS = {
+    'cheapest': lambda row: row[COST],
+    'fastest': lambda row: row[DURATION],
+}
+# The itinerary total each sort orders by
+SORT_FIELDS = {'cheapest': 'cost', 'fastest': 'duration'}
+
+DEFAULT_K = 3
+DEFAULT_MAX_LEGS = 3
+MAX_CACHED_QUERIES = 100000
+# Share of the cache the startup precompute may fill; the rest is left for live queries
+PRECOMPUTE_SHARE = 0.5
+
+
+# Cheapest simple path from source to target using at most max_legs edges,
+# skipping banned edge ids and nodes. Labels are (node, legs used), and a
+# label is pruned when the node was already reached as cheaply in fewer legs.
+def shortest_path(adjacency, source, target, max_legs, weight, banned_edges=(), banned_nodes=()):
+    if max_legs < 1 or source in banned_nodes:
+        return None
+    best = {}
+    heap = [(0.0, 0, source, ())]
+    while heap:
+        distance, legs, node, path = heapq.heappop(heap)
+        if node == target and path:
+            return distance, path
+        if legs == max_legs:
+            continue
+        visited = {source}
+        visited.update(row[DESTINATION] for row in path)
+        for row in adjacency.get(node, ()):
+            cost = weight(row)
+            if cost is None or row[ID] in banned_edges:
+                continue
+            next_node = row[DESTINATION]
+            if next_node in visited or next_node in banned_nodes:
+                continue
+            next_distance = distance + cost
+            next_legs = legs + 1
+            labels = best.setdefault(next_node, {})
+            if any(labels[used] <= next_distance for used in labels if used <= next_legs):
+                continue
+            labels[next_legs] = next_distance
+            heapq.heappush(heap, (next_distance, next_legs, next_node, path + (row,)))
+    return None
+
+
+# Yen's algorithm: the k cheapest loop-free itineraries with at most max_legs legs
+def k_shortest_paths(adjacency, source, target, k, max_legs, weight):
+    if source == target:
+        return []
+    first = shortest_path(adjacency, source, target, max_legs, weight)
+    if first is None:
+        return []
+    found = [first]
+    seen = {tuple(row[ID] for row in first[1])}
+    candidates = []
+    while len(found) < k:
+        _, previous = found[-1]
+        for spur_index in range(len(previous)):
+            root = previous[:spur_index]
+            root_ids = tuple(row[ID] for row in root)
+            spur_node = previous[spur_index][ORIGIN]
+            banned_edges = {path[spur_index][ID] for _, path in found
+                            if len(path) > spur_index and tuple(row[ID] for row in path[:spur_index]) == root_ids}
+            banned_nodes = {source} | {row[DESTINATION] for row in root}
+            banned_nodes.discard(spur_node)
+            spur = shortest_path(adjacency, spur_node, target, max_legs - spur_index, weight, banned_edges, banned_nodes)
+            if spur is None:
+                continue
+            path = root + spur[1]
+            ids = tuple(row[ID] for row in path)
+            if ids in seen:
+                continue
+            seen.add(ids)
+            heapq.heappush(candidates, (sum(weight(row) for row in path), len(path), ids, path))
+        if not candidates:
+            break
+        distance, _, _, path = heapq.heappop(candidates)
+        found.append((distance, path))
+    return found
+
+
+def itinerary(path):
+    durations = [row[DURATION] for row in path]
+    return {
+        'legs': list(path),
+        'cost': sum(row[COST] for row in path),
+        'duration': None if None in durations else sum(durations),
+        'stops': [row[DESTINATION] for row in path[:-1]],
+    }
+
+
+# The Transport table as a weighted graph with a bounded cache of route
+# queries. Edge changes only drop the cached answers they can affect: a
+# removed edge invalidates the answers that use it, and a new edge the
+# answers it could add a route to (see _changed_by).
+class RouteGraph:
+    def __init__(self, transports=(), max_cached=MAX_CACHED_QUERIES):
+        self.max_cached = max_cached
+        self._edges = {}
+        self._adjacency = {}
+        self._reverse = {}
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._source = None
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        for row in transports:
+            self.add_edge(row)
+
+    def add_edge(self, row):
+        with self._lock:
+            if row[ID] in self._edges:
+                self.remove_edge(row[ID])
+            self._edges[row[ID]] = row
+            # Adjacency lists are replaced, never mutated, so queries can run on a copy of the dict
+            self._adjacency[row[ORIGIN]] = self._adjacency.get(row[ORIGIN], []) + [row]
+            self._version += 1
+            self._reverse.setdefault(row[DESTINATION], set()).add(row[ORIGIN])
+            if self._cache:
+                for key in self._changed_by(row):
+                    del self._cache[key]
+
+    def remove_edge(self, edge_id):
+        with self._lock:
+            row = self._edges.pop(edge_id, None)
+            if row is None:
+                return
+            self._adjacency[row[ORIGIN]] = [edge for edge in self._adjacency[row[ORIGIN]] if edge[ID] != edge_id]
+            self._version += 1
+            if not any(edge[DESTINATION] == row[DESTINATION] for edge in self._adjacency[row[ORIGIN]]):
+                self._reverse[row[DESTINATION]].discard(row[ORIGIN])
+            for key in [key for key, cached in self._cache.items()
+                        if any(edge[ID] == edge_id for route in cached for edge in route['legs'])]:
+                del self._cache[key]
+
+    # Fewest legs from city to each city reachable in at most max_legs legs
+    # (or to city from each city that can reach it, with reverse=True)
+    def _hops(self, city, max_legs, reverse=False):
+        hops = {city: 0}
+        frontier = [city]
+        for legs in range(1, max_legs + 1):
+            reached = []
+            for node in frontier:
+                if reverse:
+                    neighbours = self._reverse.get(node, ())
+                else:
+                    neighbours = (row[DESTINATION] for row in self._adjacency.get(node, ()))
+                for neighbour in neighbours:
+                    if neighbour not in hops:
+                        hops[neighbour] = legs
+                        reached.append(neighbour)
+            frontier = reached
+        return hops
+
+    # Cached answers a new edge can change. A route through the edge needs
+    # the origin to reach its start and its end to reach the destination
+    # within the leg limit, and costs at least the edge's own weight, so a
+    # full answer whose last route is cheaper than that cannot change either.
+    def _changed_by(self, row):
+        max_legs = max(key[3] for key in self._cache)
+        to_start = self._hops(row[ORIGIN], max_legs - 1, reverse=True)
+        from_end = self._hops(row[DESTINATION], max_legs - 1)
+        changed = []
+        for key, cached in self._cache.items():
+            origin, destination, k, legs, sort = key
+            weight = WEIGHTS[sort](row)
+            if weight is None or origin not in to_start or destination not in from_end:
+                continue
+            if to_start[origin] + 1 + from_end[destination] > legs:
+                continue
+            if len(cached) == k and cached[-1][SORT_FIELDS[sort]] < weight:
+                continue
+            changed.append(key)
+        return changed
+
+    # Bring the graph in line with a new list of transport rows, applying only the differences
+    def sync(self, transports):
+        with self._lock:
+            if transports is self._source:
+                return
+            incoming = {row[ID]: row for row in transports}
+            for edge_id in [edge_id for edge_id in self._edges if edge_id not in incoming]:
+                self.remove_edge(edge_id)
+            for edge_id, row in incoming.items():
+                if self._edges.get(edge_id) != row:
+                    self.add_edge(row)
+            self._source = transports
+
+    def routes(self, origin, destination, k=DEFAULT_K, max_legs=DEFAULT_MAX_LEGS, sort='cheapest'):
+        if sort not in WEIGHTS:
+            raise ValueError(f"sort must be one of {', '.join(WEIGHTS)}")
+        key = (origin, destination, k, max_legs, sort)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+            adjacency = dict(self._adjacency)
+            version = self._version
+
+        # Search outside the lock so concurrent queries do not queue behind each other
+        paths = k_shortest_paths(adjacency, origin, destination, k, max_legs, WEIGHTS[sort])
+        result = [itinerary(path) for _, path in paths]
+        with self._lock:
+            # Only cache answers computed against the current graph
+            if version == self._version:
+                self._cache[key] = result
+                if len(self._cache) > self.max_cached:
+                    self._cache.popitem(last=False)
+        return result
+
+    def cities(self):
+        with self._lock:
+            return set(self._adjacency) | set(self._reverse)
+
+    # Warm the cache with the city pairs the fewest legs apart first (direct
+    # connections, then one stop, and so on), skipping pairs with no route,
+    # until limit queries have run: by default PRECOMPUTE_SHARE of the cache,
+    # so the warm-up never evicts its own answers. Returns the queries run.
+    def precompute(self, k=DEFAULT_K, max_legs=DEFAULT_MAX_LEGS, sorts=tuple(WEIGHTS), limit=None):
+        if limit is None:
+            limit = int(self.max_cached * PRECOMPUTE_SHARE)
+        with self._lock:
+            pairs = sorted((legs, origin, destination) for origin in self.cities()
+                           for destination, legs in self._hops(origin, max_legs).items() if destination != origin)
+        queries = 0
+        for _, origin, destination in pairs:
+            for sort in sorts:
+                if queries >= limit:
+                    return queries
+                self.routes(origin, destination, k, max_legs, sort)
+                queries += 1
+        return queries
+
+    # Identifies the edge set; saved answers are only loaded into a graph with the same edges
+    def fingerprint(self):
+        with self._lock:
+            edges = repr(sorted(self._edges.items()))
+        return hashlib.blake2b(edges.encode(), digest_size=12).hexdigest()
+
+    # Write the cached answers to path, so other processes can load them
+    # instead of computing them again
+    def save(self, path):
+        with self._lock:
+            data = {'fingerprint': self.fingerprint(), 'queries': list(self._cache.items())}
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(codec.encode(data, codec.BINARY))
+        os.replace(temporary, path)
+
+    # Load answers written by save() for this same edge set; returns how many
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data, _ = codec.decode(f.read())
+        except (OSError, codec.CodecError):
+            return 0
+        with self._lock:
+            if not isinstance(data, dict) or data.get('fingerprint') != self.fingerprint():
+                return 0
+            for key, result in data['queries']:
+                self._cache[tuple(key)] = result
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return len(data['queries'])
+
+    def stats(self):
+        with self._lock:
+            return {'edges': len(self._edges), 'cached_queries': len(self._cache),
+                    'hits': self.hits, 'misses': self.misses}
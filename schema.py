@@ -0,0 +1,352 @@
+import logging
+import sqlite3
+
+from ids import ulid_time
+
+logger = logging.getLogger('server.schema')
+
+# Stored in PRAGMA user_version. Bump it whenever create_schema changes so
+# existing databases are migrated on the next start; a database already at
+# this version is used as is, however big its catalog.
+SCHEMA_VERSION = 6
+
+# Sample bank accounts, seeded into the BankAccount table the first time the database is created
+bank_accounts = [
+    {'account_number': '12345', 'password': 'pass', 'balance': 100000.00},
+    {'account_number': '54321', 'password': 'pass', 'balance': 50000.00},
+]
+
+# Rooms of each type per hotel in the seed catalog
+ROOM_INVENTORY = {'Single Room': 20, 'Double Room': 15, 'Suite': 5, 'Delux Suite': 2}
+
+# Seed catalog for an empty database (duration in hours)
+SEED_TRANSPORTS = [
+    ('Bus', 30, 'San Francisco', 'Los Angeles', 7.5),
+    ('Train', 110, 'San Francisco', 'Chicago', 52),
+    ('Flight', 290, 'San Francisco', 'New York', 5.5),
+    ('Bus', 60, 'Los Angeles', 'Chicago', 40),
+    ('Train', 210, 'Los Angeles', 'New York', 66),
+    ('Flight', 160, 'Los Angeles', 'San Francisco', 1.5),
+    ('Flight', 240, 'Chicago', 'New York', 2.5),
+    ('Bus', 80, 'Chicago', 'Los Angeles', 41),
+    ('Bus', 80, 'Chicago', 'San Francisco', 48),
+    ('Train', 170, 'New York', 'San Francisco', 80),
+    ('Flight', 210, 'New York', 'Chicago', 2.5),
+    ('Flight', 210, 'New York', 'Los Angeles', 6),
+]
+
+SEED_HOTELS = [
+    ('Luxury Inn', 'San Francisco'),
+    ('Cityscape Hotel', 'San Francisco'),
+    ('Downtown Suites', 'San Francisco'),
+    ('Sunset Suites', 'Los Angeles'),
+    ('Beachside Hotel', 'Los Angeles'),
+    ('Hollywood Heights', 'Los Angeles'),
+    ('Skyline Plaza', 'Chicago'),
+    ('Riverfront Suites', 'Chicago'),
+    ('City Central', 'Chicago'),
+    ('Bay Area Resort', 'New York'),
+    ('Empire State Hotel', 'New York'),
+    ('Urban Retreat', 'New York'),
+]
+
+# (hotel id, room type, cost per night); hotel ids follow SEED_HOTELS
+SEED_ROOM_TYPES = [
+    (1, 'Single Room', 150), (1, 'Double Room', 200), (1, 'Suite', 250), (1, 'Delux Suite', 350),
+    (2, 'Single Room', 80), (2, 'Double Room', 130), (2, 'Suite', 230),
+    (3, 'Single Room', 80), (3, 'Double Room', 130), (3, 'Suite', 230),
+    (4, 'Single Room', 110), (4, 'Double Room', 160), (4, 'Suite', 260), (4, 'Delux Suite', 360),
+    (5, 'Single Room', 95), (5, 'Double Room', 145), (5, 'Suite', 245),
+    (6, 'Single Room', 85), (6, 'Double Room', 135), (6, 'Suite', 235),
+    (7, 'Single Room', 105), (7, 'Double Room', 155), (7, 'Suite', 255), (7, 'Delux Suite', 370),
+    (8, 'Single Room', 75), (8, 'Double Room', 125), (8, 'Suite', 225),
+    (9, 'Single Room', 110), (9, 'Double Room', 160), (9, 'Suite', 260),
+    (10, 'Single Room', 120), (10, 'Double Room', 170), (10, 'Suite', 270), (10, 'Delux Suite', 400),
+    (11, 'Single Room', 130), (11, 'Double Room', 180), (11, 'Suite', 290),
+    (12, 'Single Room', 140), (12, 'Double Room', 190), (12, 'Suite', 300),
+]
+
+CATALOG_TABLES = ('Transport', 'Hotel', 'RoomType')
+
+# BookingRollup keeps booking counts and revenue per UTC day, route, hotel,
+# room type and transport type, updated by triggers as bookings are written,
+# so reports read a table the size of the catalog times the number of days
+# instead of every booking. Dimensions are never NULL ('' stands for a
+# booking without transport, or a day that is not known) so that each
+# combination is exactly one row.
+ROLLUP_DIMENSIONS = [
+    ('day', "COALESCE(date({row}created_at, 'unixepoch'), '')"),
+    ('origin', "COALESCE({row}origin, '')"),
+    ('destination', "COALESCE({row}destination, '')"),
+    ('hotel_name', "COALESCE({row}hotel_name, '')"),
+    ('room_type', "COALESCE({row}room_type, '')"),
+    ('transport_type', "COALESCE({row}transport_type, '')"),
+]
+ROLLUP_MEASURES = [
+    ('bookings', "1"),
+    ('revenue', "COALESCE({row}total_amount, 0)"),
+    ('hotel_revenue', "COALESCE({row}hotel_cost, 0)"),
+    ('transport_revenue', "COALESCE({row}transport_cost, 0)"),
+]
+
+
+# The rollup columns computed from one Bookings row; row is 'NEW.', 'OLD.'
+# or '' for a plain SELECT
+def rollup_values(row=''):
+    return ', '.join(f"{expression.format(row=row)} AS {name}" for name, expression in ROLLUP_DIMENSIONS + ROLLUP_MEASURES)
+
+
+def create_rollup(cursor):
+    dimensions = ', '.join(name for name, _ in ROLLUP_DIMENSIONS)
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS BookingRollup (
+        day TEXT NOT NULL,
+        origin TEXT NOT NULL,
+        destination TEXT NOT NULL,
+        hotel_name TEXT NOT NULL,
+        room_type TEXT NOT NULL,
+        transport_type TEXT NOT NULL,
+        bookings INTEGER NOT NULL,
+        revenue REAL NOT NULL,
+        hotel_revenue REAL NOT NULL,
+        transport_revenue REAL NOT NULL,
+        PRIMARY KEY ({dimensions})
+    ) WITHOUT ROWID
+    ''')
+    add = ', '.join(f"{name} = {name} + excluded.{name}" for name, _ in ROLLUP_MEASURES)
+    subtract = ', '.join(f"{name} = {name} - {expression.format(row='OLD.')}" for name, expression in ROLLUP_MEASURES)
+    match = ' AND '.join(f"{name} = {expression.format(row='OLD.')}" for name, expression in ROLLUP_DIMENSIONS)
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS bookings_rollup_insert AFTER INSERT ON Bookings BEGIN
+        INSERT INTO BookingRollup SELECT {rollup_values('NEW.')}
+        WHERE true ON CONFLICT ({dimensions}) DO UPDATE SET {add};
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS bookings_rollup_delete AFTER DELETE ON Bookings BEGIN
+        UPDATE BookingRollup SET {subtract} WHERE {match};
+        DELETE FROM BookingRollup WHERE bookings <= 0 AND {match};
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS bookings_rollup_update AFTER UPDATE ON Bookings BEGIN
+        UPDATE BookingRollup SET {subtract} WHERE {match};
+        DELETE FROM BookingRollup WHERE bookings <= 0 AND {match};
+        INSERT INTO BookingRollup SELECT {rollup_values('NEW.')}
+        WHERE true ON CONFLICT ({dimensions}) DO UPDATE SET {add};
+    END
+    ''')
+
+
+# Recompute BookingRollup from every booking, e.g. after bookings were
+# written with the triggers missing
+def rebuild_rollup(cursor):
+    dimensions = ', '.join(name for name, _ in ROLLUP_DIMENSIONS)
+    measures = ', '.join(f"SUM({name})" for name, _ in ROLLUP_MEASURES)
+    cursor.execute("DELETE FROM BookingRollup")
+    cursor.execute(f'''
+    INSERT INTO BookingRollup
+    SELECT {dimensions}, {measures} FROM (SELECT {rollup_values()} FROM Bookings)
+    GROUP BY {dimensions}
+    ''')
+
+
+# ChangeLog is the append-only journal read replicas follow: triggers on the
+# replicated tables record every insert and update as an upsert of the whole
+# row (JSON keyed by column) and every delete by id, numbered by seq in commit
+# order. BankAccount is not replicated; payments only run on the primary.
+REPLICATED_TABLES = ('Transport', 'Hotel', 'RoomType', 'Bookings')
+# Unix time with milliseconds, in SQL
+CHANGE_TIME = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def create_change_log(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ChangeLog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        at REAL NOT NULL,
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        data TEXT
+    )
+    ''')
+    # The newest change per table, for the catalog cache's change check
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changelog_table ON ChangeLog(table_name, seq)")
+    # Settings and positions: log_id names this database's log, so a replica
+    # can tell when the log it follows was replaced; replicas also keep the
+    # log they follow and the last seq applied from it
+    cursor.execute("CREATE TABLE IF NOT EXISTS ReplicationState (name TEXT PRIMARY KEY, value)")
+    cursor.execute("INSERT OR IGNORE INTO ReplicationState VALUES ('log_id', lower(hex(randomblob(8))))")
+    for table in REPLICATED_TABLES:
+        # Recreated every time so the row data follows columns added by later versions
+        create_change_log_triggers(cursor, table)
+
+
+def drop_change_log_triggers(cursor, table):
+    for operation in ('insert', 'update', 'delete'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table.lower()}_log_{operation}")
+
+
+def create_change_log_triggers(cursor, table):
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    data = 'json_object({})'.format(', '.join(f"'{column}', NEW.{column}" for column in columns))
+    record = f"INSERT INTO ChangeLog (at, table_name, op, row_id, data) SELECT {CHANGE_TIME}, '{table}'"
+    drop_change_log_triggers(cursor, table)
+    cursor.execute(f'''
+    CREATE TRIGGER {table.lower()}_log_insert AFTER INSERT ON {table} BEGIN
+        {record}, 'upsert', NEW.id, {data};
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER {table.lower()}_log_update AFTER UPDATE ON {table} BEGIN
+        {record}, 'delete', OLD.id, NULL WHERE OLD.id != NEW.id;
+        {record}, 'upsert', NEW.id, {data};
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER {table.lower()}_log_delete AFTER DELETE ON {table} BEGIN
+        {record}, 'delete', OLD.id, NULL;
+    END
+    ''')
+
+
+# Start a new change log for writes the log did not record (such as a bulk
+# import): replicas see the new log_id and copy the tables again
+def restart_change_log(cursor):
+    cursor.execute("DELETE FROM ChangeLog")
+    cursor.execute("UPDATE ReplicationState SET value = lower(hex(randomblob(8))) WHERE name = 'log_id'")
+
+
+# Bring tables created by older versions up to date
+def add_missing_columns(cursor, table, columns):
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for name, column_type in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
+# Create or upgrade every table and index. Idempotent, and never drops data.
+def create_schema(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS Transport (
+        id INTEGER PRIMARY KEY,
+        type TEXT,
+        cost REAL,
+        origin TEXT,
+        destination TEXT,
+        duration REAL
+    )
+    ''')
+    add_missing_columns(cursor, 'Transport', [('duration', 'REAL')])
+    # Route lookups, cheapest first
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transport_route ON Transport(origin, destination, cost)")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS Hotel (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        destination TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_hotel_destination ON Hotel(destination)")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS RoomType (
+        id INTEGER PRIMARY KEY,
+        hotel_id INTEGER,
+        type TEXT,
+        cost REAL,
+        inventory INTEGER,
+        FOREIGN KEY(hotel_id) REFERENCES Hotel(id)
+    )
+    ''')
+    add_missing_columns(cursor, 'RoomType', [('inventory', 'INTEGER')])
+    # Also the index foreign key checks on hotel_id use
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_roomtype_hotel ON RoomType(hotel_id, cost)")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS BankAccount (
+        account_number TEXT PRIMARY KEY,
+        password TEXT,
+        balance REAL CHECK (balance >= 0)
+    )
+    ''')
+    cursor.executemany("INSERT OR IGNORE INTO BankAccount (account_number, password, balance) VALUES (:account_number, :password, :balance)",
+                       bank_accounts)
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS Bookings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        booking_id TEXT,
+        transport_type TEXT,
+        origin TEXT,
+        destination TEXT,
+        transport_cost REAL,
+        hotel_name TEXT,
+        room_type TEXT,
+        hotel_cost REAL,
+        total_amount REAL,
+        room_type_id INTEGER,
+        check_in TEXT,
+        check_out TEXT,
+        idempotency_key TEXT
+    )
+    ''')
+    add_missing_columns(cursor, 'Bookings', [('room_type_id', 'INTEGER'), ('check_in', 'TEXT'), ('check_out', 'TEXT'),
+                                             ('idempotency_key', 'TEXT'), ('created_at', 'REAL')])
+    # Bookings stored before created_at existed: server-assigned IDs carry their creation time
+    cursor.connection.create_function('ulid_time', 1, ulid_time)
+    cursor.execute("UPDATE Bookings SET created_at = ulid_time(booking_id) WHERE created_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_destination ON Bookings(destination)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_hotel_name ON Bookings(hotel_name)")
+    try:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_booking_id ON Bookings(booking_id)")
+    except sqlite3.IntegrityError:
+        # Databases written before booking IDs were unique may hold duplicates
+        logger.warning("Bookings contains duplicate booking IDs; indexing booking_id without a unique constraint")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_booking_id_nonunique ON Bookings(booking_id)")
+    # A retried booking finds the row its first attempt stored; NULL keys are never equal
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_idempotency_key ON Bookings(idempotency_key)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_created_at ON Bookings(created_at)")
+
+    create_rollup(cursor)
+    rebuild_rollup(cursor)
+    create_change_log(cursor)
+
+
+# Seed the sample catalog, but only into a database with no catalog at all:
+# imported data is never mixed with the sample rows
+def seed_catalog(cursor):
+    for table in CATALOG_TABLES:
+        if cursor.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None:
+            return False
+    cursor.executemany("INSERT INTO Transport (type, cost, origin, destination, duration) VALUES (?, ?, ?, ?, ?)", SEED_TRANSPORTS)
+    cursor.executemany("INSERT INTO Hotel (name, destination) VALUES (?, ?)", SEED_HOTELS)
+    cursor.executemany("INSERT INTO RoomType (hotel_id, type, cost, inventory) VALUES (?, ?, ?, ?)",
+                       [(hotel_id, room_type, cost, ROOM_INVENTORY[room_type]) for hotel_id, room_type, cost in SEED_ROOM_TYPES])
+    return True
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Make sure conn's database is at SCHEMA_VERSION. A database already at this
+# version costs one PRAGMA read; otherwise the schema is created or migrated
+# (and the sample catalog seeded into an empty one). Call inside a transaction:
+# user_version is part of the database header, so it commits with the tables.
+# Returns True when anything was changed.
+def ensure_schema(conn, seed=True):
+    version = schema_version(conn)
+    if version == SCHEMA_VERSION:
+        return False
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this server ({SCHEMA_VERSION})")
+    cursor = conn.cursor()
+    create_schema(cursor)
+    if seed and seed_catalog(cursor):
+        logger.info("Seeded the sample catalog")
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    logger.info("Database schema upgraded from version %d to %d", version, SCHEMA_VERSION)
+    return True
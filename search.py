@@ -0,0 +1,122 @@
+import bisect
+import heapq
+import re
+import unicodedata
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+KINDS = ('city', 'hotel')
+# Fuzzy matches must share at least this fraction of their trigrams with the query
+MIN_SIMILARITY = 0.3
+
+# Score bands, best first: the whole name, a prefix of the name, a prefix of
+# one of its words, then trigram similarity (0 to 1) for misspellings
+EXACT = 4.0
+NAME_PREFIX = 3.0
+WORD_PREFIX = 2.0
+
+_SEPARATORS = re.compile(r'[^0-9a-z]+')
+
+
+# Case, accents and punctuation do not matter when matching
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    return _SEPARATORS.sub(' ', text.lower()).strip()
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+# Name search over one catalog snapshot's cities and hotels: sorted name and
+# word lists answer prefix (autocomplete) queries with a binary search, and a
+# trigram index finds misspelt names without comparing the query against
+# every entry. Entries are (kind, hotel id or None, name, city).
+class SearchIndex:
+    def __init__(self, cities, hotels):
+        self.entries = [('city', None, city, city) for city in sorted(cities)]
+        self.entries += [('hotel', row[0], row[1], row[2]) for row in hotels]
+        self.names = [normalize(entry[2]) for entry in self.entries]
+
+        words = []
+        self.trigrams = {}
+        self.trigram_counts = []
+        for entry_id, name in enumerate(self.names):
+            for word in set(name.split()):
+                words.append((word, entry_id))
+            name_trigrams = trigrams(name)
+            self.trigram_counts.append(len(name_trigrams))
+            for trigram in name_trigrams:
+                self.trigrams.setdefault(trigram, []).append(entry_id)
+        words.sort()
+        self.words = words
+        self._word_keys = [word for word, _ in words]
+        self._name_order = sorted(range(len(self.names)), key=self.names.__getitem__)
+        self._sorted_names = [self.names[entry_id] for entry_id in self._name_order]
+
+    def _prefix_matches(self, prefix):
+        index = bisect.bisect_left(self._word_keys, prefix)
+        while index < len(self.words) and self._word_keys[index].startswith(prefix):
+            yield self.words[index][1]
+            index += 1
+
+    def _fuzzy_matches(self, query):
+        query_trigrams = trigrams(query)
+        shared = {}
+        for trigram in query_trigrams:
+            for entry_id in self.trigrams.get(trigram, ()):
+                shared[entry_id] = shared.get(entry_id, 0) + 1
+        for entry_id, count in shared.items():
+            # Dice coefficient of the two trigram sets
+            similarity = 2 * count / (len(query_trigrams) + self.trigram_counts[entry_id])
+            if similarity >= MIN_SIMILARITY:
+                yield entry_id, similarity
+
+    # Best matches for query, best first, as (kind, hotel id, name, city,
+    # score) rows. kinds limits the entry types; city limits hotels to one city.
+    # Each score band is only searched if the better ones did not fill limit,
+    # and names that start with the query come straight off the sorted name
+    # list, so a short, common prefix costs no more than a long one.
+    def search(self, query, kinds=None, limit=DEFAULT_LIMIT, city=None):
+        query = normalize(query)
+        if not query:
+            return []
+        kinds = set(KINDS if kinds is None else kinds)
+        unknown = kinds - set(KINDS)
+        if unknown:
+            raise ValueError(f"Unknown search kinds: {', '.join(sorted(unknown))}")
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        entries = self.entries
+        names = self.names
+
+        def wanted(entry_id):
+            kind, _, _, entry_city = entries[entry_id]
+            return kind in kinds and (city is None or kind != 'hotel' or entry_city == city)
+
+        found = {}
+        index = bisect.bisect_left(self._sorted_names, query)
+        while len(found) < limit and index < len(self._sorted_names) and self._sorted_names[index].startswith(query):
+            entry_id = self._name_order[index]
+            if wanted(entry_id):
+                found[entry_id] = EXACT if names[entry_id] == query else NAME_PREFIX
+            index += 1
+
+        if len(found) < limit:
+            # Every query word starts a word of the name; the last one may be half typed
+            words = query.split()
+            candidates = self._prefix_matches(words[0])
+            for word in words[1:]:
+                candidates = set(candidates).intersection(self._prefix_matches(word))
+            matches = {entry_id for entry_id in candidates if entry_id not in found and wanted(entry_id)}
+            for entry_id in heapq.nsmallest(limit - len(found), matches, key=names.__getitem__):
+                found[entry_id] = WORD_PREFIX
+
+        if len(found) < limit:
+            misspelt = [(similarity, entry_id) for entry_id, similarity in self._fuzzy_matches(query)
+                        if entry_id not in found and wanted(entry_id)]
+            for similarity, entry_id in heapq.nsmallest(limit - len(found), misspelt,
+                                                        key=lambda match: (-match[0], names[match[1]])):
+                found[entry_id] = similarity
+
+        return [entries[entry_id] + (round(score, 3),) for entry_id, score in found.items()]
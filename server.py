@@ -1,259 +1,801 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
 import socket
-import pickle
 import sqlite3
 import threading
-
-# Sample in-memory database of bank accounts
-bank_accounts = [
-    {'account_number': '12345', 'password': 'pass', 'balance': 100000.00},
-    {'account_number': '54321', 'password': 'pass', 'balance': 50000.00},
-]
+import time
+
+import codec
+from admission import (BUSY_RETRY_AFTER, DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_QUEUE, DEFAULT_QUEUE_TIMEOUT,
+                       DEFAULT_READ_TIMEOUT, DEFAULT_WRITE_TIMEOUT, Admission)
+from availability import availability, parse_stay
+from booking_writer import DEFAULT_MAX_BATCH, DEFAULT_MAX_WAIT, configure_writer, get_writer, rollback_listeners
+from catalog_cache import catalog
+from catalog_query import COLUMNS, hotel_rows, page, wants_page
+from db import DB_PATH, configure_pool, get_pool
+from ids import RecentResults, new_id, scoped_key
+from metrics import RateLimitFilter, SamplingProfiler, ServerMetrics, prometheus_text
+from protocol import HEADER, FrameTimeout, send_frame, recv_frame, read_frame_async, write_frame_async
+from replication import DEFAULT_MAX_LAG, DEFAULT_POLL_INTERVAL, DEFAULT_RETENTION, ChangeLogPublisher, Replica
+from routes import DEFAULT_K, DEFAULT_MAX_LEGS, RouteGraph
+from schema import ensure_schema
+from search import DEFAULT_LIMIT as DEFAULT_SEARCH_LIMIT
+
+logger = logging.getLogger('server')
+metrics = ServerMetrics()
+profiler = SamplingProfiler()
+route_graph = RouteGraph()
+# Answers to recent bookings by idempotency key
+completed_bookings = RecentResults()
+# Connection timeouts, the request queue and per-client rate limits
+admission = Admission()
+# The change log this database publishes, and with --replica-of the primary it follows
+publisher = ChangeLogPublisher()
+replica = None
+# A rolled-back write batch may have been counted by the occupancy index
+rollback_listeners.append(availability.reset)
+
+DEFAULT_BACKLOG = 1024
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_DB_WORKERS = 8
+DEFAULT_GRACEFUL_TIMEOUT = 10.0
+MAX_BATCH_SIZE = 100
+MAX_ROUTES = 20
+MAX_LEGS = 6
+PRECOMPUTE_ROUTES = True
+# Prefork workers wait up to this many seconds for the routes the supervisor
+# precomputes instead of each computing their own; 0 computes them here
+SAVED_ROUTES_WAIT = 0.0
 
 # Database setup and functions
 def setup_database():
-    conn = sqlite3.connect('hotel_booking.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("DROP TABLE IF EXISTS Hotel")
-    cursor.execute("DROP TABLE IF EXISTS RoomType")
-    cursor.execute("DROP TABLE IF EXISTS Transport")
-    
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Transport (
-        id INTEGER PRIMARY KEY,
-        type TEXT,
-        cost REAL,
-        origin TEXT,
-        destination TEXT
-    )
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Hotel (
-        id INTEGER PRIMARY KEY,
-        name TEXT,
-        destination TEXT
-    )
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS RoomType (
-        id INTEGER PRIMARY KEY,
-        hotel_id INTEGER,
-        type TEXT,
-        cost REAL,
-        FOREIGN KEY(hotel_id) REFERENCES Hotel(id)
-    )
-    ''')
-
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS Bookings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        booking_id TEXT,
-        transport_type TEXT,
-        origin TEXT,
-        destination TEXT,
-        transport_cost REAL,
-        hotel_name TEXT,
-        room_type TEXT,
-        hotel_cost REAL,
-        total_amount REAL
-    )
-    ''')
-
-    # Insert transport data
-    transports = [
-        ('Bus', 30, 'San Francisco', 'Los Angeles'),
-        ('Train', 110, 'San Francisco', 'Chicago'),
-        ('Flight', 290, 'San Francisco', 'New York'),
-        ('Bus', 60, 'Los Angeles', 'Chicago'),
-        ('Train', 210, 'Los Angeles', 'New York'),
-        ('Flight', 160, 'Los Angeles', 'San Francisco'),
-        ('Flight', 240, 'Chicago', 'New York'),
-        ('Bus', 80, 'Chicago', 'Los Angeles'),
-        ('Bus', 80, 'Chicago', 'San Francisco'),
-        ('Train', 170, 'New York', 'San Francisco'),
-        ('Flight', 210, 'New York', 'Chicago'),
-        ('Flight', 210, 'New York', 'Los Angeles'),
-    ]
-    cursor.executemany("INSERT OR IGNORE INTO Transport (type, cost, origin, destination) VALUES (?, ?, ?, ?)", transports)
-
-    # Insert hotel data
-    hotels = [
-        ('Luxury Inn', 'San Francisco'),
-        ('Cityscape Hotel', 'San Francisco'),
-        ('Downtown Suites', 'San Francisco'),
-        ('Sunset Suites', 'Los Angeles'),
-        ('Beachside Hotel', 'Los Angeles'),
-        ('Hollywood Heights', 'Los Angeles'),
-        ('Skyline Plaza', 'Chicago'),
-        ('Riverfront Suites', 'Chicago'),
-        ('City Central', 'Chicago'),
-        ('Bay Area Resort', 'New York'),
-        ('Empire State Hotel', 'New York'),
-        ('Urban Retreat', 'New York'),
-    ]
-    cursor.executemany("INSERT OR IGNORE INTO Hotel (name, destination) VALUES (?, ?)", hotels)
-
-    # Insert room types data
-    room_types = [
-        (1, 'Single Room', 150), (1, 'Double Room', 200), (1, 'Suite', 250), (1, 'Delux Suite', 350),
-        (2, 'Single Room', 80), (2, 'Double Room', 130), (2, 'Suite', 230),
-        (3, 'Single Room', 80), (3, 'Double Room', 130), (3, 'Suite', 230),
-        (4, 'Single Room', 110), (4, 'Double Room', 160), (4, 'Suite', 260), (4, 'Delux Suite', 360),
-        (5, 'Single Room', 95), (5, 'Double Room', 145), (5, 'Suite', 245),
-        (6, 'Single Room', 85), (6, 'Double Room', 135), (6, 'Suite', 235),
-        (7, 'Single Room', 105), (7, 'Double Room', 155), (7, 'Suite', 255), (7, 'Delux Suite', 370),
-        (8, 'Single Room', 75), (8, 'Double Room', 125), (8, 'Suite', 225),
-        (9, 'Single Room', 110), (9, 'Double Room', 160), (9, 'Suite', 260),
-        (10, 'Single Room', 120), (10, 'Double Room', 170), (10, 'Suite', 270), (10, 'Delux Suite', 400),
-        (11, 'Single Room', 130), (11, 'Double Room', 180), (11, 'Suite', 290),
-        (12, 'Single Room', 140), (12, 'Double Room', 190), (12, 'Suite', 300),
-    ]
-
-    cursor.executemany("INSERT INTO RoomType (hotel_id, type, cost) VALUES (?, ?, ?)", room_types)
-
-    conn.commit()
-    conn.close()
+    # A replica's catalog comes from its primary, never from the sample data
+    with get_pool().transaction() as conn:
+        ensure_schema(conn, seed=replica is None)
+
+    catalog.invalidate()
+    availability.reset()
 
 def validate_bank_credentials(account_number, password):
-    for account in bank_accounts:
-        if account['account_number'] == account_number and account['password'] == password:
-            return account
-    return None
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT account_number, password, balance FROM BankAccount WHERE account_number=? AND password=?",
+                           (account_number, password)).fetchone()
+    if row is None:
+        return None
+    return {'account_number': row[0], 'password': row[1], 'balance': row[2]}
+
+def credentials_match(conn, account_number, password):
+    return conn.execute("SELECT 1 FROM BankAccount WHERE account_number=? AND password=?",
+                        (account_number, password)).fetchone() is not None
 
 def has_sufficient_balance(account, total_amount):
     return account['balance'] >= total_amount
 
+def _validate_amount(total_amount):
+    if isinstance(total_amount, bool) or not isinstance(total_amount, (int, float)) or not total_amount >= 0:
+        raise ValueError(f"Invalid payment amount: {total_amount!r}")
+
+# Check and debit in a single statement; returns False when the credentials
+# are wrong or the balance would go negative
+def debit_account(conn, account_number, password, total_amount):
+    cursor = conn.execute(
+        "UPDATE BankAccount SET balance = balance - ? WHERE account_number=? AND password=? AND balance >= ?",
+        (total_amount, account_number, password, total_amount))
+    return cursor.rowcount == 1
+
+# Writes go through the group-commit writer (booking_writer.py): concurrent
+# requests share one transaction and one fsync, and each call returns once its
+# batch has committed
 def process_payment(request):
     account_number = request.get('account_number')
     password = request.get('password')
     total_amount = request.get('total_amount')
+    _validate_amount(total_amount)
 
-    account = validate_bank_credentials(account_number, password)
-    if account and has_sufficient_balance(account, total_amount):
-        account['balance'] -= total_amount
+    paid = get_writer().run(lambda conn: debit_account(conn, account_number, password, total_amount))
+    if paid:
         return {'status': 'success'}
     else:
         return {'status': 'failure', 'message': 'Invalid account credentials or insufficient balance'}
 
+# Debit the account and record the booking in one transaction: either both
+# happen or neither does. Retries carrying the same idempotency_key get the
+# first attempt's answer and never debit twice; the key is scoped to the
+# account, and the answer only given back once its credentials check out.
+def book_and_pay(request):
+    account_number = request.get('account_number')
+    password = request.get('password')
+    booking_details = prepare_booking(request, account_number)
+    key = booking_details['idempotency_key']
+    _validate_amount(booking_details['total_amount'])
+    if key is not None:
+        result = completed_bookings.get(key)
+        if result is not None:
+            with get_pool().connection() as conn:
+                if not credentials_match(conn, account_number, password):
+                    return {'status': 'failure', 'message': 'Invalid account credentials'}
+            return result
+
+    def job(conn):
+        result = find_booking_result(conn, key)
+        if result is not None:
+            if not credentials_match(conn, account_number, password):
+                return {'status': 'failure', 'message': 'Invalid account credentials'}
+            return result
+        if not room_available(conn, booking_details):
+            return {'status': 'failure', 'message': 'The selected room is not available for those dates'}
+        if not debit_account(conn, account_number, password, booking_details['total_amount']):
+            return {'status': 'failure', 'message': 'Invalid account credentials or insufficient balance'}
+        return insert_booking(conn, booking_details)
+
+    result = get_writer().run(job)
+    if result['status'] != 'success':
+        return result
+    return booking_stored(key, result)
+
+# Catalog reads are answered from the in-memory catalog cache
 def get_available_cities():
-    conn = sqlite3.connect('hotel_booking.db')
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT DISTINCT origin FROM Transport")
-    origin_cities = [row[0] for row in cursor.fetchall()]
-    cursor.execute("SELECT DISTINCT destination FROM Transport")
-    destination_cities = [row[0] for row in cursor.fetchall()]
-    cursor.execute("SELECT DISTINCT destination FROM Hotel")
-    hotel_cities = [row[0] for row in cursor.fetchall()]
-
-    all_cities = set(origin_cities + destination_cities + hotel_cities)
-    conn.close()
-    
-    return list(all_cities)
-
-def get_transport_options(origin, destination):
-    conn = sqlite3.connect('hotel_booking.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Transport WHERE origin=? AND destination=?", (origin, destination))
-    transport_options = cursor.fetchall()
-    conn.close()
-    return transport_options
-
-def get_hotel_options(destination):
-    conn = sqlite3.connect('hotel_booking.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Hotel WHERE destination=?", (destination,))
-    hotel_options = cursor.fetchall()
-    conn.close()
-    return hotel_options
-
-def get_room_types(hotel_id):
-    conn = sqlite3.connect('hotel_booking.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM RoomType WHERE hotel_id=?", (hotel_id,))
-    room_types = cursor.fetchall()
-    conn.close()
-    return room_types
-
-def save_booking(booking_details):
+    return catalog.cities()
+
+# Cities and hotels whose names match query, best first; see search.py
+def search_catalog(query, kinds=None, limit=DEFAULT_SEARCH_LIMIT, city=None):
+    return catalog.search(query, kinds, limit, city)
+
+# The three list actions below return every matching row, or, when the
+# request carries any of catalog_query.PAGE_OPTIONS, one page of it with
+# projection, price filters, sorting and a cursor for the next page
+def get_transport_options(origin, destination, query=None):
+    if query is None or not wants_page(query):
+        return catalog.transports(origin, destination)
+    snapshot = catalog.snapshot()
+    rows = snapshot.transports_by_route.get(origin, {}).get(destination, ())
+    return page(snapshot, 'transports', (origin, destination), rows, query)
+
+# With check_in/check_out only hotels with a free room for the whole stay are returned
+def get_hotel_options(destination, check_in=None, check_out=None, query=None):
+    dated = check_in is not None or check_out is not None
+    if query is not None and wants_page(query):
+        snapshot = catalog.snapshot()
+        extend = (lambda hotel: hotel if get_room_types(hotel[0], check_in, check_out) else None) if dated else None
+        return page(snapshot, 'hotels', destination, hotel_rows(snapshot, destination), query, extend)
+    hotels = catalog.hotels(destination)
+    if not dated:
+        return hotels
+    return [hotel for hotel in hotels if get_room_types(hotel[0], check_in, check_out)]
+
+# With check_in/check_out only room types free for the whole stay are
+# returned, each row extended with the number of rooms still available
+def get_room_types(hotel_id, check_in=None, check_out=None, query=None):
+    paged = query is not None and wants_page(query)
+    if paged:
+        snapshot = catalog.snapshot()
+        room_types = snapshot.room_types_by_hotel.get(hotel_id, ())
+    else:
+        room_types = catalog.room_types(hotel_id)
+    if check_in is None and check_out is None:
+        if paged:
+            return page(snapshot, 'room_types', hotel_id, room_types, query,
+                        columns=COLUMNS['room_types'][:-1])
+        return room_types
+    first, end = parse_stay(check_in, check_out)
+    availability.refresh()
+
+    def with_free_rooms(row):
+        free = availability.available(row[0], row[4], first, end)
+        return row + (free,) if free is None or free > 0 else None
+
+    if paged:
+        return page(snapshot, 'room_types', hotel_id, room_types, query, with_free_rooms)
+    return [row for row in map(with_free_rooms, room_types) if row is not None]
+
+# Up to k itineraries from origin to destination with at most max_legs legs,
+# sorted 'cheapest' or 'fastest'. The route graph follows the catalog cache.
+def get_routes(origin, destination, k=DEFAULT_K, max_legs=DEFAULT_MAX_LEGS, sort='cheapest'):
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_ROUTES:
+        raise ValueError(f"k must be between 1 and {MAX_ROUTES}")
+    if isinstance(max_legs, bool) or not isinstance(max_legs, int) or not 1 <= max_legs <= MAX_LEGS:
+        raise ValueError(f"max_legs must be between 1 and {MAX_LEGS}")
+    route_graph.sync(catalog.snapshot().transports)
+    return route_graph.routes(origin, destination, k, max_legs, sort)
+
+# Precomputed routes are saved next to the database, so prefork workers and
+# restarts over the same transports load them rather than computing them again
+def routes_path():
+    return get_pool().path + '.routes'
+
+def precompute_routes(wait=0.0):
+    started = time.perf_counter()
+    deadline = time.monotonic() + wait
+    while True:
+        route_graph.sync(catalog.snapshot().transports)
+        loaded = route_graph.load(routes_path())
+        if loaded:
+            logger.info("Loaded %d saved routes in %.3fs", loaded, time.perf_counter() - started)
+            return
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(1.0)
+    if wait:
+        logger.warning("No saved routes after %.0fs; routes are computed as they are asked for", wait)
+        return
+    queries = route_graph.precompute()
+    route_graph.save(routes_path())
+    logger.info("Precomputed %d routes in %.1fs: %s", queries, time.perf_counter() - started, route_graph.stats())
+
+# Everything the client needs to pick a trip, in one response. room_types is
+# parallel to hotels: room_types[i] lists the rooms of hotels[i].
+def search_trip(origin, destination, check_in=None, check_out=None):
+    hotels = get_hotel_options(destination, check_in, check_out)
+    return {
+        'transports': get_transport_options(origin, destination) if origin != destination else [],
+        'hotels': hotels,
+        'room_types': [get_room_types(hotel[0], check_in, check_out) for hotel in hotels],
+    }
+
+# Run each sub-request in order; a failing sub-request yields a failure result
+# without stopping the rest of the batch
+def run_batch(requests):
+    if len(requests) > MAX_BATCH_SIZE:
+        return {'status': 'failure', 'message': f"Batch of {len(requests)} requests exceeds the limit of {MAX_BATCH_SIZE}"}
+    results = []
+    for request in requests:
+        if request.get('action') == 'batch':
+            results.append({'status': 'failure', 'message': "Batches cannot be nested"})
+            continue
+        try:
+            results.append(handle_request(request))
+        except Exception as e:
+            results.append({'status': 'failure', 'message': str(e)})
+    return results
+
+# Copy of the request's booking with a server-assigned ID (unless the client
+# chose one) and the request's idempotency key, scoped to the paying account,
+# or for unpaid bookings to the booking as sent
+def prepare_booking(request, account_number=None):
+    booking_details = dict(request['booking'])
+    key = request.get('idempotency_key', booking_details.get('idempotency_key'))
+    if account_number is not None:
+        key = scoped_key(key, 'account', account_number)
+    else:
+        key = scoped_key(key, 'booking', sorted(booking_details.items()))
+    if booking_details.get('booking_id') is None:
+        booking_details['booking_id'] = new_id()
+    booking_details['idempotency_key'] = key
+    return booking_details
+
+# The answer for a booking already stored under this idempotency key, if any
+def find_booking_result(conn, key):
+    if key is None:
+        return None
+    row = conn.execute("SELECT booking_id FROM Bookings WHERE idempotency_key=?", (key,)).fetchone()
+    if row is None:
+        return None
+    return {'status': 'success', 'booking_id': row[0]}
+
+def insert_booking(conn, booking_details):
     try:
-        conn = sqlite3.connect('hotel_booking.db')
-        cursor = conn.cursor()
-        cursor.execute(''' 
-        INSERT INTO Bookings (booking_id, transport_type, origin, destination, transport_cost, hotel_name, room_type, hotel_cost, total_amount)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        conn.execute('''
+        INSERT INTO Bookings (booking_id, transport_type, origin, destination, transport_cost, hotel_name, room_type, hotel_cost, total_amount,
+                              room_type_id, check_in, check_out, idempotency_key, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (booking_details['booking_id'], booking_details['transport_type'], booking_details['origin'], booking_details['destination'],
-              booking_details['transport_cost'], booking_details['hotel_name'], booking_details['room_type'], booking_details['hotel_cost'], booking_details['total_amount']))
-        conn.commit()
-    except Exception as e:
-        print(f"Database error: {e}")
-    finally:
-        conn.close()
+              booking_details['transport_cost'], booking_details['hotel_name'], booking_details['room_type'], booking_details['hotel_cost'], booking_details['total_amount'],
+              booking_details.get('room_type_id'), booking_details.get('check_in'), booking_details.get('check_out'),
+              booking_details.get('idempotency_key'), time.time()))
+    except sqlite3.IntegrityError as e:
+        if 'booking_id' in str(e):
+            raise ValueError(f"Booking ID {booking_details['booking_id']!r} already exists")
+        raise
+    return {'status': 'success', 'booking_id': booking_details['booking_id']}
+
+# Bookings are answered from here once committed: the occupancy index is
+# brought up to date and the answer remembered for retries
+def booking_stored(key, result):
+    availability.refresh(max_age=0)
+    if key is not None:
+        completed_bookings.put(key, result)
+    return result
+
+# Capacity check for a dated booking, run inside the caller's write
+# transaction so no other booking can slip in between the check and the insert.
+# Bookings without dates predate room inventory and are not checked.
+def room_available(conn, booking_details):
+    check_in = booking_details.get('check_in')
+    check_out = booking_details.get('check_out')
+    if check_in is None and check_out is None:
+        return True
+    first, end = parse_stay(check_in, check_out)
+    room = catalog.room_type(booking_details.get('room_type_id'))
+    if room is None:
+        raise ValueError(f"Unknown room type: {booking_details.get('room_type_id')!r}")
+    availability.catch_up(conn)
+    free = availability.available(room[0], room[4], first, end)
+    return free is None or free > 0
+
+# Store a booking without payment. Failures, database errors included, reach
+# the client as a failure response instead of being reported as success.
+def save_booking(request):
+    booking_details = prepare_booking(request)
+    key = booking_details['idempotency_key']
+    if key is not None:
+        result = completed_bookings.get(key)
+        if result is not None:
+            return result
+
+    def job(conn):
+        result = find_booking_result(conn, key)
+        if result is not None:
+            return result
+        if not room_available(conn, booking_details):
+            raise ValueError("The selected room is not available for those dates")
+        return insert_booking(conn, booking_details)
+
+    return booking_stored(key, get_writer().run(job))
+
+# Answers that depend on nothing but the catalog (for the availability-aware
+# actions: only when no dates are given) can be revalidated with its etag
+CATALOG_ACTIONS = {'fetch_cities', 'fetch_transports', 'fetch_routes', 'search'}
+UNDATED_CATALOG_ACTIONS = {'fetch_hotels', 'fetch_room_types', 'search_trip'}
+
+def catalog_etag(request):
+    action = request.get('action')
+    if action in CATALOG_ACTIONS or (action in UNDATED_CATALOG_ACTIONS
+                                     and request.get('check_in') is None and request.get('check_out') is None):
+        return catalog.snapshot().etag
+    return None
 
-def handle_client(conn):
-    with conn:
+# A request carrying if_none_match (None on a first fetch) gets its result
+# wrapped with the catalog etag, or just {'status': 'not_modified'} when the
+# client's copy is still current. etag is None for uncacheable answers.
+def handle_conditional(request):
+    request = dict(request)
+    if_none_match = request.pop('if_none_match')
+    # Taken before the result, so a catalog reload in between can only make the tag look stale
+    etag = catalog_etag(request)
+    if etag is not None and if_none_match == etag:
+        return {'status': 'not_modified', 'etag': etag}
+    result = handle_request(request)
+    if isinstance(result, dict) and result.get('status') == 'failure':
+        return result
+    return {'status': 'success', 'etag': etag, 'result': result}
+
+# The actions handle_request runs; metrics record any other name as 'unknown'
+ACTIONS = {'fetch_cities', 'fetch_transports', 'fetch_hotels', 'fetch_room_types', 'fetch_routes', 'search',
+           'search_trip', 'batch', 'stats', 'process_payment', 'book_and_pay', 'save_booking',
+           'fetch_changes', 'fetch_snapshot'}
+
+def handle_request(request):
+    action = request.get('action')
+    if replica is not None:
+        refusal = replica.refusal(action)
+        if refusal is not None:
+            return refusal
+
+    if 'if_none_match' in request:
+        return handle_conditional(request)
+
+    if action == 'fetch_cities':
+        return get_available_cities()
+
+    elif action == 'fetch_transports':
+        return get_transport_options(request['origin'], request['destination'], request)
+
+    elif action == 'fetch_hotels':
+        return get_hotel_options(request['destination'], request.get('check_in'), request.get('check_out'), request)
+
+    elif action == 'fetch_room_types':
+        return get_room_types(request['hotel_id'], request.get('check_in'), request.get('check_out'), request)
+
+    elif action == 'fetch_routes':
+        return get_routes(request['origin'], request['destination'], request.get('k', DEFAULT_K),
+                          request.get('max_legs', DEFAULT_MAX_LEGS), request.get('sort', 'cheapest'))
+
+    elif action == 'search':
+        return search_catalog(request['query'], request.get('kinds'), request.get('limit', DEFAULT_SEARCH_LIMIT),
+                              request.get('city'))
+
+    elif action == 'search_trip':
+        return search_trip(request['origin'], request['destination'], request.get('check_in'), request.get('check_out'))
+
+    elif action == 'batch':
+        return run_batch(request['requests'])
+
+    elif action == 'stats':
+        return server_stats(request.get('format'), request.get('profile', False))
+
+    elif action == 'process_payment':
+        return process_payment(request)
+
+    elif action == 'book_and_pay':
+        return book_and_pay(request)
+
+    elif action == 'save_booking':
+        return save_booking(request)
+
+    elif action == 'fetch_changes':
+        return publisher.changes(request)
+
+    elif action == 'fetch_snapshot':
+        return publisher.snapshot(request)
+
+    return {'status': 'failure', 'message': f"Unknown action: {action}"}
+
+# Decode one request frame, run it and encode the response frame in the
+# codec the client used
+def respond(payload):
+    started = time.perf_counter()
+    # Unknown codec bytes get their error message back as JSON, the most portable choice
+    reply_codec = payload[0] if payload and payload[0] in codec.CODEC_NAMES else codec.JSON
+    action = 'invalid'
+    handler_seconds = 0.0
+    try:
+        request, reply_codec = codec.decode(payload)
+        action = request.get('action')
+        # Names come from clients: only known ones get their own metrics series
+        action = action if isinstance(action, str) and action in ACTIONS else 'unknown'
+        logger.debug("Received request: %r", request)
+        handler_started = time.perf_counter()
         try:
-            request = pickle.loads(receive_all(conn))
-            print(f"Received request: {request}")
-
-            if request['action'] == 'fetch_cities':
-                cities = get_available_cities()
-                conn.sendall(pickle.dumps(cities))
-                print(f"Sent response: {cities}")
-
-            elif request['action'] == 'fetch_transports':
-                transport_options = get_transport_options(request['origin'], request['destination'])
-                conn.sendall(pickle.dumps(transport_options))
-                print(f"Sent response: {transport_options}")
-
-            elif request['action'] == 'fetch_hotels':
-                hotel_options = get_hotel_options(request['destination'])
-                conn.sendall(pickle.dumps(hotel_options))
-                print(f"Sent response: {hotel_options}")
-
-            elif request['action'] == 'fetch_room_types':
-                room_types = get_room_types(request['hotel_id'])
-                conn.sendall(pickle.dumps(room_types))
-                print(f"Sent response: {room_types}")
-
-            elif request['action'] == 'process_payment':
-                result = process_payment(request)
-                conn.sendall(pickle.dumps(result))
-                print(f"Sent response: {result}")
-
-            elif request['action'] == 'save_booking':
-                booking_details = request['booking']
-                save_booking(booking_details)
-                response = {'status': 'success'}
-                conn.sendall(pickle.dumps(response))
-                print(f"Sent response: {response}")
-
-        except Exception as e:
-            print(f"Error handling client: {e}")
-            conn.sendall(pickle.dumps({'status': 'failure', 'message': str(e)}))
+            if profiler.should_sample():
+                response = profiler.run(handle_request, request)
+            else:
+                response = handle_request(request)
+        finally:
+            handler_seconds = time.perf_counter() - handler_started
+    except Exception as e:
+        logger.warning("Error handling client: %s", e)
+        response = {'status': 'failure', 'message': str(e)}
+    logger.debug("Sent response: %r", response)
+    try:
+        data = codec.encode(response, reply_codec)
+    except codec.CodecError as e:
+        logger.error("Error encoding response: %s", e)
+        response = {'status': 'failure', 'message': str(e)}
+        data = codec.encode(response, reply_codec)
+
+    error = isinstance(response, dict) and response.get('status') == 'failure'
+    codec_seconds = time.perf_counter() - started - handler_seconds
+    metrics.record(action, len(payload) + HEADER.size, len(data) + HEADER.size, handler_seconds, codec_seconds, error)
+    return data
 
-def receive_all(sock, buffer_size=4096):
-    data = b''
-    while True:
-        part = sock.recv(buffer_size)
-        data += part
-        if len(part) < buffer_size:
-            break
+SHED_MESSAGES = {
+    'busy': "Server busy; retry later",
+    'rate_limited': "Too many requests; slow down",
+}
+
+# Answer a request that was not run, without decoding it. Nothing the request
+# asked for has happened, so the client may always send it again.
+def shed(payload, code, retry_after=BUSY_RETRY_AFTER):
+    reply_codec = payload[0] if payload and payload[0] in codec.CODEC_NAMES else codec.JSON
+    response = {'status': 'failure', 'code': code, 'message': SHED_MESSAGES[code], 'retry_after': retry_after}
+    data = codec.encode(response, reply_codec)
+    metrics.record(code, len(payload) + HEADER.size, len(data) + HEADER.size, 0.0, 0.0, True)
     return data
 
-def start_server():
+def server_stats(output_format=None, include_profile=False):
+    snapshot = metrics.snapshot()
+    snapshot['pid'] = os.getpid()
+    snapshot['pool'] = get_pool().stats()
+    snapshot['catalog'] = catalog.stats()
+    snapshot['routes'] = route_graph.stats()
+    snapshot['idempotency'] = completed_bookings.stats()
+    snapshot['writer'] = get_writer().stats()
+    snapshot['admission'] = admission.stats()
+    snapshot['replication'] = publisher.stats()
+    if replica is not None:
+        snapshot['replication'].update(replica.stats())
+    if output_format == 'prometheus':
+        return prometheus_text(snapshot, gauges={'pool': snapshot['pool'], 'catalog': snapshot['catalog'],
+                                                 'routes': snapshot['routes'], 'idempotency': snapshot['idempotency'],
+                                                 'writer': snapshot['writer'], 'admission': snapshot['admission'],
+                                                 'replication': snapshot['replication']})
+    if include_profile:
+        snapshot['profile'] = profiler.report()
+    return snapshot
+
+# The rate-limited reply if client is over its request rate, else None
+def throttled(payload, client):
+    retry_after = admission.throttle(client)
+    return shed(payload, 'rate_limited', retry_after) if retry_after else None
+
+# Serve requests on one connection until the client closes it, goes quiet
+# for the idle timeout or stalls in the middle of a frame
+def handle_client(conn, client, requests):
+    metrics.connection_opened()
+    with conn:
+        try:
+            while True:
+                conn.settimeout(admission.idle_timeout)
+                try:
+                    payload = recv_frame(conn, admission.read_timeout)
+                except FrameTimeout:
+                    admission.count('read_timeouts')
+                    break
+                except socket.timeout:
+                    admission.count('idle_closed')
+                    break
+                if payload is None:
+                    break
+                response = throttled(payload, client) or requests.call(payload)
+                conn.settimeout(admission.write_timeout)
+                try:
+                    send_frame(conn, response)
+                except socket.timeout:
+                    admission.count('write_timeouts')
+                    break
+        except (ConnectionError, OSError) as e:
+            logger.info("Connection error: %s", e)
+        finally:
+            metrics.connection_closed()
+
+# Busy reply frame for a connection turned away before any request was read
+def refusal():
+    admission.count('refused')
+    data = codec.encode({'status': 'failure', 'code': 'busy', 'message': SHED_MESSAGES['busy'],
+                         'retry_after': BUSY_RETRY_AFTER}, codec.JSON)
+    return HEADER.pack(len(data)) + data
+
+# Turn away a connection over the limit: answer with a busy reply and close.
+# Whatever the client already sent is read first so the close is not a reset
+# that could discard the reply.
+def refuse(conn):
+    with conn:
+        try:
+            conn.setblocking(False)
+            try:
+                conn.recv(65536)
+            except BlockingIOError:
+                pass
+            conn.send(refusal())
+        except OSError:
+            pass
+
+# Load the catalog, occupancy index and route cache ahead of the first
+# requests. Runs in the background so the listener is up immediately; early
+# reads simply wait for (or perform) the same catalog load.
+def warm_up():
+    started = time.perf_counter()
+    snapshot = catalog.snapshot()
+    snapshot.search_index  # built now rather than by the first search
+    availability.refresh(max_age=0)
+    logger.info("Catalog loaded in %.3fs", time.perf_counter() - started)
+    if PRECOMPUTE_ROUTES:
+        precompute_routes(SAVED_ROUTES_WAIT)
+
+def start_warm_up():
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+# Trim the change log in the background and, on a replica, start following the primary
+def start_replication():
+    publisher.start_pruning()
+    if replica is not None:
+        replica.start()
+
+# Threaded server: one thread reads and writes each connection, up to
+# max_connections of them, and db_workers threads run the requests
+def start_server(host='127.0.0.1', port=12345, backlog=DEFAULT_BACKLOG,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, db_workers=DEFAULT_DB_WORKERS):
     setup_database()
+    start_replication()
+    start_warm_up()
+    requests = admission.start(respond, shed, db_workers)
+    connection_slots = threading.BoundedSemaphore(max_connections)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('127.0.0.1', 12345))
-    server_socket.listen(5)
-    print("Server started and listening for connections.")
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    logger.info("Server started and listening for connections.")
+
+    def serve(conn, client):
+        try:
+            handle_client(conn, client, requests)
+        finally:
+            connection_slots.release()
 
     while True:
         conn, addr = server_socket.accept()
-        print(f"Connected by {addr}")
-        threading.Thread(target=handle_client, args=(conn,)).start()
+        logger.debug("Connected by %s", addr)
+        if not connection_slots.acquire(blocking=False):
+            refuse(conn)
+            continue
+        threading.Thread(target=serve, args=(conn, addr[0]), daemon=True).start()
+
+# asyncio server: one event loop multiplexes every connection and blocking
+# SQLite work runs in a bounded thread pool so the loop never stalls.
+# connections maps each connection's writer to whether a request on it is
+# being handled, so a drain can close the idle ones straight away.
+async def handle_client_async(reader, writer, requests, connections, stopping):
+    metrics.connection_opened()
+    connections[writer] = False
+    peer = writer.get_extra_info('peername')
+    client = peer[0] if isinstance(peer, tuple) else peer
+    try:
+        while not stopping.is_set():
+            try:
+                payload = await read_frame_async(reader, admission.idle_timeout, admission.read_timeout)
+            except FrameTimeout:
+                admission.count('read_timeouts')
+                break
+            except asyncio.TimeoutError:
+                admission.count('idle_closed')
+                break
+            if payload is None:
+                break
+            connections[writer] = True
+            response = throttled(payload, client) or await asyncio.wrap_future(requests.submit(payload))
+            try:
+                await asyncio.wait_for(write_frame_async(writer, response), admission.write_timeout)
+            except asyncio.TimeoutError:
+                admission.count('write_timeouts')
+                break
+            connections[writer] = False
+    except (ConnectionError, OSError) as e:
+        logger.info("Connection error: %s", e)
+    finally:
+        connections.pop(writer, None)
+        metrics.connection_closed()
+        writer.close()
+
+# Serves until SIGTERM, then drains: stops accepting, closes idle connections,
+# lets requests in progress finish for up to graceful_timeout seconds and
+# returns. sock serves an already listening socket instead of binding one;
+# on_listening is called once the server accepts connections.
+async def serve_async(host='127.0.0.1', port=12345, backlog=DEFAULT_BACKLOG,
+                      max_connections=DEFAULT_MAX_CONNECTIONS, db_workers=DEFAULT_DB_WORKERS,
+                      sock=None, reuse_port=False, graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT, on_listening=None):
+    loop = asyncio.get_running_loop()
+    requests = admission.start(respond, shed, db_workers)
+    connections = {}
+    stopping = asyncio.Event()
+
+    async def on_connect(reader, writer):
+        if stopping.is_set():
+            writer.close()
+            return
+        if len(connections) >= max_connections:
+            # Over the cap: busy reply and close, as in the threaded server
+            writer.write(refusal())
+            writer.close()
+            return
+        await handle_client_async(reader, writer, requests, connections, stopping)
+
+    if sock is not None:
+        server = await asyncio.start_server(on_connect, sock=sock, backlog=backlog)
+    else:
+        server = await asyncio.start_server(on_connect, host, port, backlog=backlog, reuse_address=True,
+                                            reuse_port=reuse_port)
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    except (NotImplementedError, RuntimeError):
+        pass  # not the main thread, or no signal support on this platform
+    logger.info("Async server started and listening for connections.")
+    if on_listening is not None:
+        on_listening()
+    try:
+        await stopping.wait()
+        server.close()
+        for writer, busy in list(connections.items()):
+            if not busy:
+                writer.close()
+        deadline = loop.time() + graceful_timeout
+        while connections and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if connections:
+            logger.warning("Closing %d connections still busy after %.1fs", len(connections), graceful_timeout)
+        logger.info("Async server stopped.")
+    finally:
+        server.close()
+        requests.shutdown(wait=False)
+
+def start_async_server(host='127.0.0.1', port=12345, backlog=DEFAULT_BACKLOG,
+                       max_connections=DEFAULT_MAX_CONNECTIONS, db_workers=DEFAULT_DB_WORKERS,
+                       graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT):
+    setup_database()
+    start_replication()
+    start_warm_up()
+    asyncio.run(serve_async(host, port, backlog, max_connections, db_workers, graceful_timeout=graceful_timeout))
+
+def configure_logging(level='INFO', rate=20.0):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    handler.addFilter(RateLimitFilter(rate, burst=max(1, int(rate * 2))))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+
+# Apply the command-line options that are module settings rather than arguments
+def configure(args):
+    global PRECOMPUTE_ROUTES, admission, publisher, replica
+    configure_logging(args.log_level, args.log_rate)
+    profiler.every = args.profile_every
+    PRECOMPUTE_ROUTES = not args.no_precompute_routes
+    codec.ALLOW_PICKLE = not args.no_pickle
+    configure_writer(max_batch=args.write_batch, max_wait=args.write_wait / 1000)
+    admission = Admission(args.idle_timeout, args.read_timeout, args.write_timeout, args.max_queue,
+                          args.queue_timeout, args.client_rate, args.client_burst)
+    configure_pool(args.db)
+    publisher = ChangeLogPublisher(args.change_log_retention, args.replication_secret)
+    if args.replica_of:
+        replica = Replica(args.replica_of, f"{args.host}:{args.port}", args.poll_interval, args.max_lag,
+                          secret=args.replication_secret)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hotel booking server")
+    parser.add_argument('--mode', choices=['threaded', 'async', 'prefork'], default='threaded',
+                        help="prefork runs --workers async server processes on the same port")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG)
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="connections served at once per process; more get a busy reply")
+    parser.add_argument('--db-workers', type=int, default=DEFAULT_DB_WORKERS,
+                        help="threads running requests per process")
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help="requests waiting for a worker beyond those running; more get a busy reply")
+    parser.add_argument('--queue-timeout', type=float, default=DEFAULT_QUEUE_TIMEOUT,
+                        help="seconds a request may wait for a worker before it is shed (0 disables)")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="seconds a connection may wait between requests before it is closed (0 disables)")
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help="seconds a client has to finish sending a request it started (0 disables)")
+    parser.add_argument('--write-timeout', type=float, default=DEFAULT_WRITE_TIMEOUT,
+                        help="seconds a client has to take a response before the connection is dropped (0 disables)")
+    parser.add_argument('--client-rate', type=float, default=0.0,
+                        help="requests per second allowed from each client address (0 disables)")
+    parser.add_argument('--client-burst', type=float,
+                        help="requests a client may send at once above --client-rate (default: one second's worth)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="prefork mode: worker processes (default: one per CPU)")
+    parser.add_argument('--stats-port', type=int,
+                        help="prefork mode: serve the stats action, summed over all workers, on this port")
+    parser.add_argument('--graceful-timeout', type=float, default=DEFAULT_GRACEFUL_TIMEOUT,
+                        help="seconds a stopping server gives requests in progress to finish")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG logs every request and response")
+    parser.add_argument('--log-rate', type=float, default=20.0, help="maximum log lines per second")
+    parser.add_argument('--profile-every', type=int, default=0,
+                        help="profile every Nth request with cProfile (0 disables); see the stats action")
+    parser.add_argument('--no-precompute-routes', action='store_true',
+                        help="skip computing every city pair's routes in the background at startup")
+    parser.add_argument('--write-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help="most bookings and payments committed in one transaction")
+    parser.add_argument('--write-wait', type=float, default=DEFAULT_MAX_WAIT * 1000,
+                        help="milliseconds the writer waits for more work before committing a partial batch")
+    parser.add_argument('--no-pickle', action='store_true',
+                        help="refuse requests from clients that still send pickles")
+    parser.add_argument('--db', default=DB_PATH, help="database file")
+    parser.add_argument('--replication-secret', metavar='SECRET',
+                        help="shared secret replicas must send to fetch the change log; without it none are served")
+    parser.add_argument('--replica-of', metavar='HOST:PORT',
+                        help="run as a read replica of this primary: follow its change log and refuse writes")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="replica: seconds between change log polls once caught up")
+    parser.add_argument('--max-lag', type=float, default=DEFAULT_MAX_LAG,
+                        help="replica: refuse reads after this many seconds without catching up (0 disables)")
+    parser.add_argument('--change-log-retention', type=int, default=DEFAULT_RETENTION,
+                        help="newest change log entries kept for replicas (0 keeps everything)")
+    args = parser.parse_args(argv)
+    if args.replica_of and args.mode == 'prefork':
+        parser.error("--replica-of runs one process; use --mode threaded or async")
+    if args.replica_of and not args.replication_secret:
+        parser.error("--replica-of needs the primary's --replication-secret")
+    return args
 
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    configure(args)
+    if args.mode == 'prefork':
+        from prefork import Supervisor
+        setup_database()
+        start_replication()
+        if PRECOMPUTE_ROUTES:
+            # Computed once here and saved for the workers to load
+            threading.Thread(target=precompute_routes, name='routes', daemon=True).start()
+        Supervisor(args).run()
+    elif args.mode == 'async':
+        start_async_server(args.host, args.port, args.backlog, args.max_connections, args.db_workers,
+                           args.graceful_timeout)
+    else:
+        start_server(args.host, args.port, args.backlog, args.max_connections, args.db_workers)
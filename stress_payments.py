@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+import db
+import server
+
+# Hammer book_and_pay and process_payment from many threads against one
+# account and check that the balance never goes negative and that every
+# successful debit left exactly one booking behind
+
+
+def run(threads=32, attempts=200, amount=7.0, initial_balance=5000.0):
+    workdir = tempfile.mkdtemp(prefix='stress_payments_')
+    db.configure_pool(os.path.join(workdir, 'hotel_booking.db'), max_size=threads)
+    server.setup_database()
+    with db.get_pool().transaction() as conn:
+        conn.execute("UPDATE BankAccount SET balance=? WHERE account_number='12345'", (initial_balance,))
+
+    counts = {'booked': 0, 'paid': 0, 'rejected': 0}
+    counts_lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def worker(worker_id):
+        start.wait()
+        for attempt in range(attempts):
+            booking = {
+                'booking_id': f'STRESS-{worker_id}-{attempt}', 'transport_type': None, 'origin': 'Chicago',
+                'destination': 'Chicago', 'transport_cost': 0, 'hotel_name': 'City Central', 'room_type': 'Suite',
+                'hotel_cost': amount, 'total_amount': amount,
+            }
+            if attempt % 4 == 0:
+                result = server.process_payment({'account_number': '12345', 'password': 'pass', 'total_amount': amount})
+                outcome = 'paid'
+            else:
+                result = server.book_and_pay({'account_number': '12345', 'password': 'pass', 'booking': booking})
+                outcome = 'booked'
+            with counts_lock:
+                counts[outcome if result['status'] == 'success' else 'rejected'] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    with db.get_pool().connection() as conn:
+        balance = conn.execute("SELECT balance FROM BankAccount WHERE account_number='12345'").fetchone()[0]
+        bookings = conn.execute("SELECT COUNT(*) FROM Bookings WHERE booking_id LIKE 'STRESS-%'").fetchone()[0]
+
+    expected_balance = initial_balance - (counts['booked'] + counts['paid']) * amount
+    print(f"Attempts: {threads * attempts}, booked: {counts['booked']}, paid only: {counts['paid']}, rejected: {counts['rejected']}")
+    print(f"Final balance: {balance:.2f} (expected {expected_balance:.2f}), bookings stored: {bookings}")
+
+    failures = []
+    if balance < 0:
+        failures.append("balance went negative")
+    if abs(balance - expected_balance) > 1e-6:
+        failures.append("balance does not match the successful debits")
+    if bookings != counts['booked']:
+        failures.append("stored bookings do not match successful book_and_pay calls")
+    if counts['booked'] + counts['paid'] != int(initial_balance // amount):
+        failures.append("balance was not drained exactly to the last affordable debit")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return not failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrency stress test for payments and bookings")
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--attempts', type=int, default=200, help="payments attempted per thread")
+    parser.add_argument('--amount', type=float, default=7.0)
+    parser.add_argument('--balance', type=float, default=5000.0, help="starting balance of the account")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.threads, args.attempts, args.amount, args.balance) else 1)
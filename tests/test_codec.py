@@ -0,0 +1,178 @@
+import asyncio
+import pickle
+import socket
+
+import pytest
+
+import codec
+from protocol import HEADER, MAX_FRAME_SIZE, read_frame_async, recv_frame, send_frame
+
+MESSAGES = [
+    None, True, False, 0, 255, 256, -1, 2 ** 63 - 1, -2 ** 63, 1.5, -0.0, '', 'héllo', 'action', b'\x00\xff',
+    [], (), {}, [1, 'two', 3.0, None], (1, (2, (3,))),
+    {'action': 'fetch_hotels', 'destination': 'Chicago', 'limit': 20},
+    {'status': 'success', 'result': [(1, 'Bus', 50.0, 'Chicago', 'New York', None)]},
+    # Query results: short ones are sent cell by cell, long ones as packed columns
+    [(i, f'Hotel {i}', 'Chicago', 100.0 + i) for i in range(5)],
+    [(i, f'Hotel {i}', 'Chicago', 100.0 + i) for i in range(1000)],
+    [(i * 70000, -i, 2 ** 40 + i) for i in range(20)],
+    [(f'a{i}\x00b', i) for i in range(20)],
+    [('x', 1), ('y', 2.5), ('z', None)] * 10,
+    {('Chicago', 'New York', 3, 3, 'cheapest'): [{'cost': 1.0}]},
+    'x' * 1000, list(range(300)),
+]
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+def test_binary_round_trip_preserves_types(message):
+    decoded, used = codec.decode(codec.encode(message, codec.BINARY))
+    assert used == codec.BINARY
+    assert decoded == message
+    assert type(decoded) is type(message)
+
+
+@pytest.mark.parametrize('message', [m for m in MESSAGES if not isinstance(m, bytes)
+                                     and not (isinstance(m, dict) and any(isinstance(k, tuple) for k in m))])
+def test_json_round_trip(message):
+    decoded, used = codec.decode(codec.encode(message, codec.JSON))
+    assert used == codec.JSON
+    # JSON has no tuples
+    assert codec.encode(decoded, codec.BINARY) == codec.encode(_as_lists(message), codec.BINARY)
+
+
+def _as_lists(value):
+    if isinstance(value, (list, tuple)):
+        return [_as_lists(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _as_lists(item) for key, item in value.items()}
+    return value
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+def test_pickle_round_trip(message):
+    assert codec.decode(codec.encode(message, codec.PICKLE)) == (message, codec.PICKLE)
+
+
+@pytest.mark.parametrize('value', [float('inf'), float('-inf'), float('nan')])
+def test_json_refuses_non_finite_floats(value):
+    with pytest.raises(codec.CodecError):
+        codec.encode({'max': value}, codec.JSON)
+
+
+def test_unencodable_values_raise_codec_error():
+    for codec_byte in (codec.BINARY, codec.JSON):
+        with pytest.raises(codec.CodecError):
+            codec.encode({'when': object()}, codec_byte)
+    with pytest.raises(codec.CodecError):
+        codec.encode(2 ** 64, codec.BINARY)
+
+
+@pytest.mark.parametrize('message', MESSAGES)
+def test_every_truncated_binary_message_is_rejected(message):
+    payload = codec.encode(message, codec.BINARY)
+    for end in range(1, len(payload)):
+        with pytest.raises(codec.CodecError):
+            codec.decode(payload[:end])
+
+
+@pytest.mark.parametrize('payload', [
+    b'',
+    b'\x07',
+    b'\x01',
+    b'\x01\xee',
+    b'\x01' + bytes((codec.T_SYMBOL, len(codec.SYMBOLS))),
+    b'\x01' + bytes((codec.T_NONE, codec.T_NONE)),
+    b'\x01' + bytes((codec.T_STR, 2)) + b'\xff\xfe',
+    b'\x01' + bytes((codec.T_LIST, 0xFF)) + b'\xff\xff\xff\xff',
+    b'\x01' + bytes((codec.T_ROWS, 0xFF)) + b'\xff\xff\xff\xff' + bytes((2, codec.C_INT64)),
+    b'\x01' + bytes((codec.T_ROWS, 2, 1, 99)),
+    b'\x02{"action": ',
+    b'\x02\xff',
+    b'\x80\x05\x95',
+])
+def test_malformed_payloads_raise_codec_error(payload):
+    with pytest.raises(codec.CodecError):
+        codec.decode(payload)
+
+
+@pytest.mark.parametrize('codec_byte', [codec.BINARY, codec.JSON])
+def test_deeply_nested_payload_raises_codec_error(codec_byte):
+    if codec_byte == codec.BINARY:
+        payload = b'\x01' + bytes((codec.T_LIST, 1)) * 100000 + bytes((codec.T_NONE,))
+    else:
+        payload = b'\x02' + b'[' * 100000 + b']' * 100000
+    with pytest.raises(codec.CodecError):
+        codec.decode(payload)
+
+
+def test_pickles_may_not_load_globals():
+    with pytest.raises(codec.CodecError):
+        codec.decode(pickle.dumps(socket.socket, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def test_pickles_can_be_refused(monkeypatch):
+    monkeypatch.setattr(codec, 'ALLOW_PICKLE', False)
+    with pytest.raises(codec.CodecError):
+        codec.decode(codec.encode({'action': 'fetch_cities'}, codec.PICKLE))
+
+
+@pytest.fixture
+def sockets():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_frames_round_trip(sockets):
+    left, right = sockets
+    payloads = [b'', b'x', codec.encode(MESSAGES[23], codec.BINARY)]
+    for payload in payloads:
+        send_frame(left, payload)
+    left.close()
+    assert [recv_frame(right) for _ in payloads] == payloads
+    # A clean close between frames
+    assert recv_frame(right) is None
+
+
+def test_oversized_frame_is_refused(sockets):
+    left, right = sockets
+    left.sendall(HEADER.pack(MAX_FRAME_SIZE + 1))
+    with pytest.raises(ConnectionError):
+        recv_frame(right)
+    with pytest.raises(ValueError):
+        send_frame(left, b'x' * (MAX_FRAME_SIZE + 1))
+
+
+@pytest.mark.parametrize('data', [HEADER.pack(10) + b'short', b'\x00\x00'])
+def test_truncated_frame_is_refused(sockets, data):
+    left, right = sockets
+    left.sendall(data)
+    left.close()
+    with pytest.raises(ConnectionError):
+        recv_frame(right)
+
+
+def _read_async(data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        frames = []
+        while True:
+            frame = await read_frame_async(reader)
+            if frame is None:
+                return frames
+            frames.append(frame)
+    return asyncio.run(read())
+
+
+def test_async_frames_round_trip():
+    payloads = [b'', b'abc', codec.encode(MESSAGES[22], codec.JSON)]
+    assert _read_async(b''.join(HEADER.pack(len(p)) + p for p in payloads)) == payloads
+
+
+@pytest.mark.parametrize('data', [HEADER.pack(MAX_FRAME_SIZE + 1), HEADER.pack(10) + b'short', b'\x00\x00'])
+def test_async_malformed_frames_are_refused(data):
+    with pytest.raises(ConnectionError):
+        _read_async(data)
@@ -0,0 +1,130 @@
+import random
+
+import pytest
+
+from routes import (COST, DESTINATION, DURATION, ID, ORIGIN, WEIGHTS, RouteGraph, itinerary,
+                    k_shortest_paths)
+
+
+# Random costs and durations, so equally good routes (whose order could
+# depend on adjacency order) practically never occur
+def random_row(rng, edge_id, cities):
+    origin, destination = rng.sample(cities, 2)
+    duration = None if rng.random() < 0.1 else rng.uniform(0.5, 12.0)
+    return (edge_id, rng.choice(['Bus', 'Train', 'Flight']), rng.uniform(10.0, 300.0), origin, destination, duration)
+
+
+def random_graph(rng, cities=40, edges=200):
+    names = [f'C{index:02d}' for index in range(cities)]
+    rows = [(index + 1, 'Bus', rng.uniform(10.0, 300.0), names[index], names[(index + 1) % cities], rng.uniform(0.5, 12.0))
+            for index in range(cities)]
+    rows += [random_row(rng, edge_id, names) for edge_id in range(cities + 1, edges + 1)]
+    return names, rows
+
+
+def fresh(graph, key):
+    origin, destination, k, max_legs, sort = key
+    paths = k_shortest_paths(graph._adjacency, origin, destination, k, max_legs, WEIGHTS[sort])
+    return [itinerary(path) for _, path in paths]
+
+
+def legs(result):
+    return [[row[ID] for row in route['legs']] for route in result]
+
+
+def assert_cache_fresh(graph):
+    for key, cached in list(graph._cache.items()):
+        assert legs(cached) == legs(fresh(graph, key)), key
+
+
+def test_routes_match_a_direct_search():
+    rng = random.Random(1)
+    names, rows = random_graph(rng)
+    graph = RouteGraph(rows)
+    for _ in range(50):
+        origin, destination = rng.sample(names, 2)
+        for sort in WEIGHTS:
+            result = graph.routes(origin, destination, 3, 3, sort)
+            assert legs(result) == legs(fresh(graph, (origin, destination, 3, 3, sort)))
+            costs = [route['cost' if sort == 'cheapest' else 'duration'] for route in result]
+            assert costs == sorted(costs)
+            for route in result:
+                assert 1 <= len(route['legs']) <= 3
+                assert route['legs'][0][ORIGIN] == origin and route['legs'][-1][DESTINATION] == destination
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cache_stays_fresh_through_edge_changes(seed):
+    rng = random.Random(seed)
+    names, rows = random_graph(rng, cities=30, edges=120)
+    graph = RouteGraph(rows)
+    graph.precompute(limit=200)
+    next_id = len(rows) + 1
+    for _ in range(30):
+        change = rng.random()
+        if change < 0.4:
+            graph.add_edge(random_row(rng, next_id, names))
+            next_id += 1
+        elif change < 0.6:
+            # Same id, new cost: replaces the edge
+            row = rng.choice(list(graph._edges.values()))
+            graph.add_edge(row[:COST] + (row[COST] * rng.uniform(0.2, 1.5),) + row[COST + 1:])
+        else:
+            graph.remove_edge(rng.choice(list(graph._edges)))
+        assert_cache_fresh(graph)
+        # Refill some of what was dropped, so later changes meet a full cache
+        for _ in range(10):
+            origin, destination = rng.sample(names, 2)
+            graph.routes(origin, destination, rng.randint(1, 4), rng.randint(1, 4), rng.choice(list(WEIGHTS)))
+
+
+def test_sync_applies_only_the_differences():
+    rng = random.Random(7)
+    names, rows = random_graph(rng)
+    graph = RouteGraph()
+    graph.sync(rows)
+    graph.precompute(limit=400)
+    changed = rows[:-10] + [random_row(rng, len(rows) + index, names) for index in range(1, 4)]
+    changed[5] = changed[5][:DURATION] + (1.0,)
+    graph.sync(changed)
+    assert set(graph._edges) == {row[ID] for row in changed}
+    assert_cache_fresh(graph)
+
+
+def test_new_edge_keeps_answers_it_cannot_change():
+    rng = random.Random(3)
+    names, rows = random_graph(rng, cities=60, edges=300)
+    graph = RouteGraph(rows)
+    graph.precompute(limit=2000)
+    before = len(graph._cache)
+    graph.add_edge((len(rows) + 1, 'Bus', 250.0, names[0], names[30], 11.0))
+    assert len(graph._cache) > before * 0.8
+    assert_cache_fresh(graph)
+
+
+def test_removed_edge_drops_the_answers_using_it():
+    rng = random.Random(4)
+    names, rows = random_graph(rng)
+    graph = RouteGraph(rows)
+    graph.precompute(limit=400)
+    used = next(route['legs'][0][ID] for cached in graph._cache.values() for route in cached)
+    graph.remove_edge(used)
+    assert not any(row[ID] == used for cached in graph._cache.values() for route in cached for row in route['legs'])
+    assert_cache_fresh(graph)
+
+
+def test_saved_routes_load_only_into_the_same_edges(tmp_path):
+    rng = random.Random(5)
+    _, rows = random_graph(rng)
+    graph = RouteGraph(rows)
+    queries = graph.precompute(limit=200)
+    path = str(tmp_path / 'routes')
+    graph.save(path)
+
+    same = RouteGraph(rows)
+    assert same.load(path) == queries
+    assert same._cache == graph._cache
+    assert_cache_fresh(same)
+
+    assert RouteGraph(rows[:-1]).load(path) == 0
+    assert RouteGraph(rows).load(str(tmp_path / 'missing')) == 0
@@ -1,41 +1,94 @@
+import argparse
 import sqlite3
 
-def view_bookings():
-    # Connect to the SQLite database
-    conn = sqlite3.connect('hotel_booking.db')
-    cursor = conn.cursor()
-    
-    # Query to fetch all bookings
-    cursor.execute('''
-    SELECT booking_id, transport_type, origin AS source, destination, transport_cost, hotel_name, room_type, hotel_cost, total_amount
+# Rows fetched per keyset page; memory use stays flat however big the table is
+PAGE_SIZE = 500
+
+# Stream bookings page by page, ordered by row id. Each page resumes after the
+# last key seen (keyset pagination), so no page costs more than the one before.
+# first_booking and last_booking bound the booking IDs shown (inclusive); with
+# either one the pages walk the booking_id index instead, in booking ID order,
+# which for server-assigned IDs is creation order too.
+def iter_bookings(conn, destination=None, hotel_name=None, first_booking=None, last_booking=None, limit=None,
+                  page_size=PAGE_SIZE):
+    by_booking_id = first_booking is not None or last_booking is not None
+    key = 'booking_id' if by_booking_id else 'id'
+    filters = []
+    params = []
+    if destination is not None:
+        filters.append("destination = ?")
+        params.append(destination)
+    if hotel_name is not None:
+        filters.append("hotel_name = ?")
+        params.append(hotel_name)
+    if first_booking is not None:
+        filters.append("booking_id >= ?")
+        params.append(first_booking)
+    if last_booking is not None:
+        filters.append("booking_id <= ?")
+        params.append(last_booking)
+    where = ''.join(f" AND {condition}" for condition in filters)
+    query = f'''
+    SELECT {key}, booking_id, transport_type, origin AS source, destination, transport_cost, hotel_name, room_type, hotel_cost, total_amount
     FROM Bookings
-    ''')
-    
-    bookings = cursor.fetchall()
-    
+    WHERE {key} > ?{where}
+    ORDER BY {key}
+    LIMIT ?
+    '''
+
+    last_key = '' if by_booking_id else -1
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        rows = 0
+        for row in conn.execute(query, [last_key] + params + [size]):
+            last_key = row[0]
+            rows += 1
+            yield row[1:]
+        if remaining is not None:
+            remaining -= rows
+        if rows < size:
+            break
+
+def view_bookings(destination=None, hotel_name=None, first_booking=None, last_booking=None, limit=None,
+                  db_path='hotel_booking.db'):
+    # Connect to the SQLite database
+    conn = sqlite3.connect(db_path)
+
+    found = False
+    for booking in iter_bookings(conn, destination, hotel_name, first_booking, last_booking, limit):
+        if not found:
+            found = True
+            print("Bookings:")
+            print(f"{'Booking ID':<27} {'Transport':<15} {'Source':<15} {'Destination':<15} {'Transport Cost':<15} {'Hotel Name':<20} {'Room Type':<20} {'Hotel Cost':<10} {'Total Amount':<10}")
+        booking_id, transport_type, source, destination_city, transport_cost, hotel, room_type, hotel_cost, total_amount = booking
+
+        # Handle None values by providing default values
+        transport_type = transport_type or 'N/A'
+        transport_cost = transport_cost if transport_cost is not None else 0
+        hotel = hotel or 'N/A'
+        room_type = room_type or 'N/A'
+        hotel_cost = hotel_cost if hotel_cost is not None else 0
+        total_amount = total_amount if total_amount is not None else 0
+
+        # Print the booking details with proper formatting
+        print(f"{booking_id:<27} {transport_type:<15} {source:<15} {destination_city:<15} ${transport_cost:<14} {hotel:<20} {room_type :<20} ${hotel_cost:<10} ${total_amount:<10}")
+
     # Check if there are bookings
-    if not bookings:
+    if not found:
         print("No bookings found.")
-    else:
-        print("Bookings:")
-        print(f"{'Booking ID':<15} {'Transport':<15} {'Source':<15} {'Destination':<15} {'Transport Cost':<15} {'Hotel Name':<20} {'Room Type':<20} {'Hotel Cost':<10} {'Total Amount':<10}")
-        for booking in bookings:
-            booking_id, transport_type, source, destination, transport_cost, hotel_name, room_type, hotel_cost, total_amount = booking
-
-            # Handle None values by providing default values
-            transport_type = transport_type or 'N/A'
-            transport_cost = transport_cost if transport_cost is not None else 0
-            hotel_name = hotel_name or 'N/A'
-            room_type = room_type or 'N/A'
-            hotel_cost = hotel_cost if hotel_cost is not None else 0
-            total_amount = total_amount if total_amount is not None else 0
-
-            # Print the booking details with proper formatting
-            print(f"{booking_id:<15} {transport_type:<15} {source:<15} {destination:<15} ${transport_cost:<14} {hotel_name:<20} {room_type :<20} ${hotel_cost:<10} ${total_amount:<10}")
-    
+
     # Close the database connection
     conn.close()
 
 # Call the view_bookings function to display bookings
 if __name__ == "__main__":
-    view_bookings()
+    parser = argparse.ArgumentParser(description="Display stored bookings")
+    parser.add_argument('--destination', help="only bookings for this destination city")
+    parser.add_argument('--hotel', help="only bookings at this hotel")
+    parser.add_argument('--from', dest='first_booking', metavar='BOOKING_ID', help="first booking ID to show")
+    parser.add_argument('--to', dest='last_booking', metavar='BOOKING_ID', help="last booking ID to show")
+    parser.add_argument('--limit', type=int, help="stop after this many bookings")
+    parser.add_argument('--db', default='hotel_booking.db', help="database file")
+    args = parser.parse_args()
+    view_bookings(args.destination, args.hotel, args.first_booking, args.last_booking, args.limit, args.db)